@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""bytes/sample and CPU/sample for compressed frames vs plain ones, on a few kinds of signal"""
+
+import time
+import numpy as np
+from livechart.lib import pack_frame
+from livechart.lib import pack_compressed_frame
+from livechart.lib import FrameParser
+from livechart.lib import RECORD_DTYPE
+from livechart.lib import Decimator
+from livechart.lib import GorillaEncoder
+from livechart.lib import GorillaDecoder
+
+n = 1000  # samples per batch frame
+reps = 20
+rng = np.random.default_rng(0)
+
+
+def records(vals: np.ndarray, period_ns: int = 10**6, jitter_ns: int = 0) -> np.ndarray:
+    recs = np.empty(len(vals), dtype=RECORD_DTYPE)
+    recs["t"] = 1_700_000_000 * 10**9 + np.arange(len(vals)) * period_ns + rng.integers(0, jitter_ns + 1, len(vals))
+    recs["v"] = vals
+    return recs
+
+
+signals = {
+    "thermal (1 kHz, 1 mdegC steps)": records(np.round(45 + np.cumsum(rng.normal(0, 0.002, n)), 3)),
+    "random (1 kHz, uniform)": records(rng.random(n)),
+    "random, jittered clock": records(rng.random(n), jitter_ns=50_000),
+    "thermal in mdegC (sysfs units)": records(np.round(45000 + np.cumsum(rng.normal(0, 2, n)))),
+}
+fast = records(np.round(45 + np.cumsum(rng.normal(0, 0.002, 100 * n)), 3), period_ns=10**5)
+signals["100Hz tier of 10 kHz thermal"] = Decimator(0.01).feed(fast["t"], fast["v"])
+
+
+def per_sample(fun, n_samples: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(reps):
+        fun()
+    return (time.perf_counter() - t0) / reps / n_samples * 1e9
+
+
+print(f"{'signal':32s} {'level':>5s} {'B/sample':>9s} {'pack ns/sample':>15s} {'unpack ns/sample':>17s}")
+for name, vals in signals.items():
+    plain = pack_frame(0, vals, dtype=vals.dtype)
+    print(f"{name:32s} {'none':>5s} {len(plain) / len(vals):9.2f} {per_sample(lambda: pack_frame(0, vals, dtype=vals.dtype), len(vals)):15.1f} {per_sample(lambda: FrameParser().feed(plain), len(vals)):17.1f}")
+    for level in (1, 6, 9):
+        packed = pack_compressed_frame(0, vals, dtype=vals.dtype, level=level)
+        print(f"{'':32s} {level:5d} {len(packed) / len(vals):9.2f} {per_sample(lambda: pack_compressed_frame(0, vals, dtype=vals.dtype, level=level), len(vals)):15.1f} {per_sample(lambda: FrameParser().feed(packed), len(vals)):17.1f}")
+
+print()
+print(f"{'signal':32s} {'gorilla B/sample':>16s} {'encode ns/sample':>17s} {'decode ns/sample':>17s}")
+for name, vals in signals.items():
+    if vals.dtype != RECORD_DTYPE:
+        continue
+    packed = GorillaEncoder().encode(vals["t"], vals["v"])
+    print(f"{name:32s} {len(packed) / len(vals):16.2f} {per_sample(lambda: GorillaEncoder().encode(vals['t'], vals['v']), len(vals)):17.1f} {per_sample(lambda: GorillaDecoder().decode(packed, len(vals)), len(vals)):17.1f}")
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""rows/s into postgres for each of DBTool.add_data's modes, needs a database you don't mind it writing a scratch table into"""
+
+import argparse
+import asyncio
+import time
+import psycopg
+from livechart.db import DBTool
+from livechart.db import RandomSource
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("uri", help="database to use, e.g. postgresql://me@localhost/me")
+parser.add_argument("-t", "--table", default="tbl_ingest_bench", help="scratch table name, it gets dropped and recreated")
+parser.add_argument("-d", "--duration", type=float, default=5.0, help="seconds per mode")
+parser.add_argument("-r", "--rate", type=float, default=10**6, help="samples per second offered by the source")
+parser.add_argument("-m", "--modes", default="row,executemany,pipeline,copy", help="comma separated modes to try")
+args = parser.parse_args()
+
+
+async def main():
+    dbw = DBTool(db_uri=args.uri)
+    dbw.tbl_name = args.table
+    async with await psycopg.AsyncConnection.connect(conninfo=dbw.db_uri, autocommit=True) as aconn:
+        async with aconn.cursor() as acur:
+            await dbw.setup_data_table(aconn, acur, recreate_tables=True)
+            print(f"{'mode':>12s} {'rows':>10s} {'rows/s':>12s}")
+            for mode in args.modes.split(","):
+                async with RandomSource(artificial_delay=1 / args.rate) as d_source:
+                    t0 = time.monotonic()
+                    n_rows = await dbw.add_data(aconn, acur, d_source, timeout=args.duration, mode=mode)
+                    elapsed = time.monotonic() - t0
+                print(f"{mode:>12s} {n_rows:10d} {n_rows / elapsed:12.0f}")
+
+
+asyncio.run(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""achieved vs requested sample rate for the synthetic source: a sleep per sample, the deadline scheduler, and batches per tick"""
+
+import asyncio
+import time
+from livechart.db import RandomSource
+
+duration = 1.0  # seconds per measurement
+
+
+async def sleep_each(delay: float) -> tuple[int, int]:
+    """the way it used to be done, for comparison"""
+    n = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        await asyncio.sleep(delay)
+        n += 1
+    return n, n
+
+
+async def get_each(delay: float) -> tuple[int, int]:
+    n = 0
+    end = time.monotonic() + duration
+    async with RandomSource(artificial_delay=delay) as source:
+        while time.monotonic() < end:
+            await source.get()
+            n += 1
+    return n, n
+
+
+async def batches(delay: float) -> tuple[int, int]:
+    n = 0
+    wakes = 0
+    end = time.monotonic() + duration
+    async with RandomSource(artificial_delay=delay) as source:
+        async for ts, vals in source:
+            n += len(vals)
+            wakes += 1
+            if time.monotonic() >= end:
+                break
+    return n, wakes
+
+
+async def main():
+    print(f"{'requested Hz':>12s} {'method':>12s} {'achieved Hz':>12s} {'achieved %':>11s} {'wakes/s':>9s}")
+    for delay in (1e-2, 1e-3, 1e-4, 1e-5):
+        for name, fun in (("sleep each", sleep_each), ("get()", get_each), ("get_many()", batches)):
+            n, wakes = await fun(delay)
+            print(f"{1 / delay:12.0f} {name:>12s} {n / duration:12.0f} {n * delay / duration * 100:11.1f} {wakes / duration:9.0f}")
+
+
+asyncio.run(main())
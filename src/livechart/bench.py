@@ -0,0 +1,160 @@
+"""load generator and fan-out benchmark for LiveServer"""
+
+import asyncio
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+import os
+import numpy as np
+from .server import LiveServer
+from .lib import FrameParser
+from .lib import is_control
+
+
+def raise_fd_limit():
+    """lots of clients need lots of sockets"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_bytes() -> int:
+    """current resident set size of this process"""
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+async def generate(ls: LiveServer, rate: float, period: float = 0.001):
+    """puts rate random samples per second into the server, in batches on an absolute schedule so it doesn't drift"""
+    rng = np.random.default_rng()
+    start = time.monotonic()
+    n_put = 0
+    while True:
+        await asyncio.sleep(period)
+        due = int((time.monotonic() - start) * rate) - n_put
+        if due > 0:
+            ls.putter(rng.random(due))
+            n_put += due
+
+
+async def client(host: str, port: int, cmd: dict, started: asyncio.Event, stop: asyncio.Event) -> dict:
+    """one viewer: counts what it gets once started is set, and how old each sample was when it got here"""
+    reader, writer = await asyncio.open_connection(host, port)
+    msg = json.dumps(cmd).encode()
+    writer.write(f"{len(msg)}".encode() + msg)
+    parser = FrameParser()
+    n_samples = 0
+    n_bytes = 0
+    latencies = []
+    while not stop.is_set():
+        try:
+            data = await asyncio.wait_for(reader.read(2**16), 0.1)
+        except asyncio.TimeoutError:
+            continue
+        if not data:
+            break
+        now = time.time_ns()
+        frames = parser.feed(data)
+        if not started.is_set():
+            continue
+        n_bytes += len(data)
+        for header, vals in frames:
+            if is_control(header) or (len(vals) == 0):
+                continue
+            n_samples += len(vals)
+            latencies.append(now - vals["t"])
+    writer.close()
+    return {"samples": n_samples, "bytes": n_bytes, "latencies": np.concatenate(latencies) if latencies else np.zeros(0, dtype=np.int64)}
+
+
+def clients_main(host: str, port: int, n_clients: int, cmd: dict, duration: float, conn):
+    """the body of the client process, tells conn when they're all connected and then sends back their results"""
+    raise_fd_limit()
+
+    async def run():
+        started = asyncio.Event()
+        stop = asyncio.Event()
+        tasks = [asyncio.create_task(client(host, port, cmd, started, stop)) for i in range(n_clients)]
+        await asyncio.sleep(0.5)  # for the connections to settle in
+        conn.send("started")
+        started.set()
+        t0 = time.monotonic()
+        await asyncio.sleep(duration)
+        stop.set()
+        results = await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - t0
+        rates = np.array([result["samples"] / elapsed for result in results])
+        latencies = np.concatenate([result["latencies"] for result in results]) / 1e6  # ms
+        summary = {
+            "elapsed_s": elapsed,
+            "samples_per_s": float(rates.sum()),
+            "bytes_per_s": sum(result["bytes"] for result in results) / elapsed,
+            "per_client_samples_per_s": {"min": float(rates.min()), "mean": float(rates.mean()), "max": float(rates.max())},
+            "fairness": float(rates.sum() ** 2 / (len(rates) * (rates**2).sum())) if rates.any() else 0.0,  # Jain's index, 1 is perfectly fair
+            "latency_ms": {f"p{q}": float(np.percentile(latencies, q)) if len(latencies) else None for q in (50, 90, 99, 99.9)},
+        }
+        conn.send(summary)
+
+    asyncio.run(run())
+
+
+async def bench_one(n_clients: int, rate: float, duration: float, cmd: dict) -> dict:
+    """one run: a fresh server in this process, n_clients in another one"""
+    async with LiveServer(host="127.0.0.1", port=0, sources=["random"], history_samples=0) as ls:
+        server_task = asyncio.create_task(ls.run())
+        generator = asyncio.create_task(generate(ls, rate))
+        parent_conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.get_context("spawn").Process(target=clients_main, args=(ls.host, ls.port, n_clients, cmd, duration, child_conn), daemon=True)
+        proc.start()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, parent_conn.recv)  # they're all connected
+        usage0 = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.monotonic()
+        n_in0 = ls.sources["random"].samples_in.total
+        result = await loop.run_in_executor(None, parent_conn.recv)
+        elapsed = time.monotonic() - t0
+        usage1 = resource.getrusage(resource.RUSAGE_SELF)
+        n_in = ls.sources["random"].samples_in.total - n_in0
+        proc.join()
+        generator.cancel()
+        server_task.cancel()
+    cpu = (usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime)
+    result.update(
+        {
+            "clients": n_clients,
+            "source_samples_per_s": n_in / elapsed,
+            "server_cpu_s_per_s": cpu / elapsed,
+            "server_cpu_us_per_sample_out": cpu / max(result["samples_per_s"] * elapsed, 1) * 1e6,
+            "server_rss_bytes": rss_bytes(),
+            "server_max_rss_bytes": usage1.ru_maxrss * 1024,
+        }
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how LiveServer copes with many clients")
+    parser.add_argument("-n", "--clients", default="1,10,100,1000", help="comma separated numbers of clients to try")
+    parser.add_argument("-r", "--rate", type=float, default=1000.0, help="samples per second from the synthetic source")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="seconds to measure for, per run")
+    parser.add_argument("-t", "--tier", default="raw", help="rate tier the clients subscribe to")
+    parser.add_argument("-c", "--compression", type=int, default=0, help="zlib level the clients ask for, 0 for none")
+    parser.add_argument("-p", "--policy", default="drop-oldest", help="backpressure policy the clients ask for")
+    parser.add_argument("-o", "--output", default="livechart_bench.json", help="where to write the results")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    cmd = {"framed": True, "tier": args.tier, "compression": args.compression, "policy": args.policy}
+    results = {"params": {"rate": args.rate, "duration": args.duration, "cmd": cmd}, "runs": []}
+    for n_clients in [int(n) for n in args.clients.split(",")]:
+        run = asyncio.run(bench_one(n_clients, args.rate, args.duration, cmd))
+        results["runs"].append(run)
+        print(f"{n_clients:5d} clients: {run['samples_per_s']:12.0f} samples/s out, fairness {run['fairness']:.3f}, latency p50/p99 {run['latency_ms']['p50']} / {run['latency_ms']['p99']} ms, server CPU {run['server_cpu_s_per_s'] * 100:.1f}%, RSS {run['server_rss_bytes'] / 2**20:.1f} MiB")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results are in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 import json
+import binascii
 import psycopg
 import getpass
 import asyncio
 import datetime as dt
 import random
+import time
+import numpy as np
 from typing import Optional, Tuple
+from .lib import Pacer
+from .lib import ThermalSampler
+from .lib import sensor_name
+from .lib import RateMeter
 
 
 class ThermalSource(object):
@@ -12,48 +19,62 @@ class ThermalSource(object):
 
     _zone_num = 7
     delay = 0.001
-    _temp_file_object = None
+    sampler = None
+    tick: float = 0.001  # batches come at most this often
 
-    def __init__(self, thermal_zone=_zone_num, artificial_delay=delay):
+    def __init__(self, thermal_zone=_zone_num, artificial_delay=delay, root="/sys"):
         self._zone_num = thermal_zone
         self.delay = artificial_delay
+        self.root = root
+        self.pacer = Pacer(self.delay)
 
     async def __aenter__(self) -> "ThermalSource":
-        await self._update_thermal()
+        self._update_thermal()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback) -> Optional[bool]:
-        try:
-            self._temp_file_object.close()
-        except Exception as e:
-            pass
+        if self.sampler is not None:
+            self.sampler.close()
         return True
 
-    async def _update_thermal(self):
-        temp_file_name = f"/sys/class/thermal/thermal_zone{self._zone_num}/temp"
-        if hasattr(self._temp_file_object, "closed"):
-            if self._temp_file_object.closed == False:
-                if self._temp_file_object.name == temp_file_name:
-                    return
-                self._temp_file_object.close()
-        self._temp_file_object = open(temp_file_name, "r")
+    def _update_thermal(self):
+        if self.sampler is not None:
+            if self.sampler.sensors == [f"thermal{self._zone_num}"]:
+                return
+            self.sampler.close()
+        self.sampler = ThermalSampler([f"thermal{self._zone_num}"], root=self.root)
+
+    def _read(self) -> float:
+        return float(self.sampler.read()[0])
 
     async def get(self) -> Tuple[dt.datetime, float]:
-        await asyncio.sleep(self.delay)
-        point_int = int(self._temp_file_object.readline())
-        self._temp_file_object.seek(0)
-        return (dt.datetime.now(), point_int / 1000)
+        await self.pacer.wait()
+        self.pacer.take(1)
+        return (dt.datetime.now(), self._read())
+
+    async def get_many(self, n: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        the next n samples, or when n is None everything that's due by the next tick,
+        as arrays of timestamps [ns] (when each was actually read) and values
+        """
+        due = await self.pacer.wait(n or 1, 0 if n else self.tick)
+        n = len(self.pacer.take(n or due))
+        ts = np.empty(n, dtype=np.int64)
+        vals = np.empty(n, dtype=np.float64)
+        for i in range(n):
+            vals[i] = self._read()
+            ts[i] = time.time_ns()
+        return ts, vals
+
+    def __aiter__(self) -> "ThermalSource":
+        return self
+
+    async def __anext__(self) -> Tuple[np.ndarray, np.ndarray]:
+        return await self.get_many()
 
     @property
     def thermaltype(self):
-        try:
-            type_file = f"/sys/class/thermal/thermal_zone{self._zone_num}/type"
-            with open(type_file, "r") as fh:
-                type_str = fh.readline()
-            result = type_str.strip()
-        except Exception as e:
-            result = "Unknown"
-        return result
+        return sensor_name(f"thermal{self._zone_num}", self.root) or "Unknown"
 
     @property
     def zone(self):
@@ -70,9 +91,12 @@ class RandomSource(object):
     """Random data source class"""
 
     delay: float = 0.001
+    tick: float = 0.001  # batches come at most this often
 
     def __init__(self, artificial_delay: float = delay) -> None:
         self.delay = artificial_delay
+        self.pacer = Pacer(self.delay)
+        self._rng = np.random.default_rng()
 
     async def __aenter__(self) -> "RandomSource":
         return self
@@ -81,9 +105,207 @@ class RandomSource(object):
         return True
 
     async def get(self) -> Tuple[dt.datetime, float]:
-        await asyncio.sleep(self.delay)
+        await self.pacer.wait()
+        self.pacer.take(1)
         return (dt.datetime.now(), random.random())
 
+    async def get_many(self, n: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        the next n samples, or when n is None everything that's due by the next tick,
+        as arrays of timestamps [ns] (when each was scheduled) and values
+        """
+        due = await self.pacer.wait(n or 1, 0 if n else self.tick)
+        ts = self.pacer.take(n or due)
+        return ts, self._rng.random(len(ts))
+
+    def __aiter__(self) -> "RandomSource":
+        return self
+
+    async def __anext__(self) -> Tuple[np.ndarray, np.ndarray]:
+        return await self.get_many()
+
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\0" + bytes(8)  # then no flags and no header extension
+COPY_TRAILER = b"\xff\xff"
+COPY_ROW_DTYPE = np.dtype([("n_fields", ">i2"), ("id_len", ">i4"), ("id", ">i8"), ("ts_len", ">i4"), ("ts", ">i8"), ("val_len", ">i4"), ("val", ">f4")])  # one (id bigint, ts timestamptz, val real) tuple
+PG_EPOCH_NS = 946684800 * 10**9  # 2000-01-01 UTC, what timestamptz counts microseconds from
+ROWS_DTYPE = np.dtype([("id", "<i8"), ("t", "<i8"), ("v", "<f8")])  # unpacked rows, t is [ns since the unix epoch]
+
+
+def pack_copy(ids: np.ndarray, ts: np.ndarray, vals: np.ndarray) -> bytes:
+    """(id, ts [ns since the unix epoch], val) rows as a whole COPY ... FROM STDIN (FORMAT BINARY) stream, in one go"""
+    rows = np.empty(len(ids), dtype=COPY_ROW_DTYPE)
+    rows["n_fields"] = 3
+    rows["id_len"] = 8
+    rows["id"] = ids
+    rows["ts_len"] = 8
+    rows["ts"] = (np.asarray(ts, dtype=np.int64) - PG_EPOCH_NS) // 1000
+    rows["val_len"] = 4
+    rows["val"] = vals
+    return COPY_SIGNATURE + rows.tobytes() + COPY_TRAILER
+
+
+def unpack_copy(data: bytes) -> np.ndarray:
+    """a COPY ... TO STDOUT (FORMAT BINARY) stream of (id, ts, val) rows with no NULLs in them --> a ROWS_DTYPE array"""
+    if len(data) == 0:
+        return np.empty(0, dtype=ROWS_DTYPE)
+    rows = np.frombuffer(data[len(COPY_SIGNATURE) : -len(COPY_TRAILER)], dtype=COPY_ROW_DTYPE)
+    unpacked = np.empty(len(rows), dtype=ROWS_DTYPE)
+    unpacked["id"] = rows["id"]
+    unpacked["t"] = rows["ts"] * 1000 + PG_EPOCH_NS
+    unpacked["v"] = rows["val"]
+    return unpacked
+
+
+def ns_to_datetime(ts: int) -> dt.datetime:
+    return dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc) + dt.timedelta(microseconds=int(ts) // 1000)
+
+
+PACKED_PREFIX = "b64:"  # marks a packed notification payload, JSON ones start with "{"
+PACKED_ROW_DTYPE = np.dtype([("id", ">i8"), ("ts", ">i8"), ("val", ">f4")])  # int8send(id) || timestamptz_send(ts) || float4send(val)
+PACKED_ROWS_MAX = (7999 - len(PACKED_PREFIX)) // 4 * 3 // PACKED_ROW_DTYPE.itemsize  # as many rows as fit in a notification (payloads must be < 8000 bytes)
+
+
+def pack_payloads(ids: np.ndarray, ts: np.ndarray, vals: np.ndarray) -> list[str]:
+    """
+    (id, ts [ns since the unix epoch], val) rows as packed notification payloads, PACKED_ROWS_MAX of them per payload
+    the same thing the packed statement trigger sends
+    """
+    rows = np.empty(len(ids), dtype=PACKED_ROW_DTYPE)
+    rows["id"] = ids
+    rows["ts"] = (np.asarray(ts, dtype=np.int64) - PG_EPOCH_NS) // 1000
+    rows["val"] = vals
+    return [PACKED_PREFIX + binascii.b2a_base64(rows[i : i + PACKED_ROWS_MAX].tobytes(), newline=False).decode() for i in range(0, len(rows), PACKED_ROWS_MAX)]
+
+
+def unpack_payloads(payloads: list[str]) -> np.ndarray:
+    """a batch of packed notification payloads --> one ROWS_DTYPE array, decoded all together"""
+    rows = np.frombuffer(b"".join(binascii.a2b_base64(payload[len(PACKED_PREFIX) :]) for payload in payloads), dtype=PACKED_ROW_DTYPE)
+    unpacked = np.empty(len(rows), dtype=ROWS_DTYPE)
+    unpacked["id"] = rows["id"]
+    unpacked["t"] = rows["ts"] * 1000 + PG_EPOCH_NS
+    unpacked["v"] = rows["val"]
+    return unpacked
+
+
+def has_gap(last_id: int, ids: np.ndarray) -> bool:
+    """whether sorted ids skip any after last_id"""
+    ids = np.unique(ids[ids > last_id])
+    return (len(ids) > 0) and (int(ids[-1]) - last_id > len(ids))
+
+
+def notified_ids(payload: str) -> Tuple[int, int]:
+    """the (first, last) ids a data table notification is about, from either trigger: "<id>" per row or "<first id>,<last id>,<row count>" per statement"""
+    fields = payload.split(",")
+    return (int(fields[0]), int(fields[1] if len(fields) > 1 else fields[0]))
+
+
+class BatchWriter(object):
+    """
+    buffers samples for a data table and writes them out whenever max_rows have piled up or the oldest one is max_age seconds old
+    mode is how: "copy" (binary COPY), "executemany" or "pipeline" (one INSERT per row, but not one round trip per row)
+    each flush is one transaction, ids come from the table's sequence up front so the _events row's start_id/end_id are right
+    """
+
+    modes = ("copy", "executemany", "pipeline")
+
+    def __init__(self, dbt: "DBTool", conn: psycopg.AsyncConnection, mode: str = "copy", max_rows: int = 10000, max_age: float = 0.1):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown mode: {mode}")
+        self.dbt = dbt
+        self.conn = conn
+        self.mode = mode
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.ts = []
+        self.vals = []
+        self.n_buffered = 0
+        self.n_written = 0
+        self.event_id = None
+        self.start_id = None
+        self.end_id = None
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._timed_flushes = set()  # the timer's flush tasks, kept until add() or close() has seen how they went
+
+    async def __aenter__(self) -> "BatchWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def add(self, ts: np.ndarray, vals: np.ndarray):
+        """buffers samples (timestamps [ns] and values), and writes them all if it's time to"""
+        self._raise_timed()
+        if len(vals) == 0:
+            return
+        self.ts.append(np.asarray(ts, dtype=np.int64))
+        self.vals.append(np.asarray(vals, dtype=np.float64))
+        if self.n_buffered == 0:  # the age limit counts from now
+            self._timer = asyncio.get_running_loop().call_later(self.max_age, self._on_timer)
+        self.n_buffered += len(vals)
+        if self.n_buffered >= self.max_rows:
+            await self.flush()
+
+    def _on_timer(self):
+        self._timer = None
+        self._timed_flushes.add(asyncio.create_task(self.flush()))
+
+    def _raise_timed(self):
+        """raises the first error of the timed flushes that have finished"""
+        done = {task for task in self._timed_flushes if task.done()}
+        self._timed_flushes -= done
+        errors = [task.exception() for task in done if (not task.cancelled()) and (task.exception() is not None)]
+        if errors:
+            raise errors[0]
+
+    async def flush(self):
+        """writes out everything that's buffered, which stays buffered if that fails"""
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.n_buffered == 0:
+                return
+            n_arrays = len(self.ts)  # more can be added while we're writing these
+            ts = np.concatenate(self.ts[:n_arrays])
+            vals = np.concatenate(self.vals[:n_arrays])
+            tbl = self.dbt.tbl_name
+            async with self.conn.transaction():
+                async with self.conn.cursor() as cur:
+                    ids = await self.dbt.reserve_ids(cur, len(vals))
+                    if self.mode == "copy":
+                        async with cur.copy(f"COPY {tbl} (id, ts, val) FROM STDIN (FORMAT BINARY)") as copy:
+                            await copy.write(pack_copy(ids, ts, vals))
+                    else:
+                        rows = [(int(i), ns_to_datetime(t), float(v)) for i, t, v in zip(ids, ts, vals)]
+                        if self.mode == "executemany":
+                            await cur.executemany(f"INSERT INTO {tbl}(id, ts, val) VALUES (%s, %s, %s)", rows)
+                        else:
+                            async with self.conn.pipeline():
+                                for row in rows:
+                                    await cur.execute(f"INSERT INTO {tbl}(id, ts, val) VALUES (%s, %s, %s)", row)
+                    if self.event_id is None:
+                        self.start_id = int(ids[0])
+                        await cur.execute(f"INSERT INTO {tbl}_events(start_id) VALUES (%(start_id)s) RETURNING id", {"start_id": self.start_id})
+                        self.event_id = (await cur.fetchone())[0]
+            del self.ts[:n_arrays], self.vals[:n_arrays]
+            self.n_buffered -= len(vals)
+            self.end_id = int(ids[-1])
+            self.n_written += len(vals)
+            if self.n_buffered > 0:  # what came in meanwhile gets its own age limit
+                self._timer = asyncio.get_running_loop().call_later(self.max_age, self._on_timer)
+
+    async def close(self):
+        """writes out what's left and closes the event by setting its end_id, then raises what any timed flush ran into"""
+        if self._timed_flushes:
+            await asyncio.wait(self._timed_flushes)
+        await self.flush()
+        if self.event_id is not None:
+            async with self.conn.transaction():
+                await self.conn.execute(f"UPDATE {self.dbt.tbl_name}_events SET end_id = %(end_id)s WHERE id = %(id)s", {"id": self.event_id, "end_id": self.end_id})
+        self._raise_timed()
+
 
 class DBTool(object):
     db_proto = "postgresql://"
@@ -95,6 +317,10 @@ class DBTool(object):
     listen_channels = []
     tbl_name = "tbl_time_data"
     stop_relay: bool = False  # signal to stop relay
+    ingest: str = "push"  # how ingesting() gets new rows: "push", "pull" or "adaptive"
+    poll_interval: float = 0.05  # [s] between fetches when pulling
+    adaptive_rate: float = 1000.0  # [rows/s] above which adaptive ingest pulls, it pushes again below half of this
+    reconnect_delay: float = 1.0  # [s] before new_listening tries to get a lost connection back
 
     def __init__(self, db_proto=db_proto, db_user=db_user, db_name=db_name, db_host=db_host, db_port=db_port, db_uri=db_uri):
 
@@ -129,8 +355,13 @@ class DBTool(object):
                 self.db_name = db_name
             self.db_uri = self.db_uri + f"/{self.db_name}"
         self.outq = asyncio.Queue()
+        self.last_ids = {}  # data table channel --> the newest id that's gone into outq from it
+        self.last_event_ids = {}  # (channel, event id) --> the newest id that's gone into outq for that event, for JSON rows with an "eid"
+        self.channel_tables = {}  # channel --> the table its missed rows get fetched from, for channels not named after their table
+        self.backfilled = 0  # rows that went into outq because a gap in the notifications was noticed, not because they were notified
+        self._fill_conn = None
 
-    async def run_backend(self, timeout=5, fake_delay=0.001):
+    async def run_backend(self, timeout=5, fake_delay=0.001, mode="copy"):
         aconn = await psycopg.AsyncConnection.connect(conninfo=self.db_uri, autocommit=True)
         async with aconn:
             async with aconn.cursor() as acur:
@@ -140,7 +371,7 @@ class DBTool(object):
                     # phase_one.append(self.setup_data_table(aconn, acur))
                     await asyncio.gather(*phase_one)
                     phase_two = []
-                    phase_two.append(self.add_data(aconn, acur, d_source, timeout=timeout))
+                    phase_two.append(self.add_data(aconn, acur, d_source, timeout=timeout, mode=mode))
                     await asyncio.gather(*phase_two)
         print("run complete!")
 
@@ -156,7 +387,11 @@ class DBTool(object):
         else:
             print("No channels to listen to.")
 
-    async def add_data(self, conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor, d_source: RandomSource, timeout: float = 0):
+    async def add_data(self, conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor, d_source: RandomSource, timeout: float = 0, mode: str = "copy", max_rows: int = 10000, max_age: float = 0.1) -> int:
+        """
+        writes samples from d_source into the table until timeout runs out, returns how many
+        mode "row" is an INSERT and a commit per sample, the others go through a BatchWriter
+        """
         print("adding new data")
         loop = asyncio.get_running_loop()
         if timeout > 0:
@@ -164,11 +399,22 @@ class DBTool(object):
         else:
             end_time = float("inf")
 
+        if mode != "row":
+            async with BatchWriter(self, conn, mode=mode, max_rows=max_rows, max_age=max_age) as writer:
+                while loop.time() < end_time:
+                    ts, vals = await d_source.get_many()
+                    await writer.add(ts, vals)
+            print(f"first_row={writer.start_id}")
+            print(f"last_row={writer.end_id}")
+            return writer.n_written
+
         first_loop: bool = True
         first_row: int = 0
+        n_rows: int = 0
         while loop.time() < end_time:
             data = await d_source.get()
             await cur.execute(f"INSERT INTO {self.tbl_name}(ts, val) VALUES (%(ts)s, %(val)s) RETURNING id", {"ts": data[0], "val": data[1]})
+            n_rows += 1
             if first_loop:
                 first_row = (await cur.fetchone())[0]
                 first_loop = False
@@ -182,8 +428,19 @@ class DBTool(object):
         data = {"id": this_chunk_id, "end_id": last_row}
         await cur.execute(command, data)
         await conn.commit()
-
-    async def setup_data_table(self, conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor, recreate_tables: bool = False):
+        return n_rows
+
+    async def reserve_ids(self, cur: psycopg.AsyncCursor, n: int) -> np.ndarray:
+        """takes the next n ids from the table's sequence, so rows can be written with them already known"""
+        await cur.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", (self.tbl_name, n))
+        return np.array([row[0] for row in await cur.fetchall()], dtype=np.int64)
+
+    async def setup_data_table(self, conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor, recreate_tables: bool = False, statement_triggers: bool = False, packed_payloads: bool = False):
+        """
+        with statement_triggers, the data table notifies once per INSERT or UPDATE statement with "<first id>,<last id>,<row count>",
+        rather than with every row's id, so a batch of rows is one notification (and one wake up for each listener)
+        packed_payloads is statement triggers that send the rows themselves instead, PACKED_ROWS_MAX per notification (see pack_payloads())
+        """
         if recreate_tables:
             # drop and creation order matters because of intertable refs (could probably just use CASCADE)
             await cur.execute(f"DROP TABLE IF EXISTS {self.tbl_name}_events")
@@ -196,32 +453,323 @@ class DBTool(object):
         # (re)setup trigger & function, orders matter because of function/trigger dependance
         await cur.execute(f"DROP TRIGGER IF EXISTS {self.tbl_name}_events_changed ON {self.tbl_name}_events")
         await cur.execute(f"DROP TRIGGER IF EXISTS {self.tbl_name}_changed ON {self.tbl_name}")
+        await cur.execute(f"DROP TRIGGER IF EXISTS {self.tbl_name}_inserted ON {self.tbl_name}")
+        await cur.execute(f"DROP TRIGGER IF EXISTS {self.tbl_name}_updated ON {self.tbl_name}")
 
         await cur.execute(f"DROP FUNCTION IF EXISTS notify_of_change_verbose()")
         await cur.execute(f"DROP FUNCTION IF EXISTS notify_of_change()")
+        await cur.execute(f"DROP FUNCTION IF EXISTS notify_of_statement()")
+        await cur.execute(f"DROP FUNCTION IF EXISTS notify_of_statement_packed()")
         await cur.execute(f"CREATE FUNCTION notify_of_change_verbose() RETURNS TRIGGER AS $$ BEGIN PERFORM pg_notify(TG_ARGV[0], NEW::text); RETURN NULL; END; $$ LANGUAGE plpgsql;")
         await cur.execute(f"CREATE FUNCTION notify_of_change() RETURNS TRIGGER AS $$ BEGIN PERFORM pg_notify(TG_ARGV[0], NEW.id::text); RETURN NULL; END; $$ LANGUAGE plpgsql;")
+        await cur.execute(f"CREATE FUNCTION notify_of_statement() RETURNS TRIGGER AS $$ DECLARE first_id bigint; last_id bigint; n_rows bigint; BEGIN SELECT min(id), max(id), count(*) INTO first_id, last_id, n_rows FROM new_rows; IF n_rows > 0 THEN PERFORM pg_notify(TG_ARGV[0], first_id || ',' || last_id || ',' || n_rows); END IF; RETURN NULL; END; $$ LANGUAGE plpgsql;")
 
         await cur.execute(f"CREATE TRIGGER {self.tbl_name}_events_changed AFTER INSERT OR UPDATE ON {self.tbl_name}_events FOR EACH ROW EXECUTE FUNCTION notify_of_change_verbose ('{self.tbl_name}_events')")
-        await cur.execute(f"CREATE TRIGGER {self.tbl_name}_changed AFTER INSERT OR UPDATE ON {self.tbl_name} FOR EACH ROW EXECUTE FUNCTION notify_of_change ('{self.tbl_name}')")
+        await cur.execute(f"CREATE FUNCTION notify_of_statement_packed() RETURNS TRIGGER AS $$ BEGIN PERFORM pg_notify(TG_ARGV[0], '{PACKED_PREFIX}' || translate(encode(string_agg(int8send(id) || timestamptz_send(coalesce(ts, '-infinity')) || float4send(coalesce(val, 'NaN')), ''::bytea ORDER BY id), 'base64'), E'\\n', '')) FROM (SELECT id, ts, val, (row_number() OVER (ORDER BY id) - 1) / {PACKED_ROWS_MAX} AS chunk FROM new_rows) AS numbered GROUP BY chunk ORDER BY chunk; RETURN NULL; END; $$ LANGUAGE plpgsql;")
+
+        if statement_triggers or packed_payloads:  # a trigger with a transition table can only be for one kind of event
+            function = "notify_of_statement_packed" if packed_payloads else "notify_of_statement"
+            await cur.execute(f"CREATE TRIGGER {self.tbl_name}_inserted AFTER INSERT ON {self.tbl_name} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {function} ('{self.tbl_name}')")
+            await cur.execute(f"CREATE TRIGGER {self.tbl_name}_updated AFTER UPDATE ON {self.tbl_name} REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {function} ('{self.tbl_name}')")
+        else:
+            await cur.execute(f"CREATE TRIGGER {self.tbl_name}_changed AFTER INSERT OR UPDATE ON {self.tbl_name} FOR EACH ROW EXECUTE FUNCTION notify_of_change ('{self.tbl_name}')")
         await conn.commit()
         print("Setup complete!")
 
     async def new_listening(self, conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor):
-        if self.listen_channels != []:
-            await asyncio.gather(*[cur.execute(f"LISTEN {ch}") for ch in self.listen_channels])
-            await conn.commit()
+        """
+        puts every notification's JSON payload (a dict, with "channel" added) in outq, in the order they came in
+        packed payloads that come in together get decoded together and go in as {"channel": ..., "rows": ROWS_DTYPE array}
+        rows with an "id" are kept track of in last_ids, and whatever a gap in their ids (or a lost connection, which
+        gets remade reconnect_delay later) missed is fetched from the channel's table and put in ahead of anything newer
+        """
+        if self.listen_channels == []:
+            print("No channels to listen to.")
+            return
+
+        loop = asyncio.get_running_loop()
+        packed = {}  # channel --> packed payloads that have come in since the last flush
+        packed_channels = set()  # the channels that have sent packed payloads, their missed rows get fetched as ROWS_DTYPE
+        filling = {}  # channel --> the task putting its rows in outq after a backfill, newer rows wait for it
 
-            gen = conn.notifies()
-            async for notify in gen:
+        def busy(channel: str) -> bool:
+            return (channel in filling) and not filling[channel].done()
+
+        def flush():
+            for channel, payloads in packed.items():
+                packed_channels.add(channel)
                 try:
-                    jayson = json.loads(notify.payload)
-                    jayson["channel"] = notify.channel
-                    self.outq.put_nowait(jayson)
-                except:
-                    print(f"Failed to parse payload")
+                    rows = unpack_payloads(payloads)
+                except ValueError:
+                    print(f"Failed to unpack payloads")
+                    continue
+                rows = rows[np.argsort(rows["id"], kind="stable")]
+                last_id = self.last_ids.get(channel)
+                if busy(channel) or ((last_id is not None) and has_gap(last_id, rows["id"])):
+                    filling[channel] = asyncio.create_task(self.splice(channel, rows, filling.get(channel)))
+                else:
+                    self.deliver(channel, rows)
+            packed.clear()
+
+        async def put_after(previous: asyncio.Task, jayson: dict):
+            await previous
+            self.outq.put_nowait(jayson)
+
+        def put(jayson: dict):
+            """queues a JSON payload behind everything that came in before it"""
+            if packed:
+                flush()
+            channel = jayson["channel"]
+            row_id = jayson.get("id")
+            if isinstance(row_id, int) and not isinstance(row_id, bool):
+                last_id = self.last_ids.get(channel)
+                if busy(channel) or ((last_id is not None) and (row_id > last_id + 1)):
+                    filling[channel] = asyncio.create_task(self.splice_dicts(channel, [jayson], filling.get(channel)))
+                else:
+                    self.deliver_dicts(channel, [jayson])
+            elif busy(channel):
+                filling[channel] = asyncio.create_task(put_after(filling[channel], jayson))
+            else:
+                self.outq.put_nowait(jayson)
+
+        own_conn = None  # the one we made after losing the one we were given
+        reconnected = False
+        try:
+            while True:
+                try:
+                    await asyncio.gather(*[cur.execute(f"LISTEN {ch}") for ch in self.listen_channels])
+                    await conn.commit()
+                    if reconnected:  # catch up on what was missed in the meantime
+                        for channel in self.listen_channels:
+                            if channel in self.last_ids:
+                                filling[channel] = asyncio.create_task(self.catch_up(channel, channel in packed_channels, filling.get(channel)))
+                    async for notify in conn.notifies():
+                        if notify.payload.startswith(PACKED_PREFIX):
+                            if not packed:
+                                loop.call_soon(flush)
+                            packed.setdefault(notify.channel, []).append(notify.payload)
+                            continue
+                        try:
+                            jayson = json.loads(notify.payload)
+                            jayson["channel"] = notify.channel
+                        except:
+                            print(f"Failed to parse payload")
+                        else:
+                            put(jayson)
+                    return
+                except psycopg.OperationalError as e:
+                    print(f"Lost the notification connection: {e}")
+                while True:
+                    await asyncio.sleep(self.reconnect_delay)
+                    try:
+                        new_conn = await self.connect()
+                        break
+                    except psycopg.OperationalError as e:
+                        print(f"Failed to reconnect: {e}")
+                if own_conn is not None:
+                    await own_conn.close()
+                conn = own_conn = new_conn
+                cur = conn.cursor()
+                reconnected = True
+        finally:
+            if own_conn is not None:
+                await own_conn.close()
+
+    async def latest_id(self, conn: psycopg.AsyncConnection, tbl: str) -> int:
+        cur = await conn.execute(f"SELECT coalesce(max(id), 0) FROM {tbl}")
+        return (await cur.fetchone())[0]
+
+    async def fetch_since(self, conn: psycopg.AsyncConnection, tbl: str, last_id: int, before_id: int | None = None) -> np.ndarray:
+        """every row of a data table after last_id (and before before_id), in one binary COPY, as a ROWS_DTYPE array"""
+        chunks = []
+        upper = "" if before_id is None else f" AND id < {int(before_id)}"
+        async with conn.cursor() as cur:
+            async with cur.copy(f"COPY (SELECT id, coalesce(ts, '-infinity'), coalesce(val, 'NaN') FROM {tbl} WHERE id > {int(last_id)}{upper} ORDER BY id) TO STDOUT (FORMAT BINARY)") as copy:
+                async for data in copy:
+                    chunks.append(bytes(data))
+        return unpack_copy(b"".join(chunks))
+
+    async def fetch_dicts_since(self, conn: psycopg.AsyncConnection, tbl: str, last_id: int, before_id: int | None = None) -> list[dict]:
+        """every row of a table after last_id (and before before_id), as the dicts a row_to_json notification would have carried"""
+        upper = "" if before_id is None else f" AND id < {int(before_id)}"
+        async with conn.cursor() as cur:
+            await cur.execute(f"SELECT row_to_json(r)::text FROM {tbl} AS r WHERE id > {int(last_id)}{upper} ORDER BY id")
+            return [json.loads(row[0]) for row in await cur.fetchall()]
+
+    async def ingesting(self, conn: psycopg.AsyncConnection, tables: list[str]):
+        """
+        puts new rows from the data tables into outq as {"channel": table, "rows": ROWS_DTYPE array}, starting from now
+        self.ingest picks how it finds out there are some:
+            "push" fetches as soon as a table notifies (all the notifications that came in meanwhile make one fetch)
+            "pull" fetches from every table each poll_interval, notifications or not
+            "adaptive" pushes while rows come slower than adaptive_rate and pulls when they come faster
+        conn is for the fetches, the notifications come over a connection of their own
+        (which gets remade after database errors, anything else that stops it gets raised from here)
+        """
+        for tbl in tables:
+            self.last_ids[tbl] = await self.latest_id(conn, tbl)
+        notified = set()
+        catching_up = set()  # tables whose next fetch makes up for notifications missed while reconnecting
+        wake = asyncio.Event()
+        reconnecting = False
+
+        def listening():
+            if reconnecting:
+                notified.update(tables)
+                catching_up.update(tables)
+                wake.set()
+
+        async def listen():
+            nonlocal reconnecting
+            while True:
+                try:
+                    async for channel, payload in self.notifications(tables, listening=listening):
+                        notified.add(channel)
+                        wake.set()
+                except psycopg.Error as e:
+                    print(f"Lost the notification connection: {e}")
+                reconnecting = True
+                await asyncio.sleep(1.0)
+
+        listener = asyncio.create_task(listen())
+        meter = RateMeter(window=2)
+        mode = "push" if self.ingest == "adaptive" else self.ingest
+        waking = None
+        try:
+            while True:
+                if mode == "pull":
+                    await asyncio.wait({listener}, timeout=self.poll_interval)
+                else:
+                    if (waking is None) or waking.done():
+                        waking = asyncio.create_task(wake.wait())
+                    await asyncio.wait({listener, waking}, return_when=asyncio.FIRST_COMPLETED)
+                if listener.done():  # it only ever stops for something it couldn't deal with
+                    listener.result()
+                    raise RuntimeError("The notification listener stopped")
+                todo = tables if mode == "pull" else [tbl for tbl in tables if tbl in notified]
+                wake.clear()
+                notified.clear()
+                for tbl in todo:
+                    rows = await self.fetch_since(conn, tbl, self.last_ids[tbl])
+                    if tbl in catching_up:
+                        catching_up.discard(tbl)
+                        self.backfilled += len(rows)
+                    if len(rows) > 0:
+                        self.last_ids[tbl] = int(rows["id"][-1])
+                        meter.add(len(rows))
+                        self.outq.put_nowait({"channel": tbl, "rows": rows})
+                if self.ingest == "adaptive":
+                    if (mode == "push") and (meter.rate > self.adaptive_rate):
+                        mode = "pull"
+                    elif (mode == "pull") and (meter.rate < self.adaptive_rate / 2):
+                        mode = "push"
+        finally:
+            listener.cancel()
+            if waking is not None:
+                waking.cancel()
+
+    def deliver(self, channel: str, rows: np.ndarray):
+        """puts a data table's rows (sorted by id) in outq, except the ones that have already gone in"""
+        last_id = self.last_ids.get(channel)
+        if last_id is not None:
+            rows = rows[rows["id"] > last_id]
+        if len(rows) > 0:
+            self.last_ids[channel] = int(rows["id"][-1])
+            self.outq.put_nowait({"channel": channel, "rows": rows})
+
+    async def splice(self, channel: str, rows: np.ndarray, previous: asyncio.Task | None = None):
+        """delivers rows after fetching the ones missing between them and the last ones delivered, in one range query"""
+        if previous is not None:
+            await previous
+        last_id = self.last_ids.get(channel)
+        if (last_id is not None) and has_gap(last_id, rows["id"]):
+            ids = np.concatenate(([last_id], np.unique(rows["id"][rows["id"] > last_id])))
+            holes = np.flatnonzero(np.diff(ids) > 1)
+            try:
+                fetched = await self.fetch_since(await self.fill_conn(), self.table_of(channel), ids[holes[0]], before_id=ids[holes[-1] + 1])
+            except psycopg.Error as e:
+                print(f"Failed to backfill {channel}: {e}")
+            else:
+                missing = fetched[~np.isin(fetched["id"], ids)]
+                self.backfilled += len(missing)
+                rows = np.concatenate((missing, rows))
+                rows = rows[np.argsort(rows["id"], kind="stable")]
+        self.deliver(channel, rows)
+
+    def deliver_dicts(self, channel: str, dicts: list[dict]):
+        """puts JSON rows in outq, keeping last_ids (and last_event_ids, for rows with an "eid") up to date with the rows that have an id"""
+        for jayson in dicts:
+            jayson["channel"] = channel
+            row_id = jayson.get("id")
+            if isinstance(row_id, int) and not isinstance(row_id, bool):
+                self.last_ids[channel] = max(self.last_ids.get(channel, row_id), row_id)
+                eid = jayson.get("eid")
+                if isinstance(eid, (int, str)):
+                    key = (channel, eid)
+                    self.last_event_ids[key] = max(self.last_event_ids.get(key, row_id), row_id)
+            self.outq.put_nowait(jayson)
+
+    async def splice_dicts(self, channel: str, dicts: list[dict], previous: asyncio.Task | None = None):
+        """delivers JSON rows (with an "id") after fetching the ones missing between them and the last one delivered"""
+        if previous is not None:
+            await previous
+        last_id = self.last_ids.get(channel)
+        first_id = min(jayson["id"] for jayson in dicts)
+        if (last_id is not None) and (first_id > last_id + 1):
+            try:
+                fetched = await self.fetch_dicts_since(await self.fill_conn(), self.table_of(channel), last_id, before_id=first_id)
+            except psycopg.Error as e:
+                print(f"Failed to backfill {channel}: {e}")
+            else:
+                self.backfilled += len(fetched)
+                dicts = fetched + dicts
+        self.deliver_dicts(channel, dicts)
+
+    async def catch_up(self, channel: str, packed: bool, previous: asyncio.Task | None = None):
+        """delivers whatever went into a channel's table after the last id delivered from it, for after a lost connection"""
+        if previous is not None:
+            await previous
+        last_id = self.last_ids.get(channel)
+        if last_id is None:
+            return
+        try:
+            if packed:
+                rows = await self.fetch_since(await self.fill_conn(), self.table_of(channel), last_id)
+            else:
+                dicts = await self.fetch_dicts_since(await self.fill_conn(), self.table_of(channel), last_id)
+        except psycopg.Error as e:
+            print(f"Failed to catch up on {channel}: {e}")
+            return
+        if packed:
+            self.backfilled += len(rows)
+            self.deliver(channel, rows)
         else:
-            print("No channels to listen to.")
+            self.backfilled += len(dicts)
+            self.deliver_dicts(channel, dicts)
+
+    def table_of(self, channel: str) -> str:
+        return self.channel_tables.get(channel, channel)
+
+    async def connect(self) -> psycopg.AsyncConnection:
+        """a new autocommit connection to db_uri"""
+        return await psycopg.AsyncConnection.connect(conninfo=self.db_uri, autocommit=True)
+
+    async def fill_conn(self) -> psycopg.AsyncConnection:
+        """the connection backfills are fetched over, (re)made as needed"""
+        if (self._fill_conn is None) or self._fill_conn.closed:
+            self._fill_conn = await self.connect()
+        return self._fill_conn
+
+    async def notifications(self, channels: list[str], listening=None):
+        """yields (channel, payload) for every notification on the channels, all over one connection, listening() gets called once it's listening"""
+        aconn = await psycopg.AsyncConnection.connect(conninfo=self.db_uri, autocommit=True)
+        async with aconn:
+            for ch in channels:
+                await aconn.execute(f"LISTEN {ch}")
+            if listening is not None:
+                listening()
+            async for notify in aconn.notifies():
+                yield (notify.channel, notify.payload)
 
     async def do_listening(self, conn: psycopg.AsyncConnection, cur: psycopg.AsyncCursor):
         # register listeners
@@ -251,13 +799,14 @@ class DBTool(object):
                 if notify.channel == self.tbl_name:  # raw data channel
                     # data notification, non-verbose
                     if expecting != 0:
-                        command = f"SELECT * FROM {self.tbl_name} WHERE id >= %(expecting)s"
-                        data = {"expecting": expecting}
-                        await cur.execute(command, data)
-                        async for record in cur:
-                            self.outq.put_nowait(record)
-                            # print(record)
-                            expecting = record[0] + 1  # we expect one more than the last we got
+                        if notified_ids(notify.payload)[1] >= expecting:  # or an earlier fetch already got these rows
+                            command = f"SELECT * FROM {self.tbl_name} WHERE id >= %(expecting)s"
+                            data = {"expecting": expecting}
+                            await cur.execute(command, data)
+                            async for record in cur:
+                                self.outq.put_nowait(record)
+                                # print(record)
+                                expecting = record[0] + 1  # we expect one more than the last we got
                     else:
                         print(f"got unexpected data notification: {notify}")
                     if expecting > last_one:  # true when the block is complete
@@ -277,6 +826,17 @@ class DBTool(object):
                         last_one = float("inf")
                     elif len(vals) == 3:  # verbose stop event
                         last_one = vals[2]
+                        if (expecting != 0) and (expecting <= last_one):  # the end of the event hasn't been notified (maybe not yet, maybe never), get it now
+                            await cur.execute(f"SELECT * FROM {self.tbl_name} WHERE id >= %(expecting)s AND id <= %(last_one)s", {"expecting": expecting, "last_one": last_one})
+                            async for record in cur:
+                                self.outq.put_nowait(record)
+                                self.backfilled += 1
+                                expecting = record[0] + 1
+                            if expecting > last_one:  # the block is complete
+                                expecting = 0
+                                last_one = float("inf")
+                                await cur.execute(f"UNLISTEN {self.tbl_name}")
+                                await conn.commit()
 
 
 def mainb():
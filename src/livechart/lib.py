@@ -1,20 +1,292 @@
 import random
 import socket
+import os
+import glob
+import functools
 import threading
 import struct
 import time
+import asyncio
+import json
+import zlib
+import numpy as np
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+
+class Pacer(object):
+    """
+    absolute deadline schedule on the monotonic clock: sample k is due at start + k * period,
+    so time spent between waits (or oversleeping in one) doesn't add up into drift
+    """
+
+    max_lag = 0.1  # samples more than this many seconds late are skipped rather than caught up on
+
+    def __init__(self, period: float):
+        self.period = period
+        self.start = None
+        self.n = 0  # samples handed out
+        self.skipped = 0
+        self.last_wake = None
+
+    def _begin(self):
+        if self.start is None:
+            self.start = time.monotonic()
+            self.start_ns = time.time_ns()
+            self.last_wake = self.start
+
+    def due(self) -> int:
+        """how many samples are due now that haven't been taken yet"""
+        self._begin()
+        if self.period <= 0:
+            return 1
+        now = time.monotonic()
+        behind = int((now - self.max_lag - self.start) / self.period) + 1 - self.n
+        if behind > 0:
+            self.skipped += behind
+            self.n += behind
+        return max(int((now - self.start) / self.period) + 1 - self.n, 0)
+
+    def until(self, n: int = 1, tick: float = 0.0) -> float:
+        """seconds to wait until n samples are due and at least tick has passed since the last wake"""
+        self._begin()
+        deadline = max(self.start + (self.n + n - 1) * max(self.period, 0), self.last_wake + tick)
+        return deadline - time.monotonic()
+
+    def take(self, n: int) -> np.ndarray:
+        """hands out the next n samples, returns their scheduled wall clock times [ns] (or now, with no period to schedule by)"""
+        self._begin()
+        if self.period <= 0:
+            self.n += n
+            return np.full(n, time.time_ns(), dtype=np.int64)
+        ts = self.start_ns + np.round((self.n + np.arange(n)) * self.period * 1e9).astype(np.int64)
+        self.n += n
+        return ts
+
+    async def wait(self, n: int = 1, tick: float = 0.0) -> int:
+        """sleeps until n samples are due (and tick has passed since the last wake), returns how many are due"""
+        delay = self.until(n, tick)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.last_wake = time.monotonic()
+        return self.due()
+
+    def wait_sync(self, n: int = 1, tick: float = 0.0) -> int:
+        """wait() for threads"""
+        delay = self.until(n, tick)
+        if delay > 0:
+            time.sleep(delay)
+        self.last_wake = time.monotonic()
+        return self.due()
+
+    @property
+    def rate(self) -> float:
+        """samples per second we've actually handed out since starting"""
+        if self.start is None:
+            return 0.0
+        return self.n / max(time.monotonic() - self.start, 1e-9)
+
+
+def sensor_paths(sensor: str, root: str = "/sys") -> tuple[str, list[str]]:
+    """
+    where a temperature sensor's input is, and the files that name it
+    sensors are thermal<N> for class/thermal/thermal_zone<N>/temp and hwmon<N>/temp<M> for class/hwmon/hwmon<N>/temp<M>_input
+    """
+    if sensor.startswith("thermal"):
+        zone_dir = os.path.join(root, "class", "thermal", f"thermal_zone{sensor.removeprefix('thermal')}")
+        return os.path.join(zone_dir, "temp"), [os.path.join(zone_dir, "type")]
+    elif sensor.startswith("hwmon"):
+        chip, temp = sensor.split("/")
+        chip_dir = os.path.join(root, "class", "hwmon", chip)
+        return os.path.join(chip_dir, f"{temp}_input"), [os.path.join(chip_dir, "name"), os.path.join(chip_dir, f"{temp}_label")]
+    else:
+        raise ValueError(f"Unknown sensor: {sensor}")
+
+
+@functools.lru_cache(maxsize=None)
+def sensor_name(sensor: str, root: str = "/sys") -> str | None:
+    """what the kernel calls a temperature sensor (read once, they don't change), None if it won't say"""
+    words = []
+    for path in sensor_paths(sensor, root)[1]:
+        try:
+            with open(path, "r") as f:
+                words.append(f.read().strip())
+        except OSError:
+            pass
+    return " ".join(words) if words else None
+
+
+class ThermalSampler(object):
+    """
+    reads a bunch of temperature sensors at once, see sensor_paths() for how they're named
+    their fds stay open, and a read is one pread per sensor into a preallocated buffer that gets parsed for all of them together
+    """
+
+    width = 16  # bytes read per sensor, plenty for millidegrees C
+
+    def __init__(self, sensors: list[str] | None = None, root: str = "/sys"):
+        self.root = root
+        self.sensors = self.discover(root) if sensors is None else list(sensors)
+        self.names = {sensor: sensor_name(sensor, root) for sensor in self.sensors}
+        self.fds = []  # None for the sensors that couldn't be opened, they read as NaN
+        self.missing = []
+        for sensor in self.sensors:
+            try:
+                self.fds.append(os.open(sensor_paths(sensor, root)[0], os.O_RDONLY))
+            except OSError as e:
+                print(f"Can't open temperature sensor {sensor}: {e}")
+                self.fds.append(None)
+                self.missing.append(sensor)
+        self._buf = np.zeros((len(self.sensors), self.width), dtype=np.uint8)
+        self._rows = [memoryview(row) for row in self._buf]
+        self._lens = np.zeros(len(self.sensors), dtype=np.int64)
+        self._col = np.arange(self.width)
+        self._pow10 = 10 ** np.arange(self.width, dtype=np.int64)
+
+    @staticmethod
+    def discover(root: str = "/sys") -> list[str]:
+        """every temperature sensor there is"""
+        zones = []
+        for path in glob.glob(os.path.join(root, "class", "thermal", "thermal_zone*", "temp")):
+            zone = path.split(os.sep)[-2].removeprefix("thermal_zone")
+            zones.append((int(zone), f"thermal{zone}"))
+        inputs = []
+        for path in glob.glob(os.path.join(root, "class", "hwmon", "hwmon*", "temp*_input")):
+            chip, temp = path.split(os.sep)[-2:]
+            temp = temp.removesuffix("_input")
+            inputs.append(((int(chip.removeprefix("hwmon")), int(temp.removeprefix("temp"))), f"{chip}/{temp}"))
+        return [sensor for key, sensor in sorted(zones)] + [sensor for key, sensor in sorted(inputs)]
+
+    def close(self):
+        for fd in self.fds:
+            if fd is None:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.fds = []
+
+    def __enter__(self) -> "ThermalSampler":
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def read(self) -> np.ndarray:
+        """every sensor's temperature [degC] right now, NaN for the ones that didn't answer"""
+        for i, fd in enumerate(self.fds):
+            if fd is None:
+                self._lens[i] = 0
+                continue
+            try:
+                self._lens[i] = os.preadv(fd, [self._rows[i]], 0)
+            except OSError:  # some sensors give EIO/ENODATA while they're asleep
+                self._lens[i] = 0
+        return self._parse()
+
+    def _parse(self) -> np.ndarray:
+        """the buffer's rows of ASCII integers (millidegrees) --> degrees"""
+        buf = self._buf.astype(np.int64)
+        neg = buf[:, 0] == ord("-")
+        start = neg.astype(np.int64)[:, None]
+        digit = (buf >= ord("0")) & (buf <= ord("9")) & (self._col < self._lens[:, None]) & (self._col >= start)
+        run = np.cumprod(digit | (self._col < start), axis=1).astype(bool)  # the digits up to the newline
+        n_digits = run.sum(axis=1) - neg
+        power = np.clip(start + n_digits[:, None] - 1 - self._col, 0, self.width - 1)
+        vals = np.where(run & digit, (buf - ord("0")) * self._pow10[power], 0).sum(axis=1)
+        return np.where(n_digits > 0, np.where(neg, -vals, vals) / 1000, np.nan)
+
+
+class DataStream(object):
+    """
+    batches of samples at a requested rate, for async for:
+        async with DataStream("thermal", zone=2, rate=100) as stream:
+            async for ts, vals in stream:  # int64 timestamps [ns] and float64 values, everything that came due since the last batch
+    what Datagetter does, without its thread, its socketpair or its 32 bit floats
+    """
+
+    tick = 0.001  # batches come at most this often
+
+    def __init__(self, dtype: str = "random", zone: int | str = 1, rate: float = 1000.0, root: str = "/sys", in_executor: bool | None = None):
+        """
+        zone is a thermal zone number, or a sensor name like "hwmon1/temp1" (see sensor_paths())
+        in_executor is whether reads go to the default executor, None means only for hwmon sensors (some of those are on slow buses)
+        """
+        if dtype not in ("random", "thermal"):
+            raise ValueError(f"Unknown datatype: {dtype}")
+        self.dtype = dtype
+        self.sensor = f"thermal{zone}" if isinstance(zone, int) else zone
+        self.rate = rate
+        self.root = root
+        self.in_executor = self.sensor.startswith("hwmon") if in_executor is None else in_executor
+        self.sampler = None
+        self.pacer = None
+        self._reading = None  # the executor's read, which carries on even if whoever was waiting for it gets cancelled
+
+    async def __aenter__(self) -> "DataStream":
+        if self.dtype == "thermal":
+            self.sampler = ThermalSampler([self.sensor], root=self.root)
+        self._rng = np.random.default_rng()
+        self.pacer = Pacer(1 / self.rate if self.rate > 0 else 0)
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.pacer = None
+        if self._reading is not None:  # the sampler can't be closed out from under it
+            await asyncio.wait({self._reading})
+            self._reading = None
+        if self.sampler is not None:
+            self.sampler.close()
+            self.sampler = None
+
+    def __aiter__(self) -> "DataStream":
+        if self.pacer is None:
+            raise RuntimeError("Iterate over it inside its async with block")
+        return self
+
+    async def __anext__(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.pacer is None:  # it's been closed
+            raise StopAsyncIteration
+        due = await self.pacer.wait(1, self.tick)
+        if self.dtype == "random":
+            ts = self.pacer.take(due)
+            return ts, self._rng.uniform(0, 100, len(ts))
+        else:
+            self.pacer.take(due)
+            if self.in_executor:
+                self._reading = asyncio.get_running_loop().run_in_executor(None, self._read, due)
+                return await asyncio.shield(self._reading)
+            else:
+                return self._read(due)
+
+    def _read(self, n: int) -> tuple[np.ndarray, np.ndarray]:
+        """n thermal samples, each stamped with when it was read"""
+        ts = np.empty(n, dtype=np.int64)
+        vals = np.empty(n, dtype=np.float64)
+        for i in range(n):
+            vals[i] = self.sampler.read()[0]
+            ts[i] = time.time_ns()
+        return ts, vals
+
+    @property
+    def thermaltype(self) -> str:
+        if self.dtype == "thermal":
+            return sensor_name(self.sensor, self.root) or "Unknown"
+        else:
+            return "Random"
 
 
 class Datagetter(object):
     """
     gets one data point at a time
+    (DataStream is the async, batched way)
     """
 
     _dtype = None  # "random" or "thermal"
     _zone = None
     _entered = None
-    temp_file_name = None
-    temp_file_object = None
+    sampler = None
     _last_val = None
     delay = 0.001
 
@@ -23,13 +295,14 @@ class Datagetter(object):
         self.zone = zone
         self.dtype = dtype
         _last_val = None
+        self._pacer = Pacer(delay)
         self._stop_doer = threading.Event()
         self._want_new = threading.Event()
 
     def __enter__(self):
         self._entered = True
         if self._dtype == "thermal":
-            self.temp_file_object = open(self.temp_file_name, "r")
+            self.sampler = ThermalSampler([f"thermal{self._zone}"])
         self._socket, self.socket = socket.socketpair()
         # self._reader, self._writer = await asyncio.open_connection(sock=_socket)
         _last_val = None
@@ -48,10 +321,9 @@ class Datagetter(object):
         self._stop_doer.clear()
 
     def _close_thermal_file(self):
-        try:
-            self.temp_file_object.close()
-        except Exception as e:
-            pass
+        if self.sampler is not None:
+            self.sampler.close()
+            self.sampler = None
 
     def _close_sockets(self):
         try:
@@ -64,12 +336,9 @@ class Datagetter(object):
             pass
 
     def _update_thermal(self):
-        self.temp_file_name = f"/sys/class/thermal/thermal_zone{self._zone}/temp"
-        if hasattr(self.temp_file_object, "closed"):
-            if self.temp_file_object.closed == False:
-                self.temp_file_object.close()
+        self._close_thermal_file()
         if self._entered == True:
-            self.temp_file_object = open(self.temp_file_name, "r")
+            self.sampler = ThermalSampler([f"thermal{self._zone}"])
 
     def trigger_new(self):
         self._want_new.set()
@@ -110,28 +379,24 @@ class Datagetter(object):
     def get(self):
         if self._dtype == "thermal":
             try:
-                point_int = int(self.temp_file_object.readline())
-                self.temp_file_object.seek(0)
+                point = float(self.sampler.read()[0])
             except:
-                point_int = float("nan")
+                point = float("nan")
         elif self._dtype == "random":
-            point_int = random.randint(0, 100 * 1000)
+            point = random.randint(0, 100 * 1000) / 1000
         else:
-            point_int = float("nan")
+            point = float("nan")
         if self.delay > 0:
-            time.sleep(self.delay)  # insert fake delay to avoid too much cpu
-        return point_int / 1000
+            if self._pacer.period != self.delay:
+                self._pacer = Pacer(self.delay)
+            self._pacer.wait_sync()  # insert fake delay to avoid too much cpu, on a schedule so it doesn't drift
+            self._pacer.take(1)
+        return point
 
     @property
     def thermaltype(self):
         if self._dtype == "thermal":
-            try:
-                type_file = f"/sys/class/thermal/thermal_zone{self._zone}/type"
-                with open(type_file, "r") as fh:
-                    type_str = fh.readline()
-                result = type_str.strip()
-            except Exception as e:
-                result = "Unknown"
+            result = sensor_name(f"thermal{self._zone}") or "Unknown"
         elif self._dtype == "random":
             result = "Random"
         else:
@@ -168,3 +433,658 @@ class Downsampler(object):
             ret_val = float("nan")
 
         return ret_val
+
+
+# binary frame layout shared by the server and its clients:
+# magic, version, dtype code, flags, (pad), stream id, sequence number (index of the first sample), sample count
+FRAME_MAGIC = b"LC"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<2sBBBxHQI")
+TIER_DTYPE = np.dtype([("t", "<i8"), ("min", "<f8"), ("max", "<f8"), ("mean", "<f8")])  # one decimated bucket, t is its start [ns]
+
+
+def record_dtype(n_vals: int = 1) -> np.dtype:
+    """a sample record: source timestamp [ns since the epoch] and one (or n_vals) values"""
+    if n_vals == 1:
+        return np.dtype([("t", "<i8"), ("v", "<f8")])
+    else:
+        return np.dtype([("t", "<i8"), ("v", "<f8", (n_vals,))])
+
+
+RECORD_DTYPE = record_dtype()
+DB_RAW_DTYPE = np.dtype([("eid", "<i8"), ("v", "<f8"), ("i", "<f8"), ("t", "<f8"), ("s", "<i8")])  # a row of one of the database's raw data tables
+FRAME_DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f8"), 3: TIER_DTYPE, 4: DB_RAW_DTYPE}  # dtype code --> payload item type
+FRAME_DTYPES.update({0x10 + n: record_dtype(n) for n in range(1, 16)})
+CONTROL_CODE = 0x20  # control frames carry a UTF-8 JSON object as their payload, their seq pairs a reply with its request
+CONTROL_VERSION = 1  # of the control protocol that's spoken over control frames
+FRAME_DTYPES[CONTROL_CODE] = np.dtype("u1")
+NOTICE_CODE = 0x21  # notice frames carry one database notification, as a UTF-8 JSON object, their seq is its index
+FRAME_DTYPES[NOTICE_CODE] = np.dtype("S1")
+FRAME_CODES = {v: k for k, v in FRAME_DTYPES.items()}
+FLAG_GAP = 0x01  # header only: count samples starting at seq were lost to this client
+FLAG_DECIMATED = 0x02  # the payload is an evenly strided pick from the samples since seq
+FLAG_BACKLOG = 0x04  # the payload is recent history being sent to a newly subscribed client
+FLAG_DOORBELL = 0x08  # header only: samples [seq, seq+count) are ready in the stream's shared memory ring
+FLAG_COMPRESSED = 0x10  # the payload is a COMPRESSED_LEN byte count then that many bytes of zlib'd delta_pack output
+COMPRESSED_LEN = struct.Struct("<I")
+
+
+def pack_frame(seq: int, vals, dtype="<f4", stream: int = 0, flags: int = 0) -> bytes:
+    """packs a batch of values into one header + contiguous payload"""
+    payload = np.asarray(vals, dtype=dtype)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_CODES[payload.dtype], flags, stream, seq, len(payload))
+    return header + payload.tobytes()
+
+
+def unpack_frame_header(buf: bytes) -> tuple:
+    """returns (dtype, flags, stream, seq, count) from a frame header"""
+    magic, ver, code, flags, stream, seq, count = FRAME_HEADER.unpack(buf)
+    if (magic != FRAME_MAGIC) or (ver != FRAME_VERSION) or (code not in FRAME_DTYPES):
+        raise ValueError(f"Bad frame header: {buf!r}")
+    return (FRAME_DTYPES[code], flags, stream, seq, count)
+
+
+def pack_header(seq: int, count: int, dtype="<f4", stream: int = 0, flags: int = 0) -> bytes:
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_CODES[np.dtype(dtype)], flags, stream, seq, count)
+
+
+def pack_gap(seq: int, count: int, dtype="<f4", stream: int = 0) -> bytes:
+    """a header only frame telling the client that samples [seq, seq+count) won't be coming"""
+    return pack_header(seq, count, dtype=dtype, stream=stream, flags=FLAG_GAP)
+
+
+def _columns(dtype: np.dtype) -> list[tuple]:
+    """(field name or None, integer dtype with the field's width, per sample shape) for each field of a payload dtype"""
+    if dtype.names is None:
+        return [(None, np.dtype(f"<i{dtype.itemsize}"), ())]
+    columns = []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        columns.append((name, np.dtype(f"<i{field.base.itemsize}"), field.shape))
+    return columns
+
+
+def delta_pack(vals: np.ndarray) -> bytes:
+    """
+    lossless, compressor friendly layout for a batch of samples: each field on its own,
+    reinterpreted as integers, replaced by its differences from the sample before, then byte shuffled
+    (slowly changing values make long runs of zero high bytes)
+    """
+    parts = []
+    for name, int_dtype, shape in _columns(vals.dtype):
+        ints = np.ascontiguousarray(vals if name is None else vals[name]).view(int_dtype)
+        deltas = ints.copy()
+        deltas[1:] -= ints[:-1]  # wraps around, which is fine since unpacking wraps back
+        parts.append(deltas.view("u1").reshape(-1, int_dtype.itemsize).T.tobytes())
+    return b"".join(parts)
+
+
+def delta_unpack(buf: bytes, dtype, count: int) -> np.ndarray:
+    """undoes delta_pack"""
+    dtype = np.dtype(dtype)
+    vals = np.empty(count, dtype=dtype)
+    pos = 0
+    for name, int_dtype, shape in _columns(dtype):
+        n_bytes = count * int(np.prod(shape, dtype=int)) * int_dtype.itemsize
+        shuffled = np.frombuffer(buf, dtype="u1", count=n_bytes, offset=pos).reshape(int_dtype.itemsize, -1)
+        deltas = np.ascontiguousarray(shuffled.T).view(int_dtype).reshape((count,) + shape)
+        ints = np.cumsum(deltas, axis=0, dtype=int_dtype)
+        if name is None:
+            vals[:] = ints.view(dtype)
+        else:
+            vals[name] = ints.view(dtype.fields[name][0].base)
+        pos += n_bytes
+    return vals
+
+
+def pack_compressed_frame(seq: int, vals, dtype="<f4", stream: int = 0, flags: int = 0, level: int = 6) -> bytes:
+    """like pack_frame, but with the payload delta packed and zlib'd at the given level"""
+    payload = np.asarray(vals, dtype=dtype)
+    packed = zlib.compress(delta_pack(payload), level)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_CODES[payload.dtype], flags | FLAG_COMPRESSED, stream, seq, len(payload))
+    return header + COMPRESSED_LEN.pack(len(packed)) + packed
+
+
+def unpack_compressed(packed: bytes, header: tuple) -> np.ndarray:
+    """the samples in a compressed frame's payload (after its length)"""
+    return delta_unpack(zlib.decompress(packed), header[0], header[4])
+
+
+def pack_control(seq: int, msg: dict) -> bytes:
+    """a control frame holding msg"""
+    return pack_frame(seq, np.frombuffer(json.dumps(msg).encode(), dtype="u1"), dtype="u1")
+
+
+def is_control(header: tuple) -> bool:
+    return header[0] == FRAME_DTYPES[CONTROL_CODE]
+
+
+def unpack_control(vals: np.ndarray) -> dict:
+    """the message in a control frame's payload, raises ValueError if it isn't one"""
+    msg = json.loads(vals.tobytes())
+    if not isinstance(msg, dict):
+        raise ValueError(f"Control message is not an object: {msg!r}")
+    return msg
+
+
+def pack_notice(seq: int, msg: bytes, stream: int = 0) -> bytes:
+    """a notice frame holding some already JSON encoded msg"""
+    return pack_frame(seq, np.frombuffer(msg, dtype="S1"), dtype="S1", stream=stream)
+
+
+def is_notice(header: tuple) -> bool:
+    return header[0] == FRAME_DTYPES[NOTICE_CODE]
+
+
+def db_raw_dicts(vals: np.ndarray, channel: str) -> list[dict]:
+    """DB_RAW_DTYPE records as the dicts that the database's notifications decode to"""
+    return [{"eid": eid, "v": v, "i": i, "t": t, "s": s, "channel": channel} for eid, v, i, t, s in vals.tolist()]
+
+
+def payload_size(header: tuple) -> int:
+    """number of bytes following a frame header, for compressed frames that's just the COMPRESSED_LEN"""
+    if header[1] & (FLAG_GAP | FLAG_DOORBELL):
+        return 0
+    elif header[1] & FLAG_COMPRESSED:
+        return COMPRESSED_LEN.size
+    else:
+        return header[0].itemsize * header[4]
+
+
+class FrameParser(object):
+    """
+    for clients that get their bytes in arbitrary chunks: feed it whatever arrived and get back the complete frames
+    the values are numpy views straight onto the received bytes
+    """
+
+    def __init__(self):
+        self._buf = b""
+
+    def feed(self, data: bytes) -> list[tuple]:
+        """returns a list of (header, values), like read_frame gives"""
+        if self._buf:
+            buf = self._buf + data
+        else:
+            buf = bytes(data)
+        view = memoryview(buf)
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(FRAME_MAGIC, pos)
+            if start < 0:
+                pos = max(pos, len(buf) - len(FRAME_MAGIC) + 1)  # hang on to what could be the start of a magic
+                break
+            if len(buf) - start < FRAME_HEADER.size:
+                pos = start
+                break
+            try:
+                header = unpack_frame_header(view[start : start + FRAME_HEADER.size])
+            except ValueError:
+                pos = start + 1  # not really a frame, keep looking
+                continue
+            n_bytes = payload_size(header)
+            if len(buf) - (start + FRAME_HEADER.size) < n_bytes:
+                pos = start
+                break
+            pos = start + FRAME_HEADER.size
+            if header[1] & FLAG_COMPRESSED:
+                n_packed = COMPRESSED_LEN.unpack_from(view, pos)[0]
+                if len(buf) - (pos + n_bytes) < n_packed:
+                    pos = start
+                    break
+                pos += n_bytes
+                frames.append((header, unpack_compressed(view[pos : pos + n_packed], header)))
+                pos += n_packed
+                continue
+            frames.append((header, np.frombuffer(view[pos : pos + n_bytes], dtype=header[0])))
+            pos += n_bytes
+        self._buf = buf[pos:]
+        return frames
+
+
+async def read_frame(reader: asyncio.StreamReader, synced: bool = False) -> tuple:
+    """
+    reads one frame from the stream, skipping anything before the frame magic
+    (synced=True if the caller has already taken the magic off the stream)
+    returns (header, values) where header is what unpack_frame_header gives
+    gap and doorbell frames come back with an empty values array
+    """
+    if not synced:
+        await reader.readuntil(FRAME_MAGIC)
+    header = unpack_frame_header(FRAME_MAGIC + await reader.readexactly(FRAME_HEADER.size - len(FRAME_MAGIC)))
+    payload = await reader.readexactly(payload_size(header))
+    if header[1] & FLAG_COMPRESSED:
+        packed = await reader.readexactly(COMPRESSED_LEN.unpack(payload)[0])
+        return (header, unpack_compressed(packed, header))
+    return (header, np.frombuffer(payload, dtype=header[0]))
+
+
+SHM_HEAD = np.dtype([("head", "<u8"), ("writing", "<u8")])  # committed head, head once the write in progress is done
+
+
+def bisect_ring(buf: np.ndarray, start: int, stop: int, value, field: str | None = None) -> int:
+    """
+    the first absolute index in [start, stop) of a ring's array whose sample (or its field) is >= value, stop if there's none
+    a binary search on the array as it is, so nothing gets copied out of it
+    """
+    col = buf if field is None else buf[field]
+    capacity = len(buf)
+    while start < stop:
+        mid = (start + stop) // 2
+        if col[mid % capacity] < value:
+            start = mid + 1
+        else:
+            stop = mid
+    return start
+
+
+class RingBuffer(object):
+    """
+    fixed size, array backed ring buffer
+    samples are addressed by their absolute index: the number of samples written before them
+    with shared=True the array lives in shared memory (after a SHM_HEAD) so other
+    processes on this host can read it with a ShmRingReader
+    """
+
+    capacity = 2**16
+    head = 0  # absolute index of the next sample to be written
+    shm = None
+
+    def __init__(self, capacity=capacity, dtype="<f4", shared=False):
+        self.capacity = capacity
+        self.head = 0
+        if shared:
+            dtype = np.dtype(dtype)
+            self.shm = shared_memory.SharedMemory(create=True, size=SHM_HEAD.itemsize + capacity * dtype.itemsize)
+            self._shared_head = np.ndarray((), dtype=SHM_HEAD, buffer=self.shm.buf)
+            self._shared_head["head"] = self._shared_head["writing"] = 0
+            self.buf = np.ndarray((capacity,), dtype=dtype, buffer=self.shm.buf, offset=SHM_HEAD.itemsize)
+        else:
+            self.buf = np.zeros(capacity, dtype=dtype)
+
+    def close(self):
+        """releases the shared memory, if there is any"""
+        if self.shm is not None:
+            del self._shared_head
+            del self.buf
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    @property
+    def tail(self) -> int:
+        """absolute index of the oldest sample still held"""
+        return max(0, self.head - self.capacity)
+
+    def write(self, vals):
+        vals = np.asarray(vals, dtype=self.buf.dtype)
+        n = len(vals)
+        if n > self.capacity:  # only the newest capacity worth will survive anyway
+            self.head += n - self.capacity
+            vals = vals[-self.capacity :]
+            n = self.capacity
+        if self.shm is not None:
+            self._shared_head["writing"] = self.head + n  # readers of anything older than this - capacity must retry
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        self.buf[start : start + first] = vals[:first]
+        self.buf[: n - first] = vals[first:]
+        self.head += n
+        if self.shm is not None:
+            self._shared_head["head"] = self.head  # published last, so readers never see a head ahead of the data
+
+    def read(self, start: int, stop: int | None = None) -> np.ndarray:
+        """
+        returns samples [start, stop), clipped to what's still held
+        this is a view into the buffer when the range doesn't wrap, so use it before the next write
+        """
+        if stop is None:
+            stop = self.head
+        start = max(start, self.tail)
+        stop = min(stop, self.head)
+        if stop <= start:
+            return self.buf[:0]
+        i = start % self.capacity
+        j = i + (stop - start)
+        if j <= self.capacity:
+            return self.buf[i:j]
+        else:
+            return np.concatenate((self.buf[i:], self.buf[: j - self.capacity]))
+
+    def bisect(self, value, field: str | None = None) -> int:
+        """absolute index of the first held sample whose field (or the sample itself) is >= value, for sorted ones"""
+        return bisect_ring(self.buf, self.tail, self.head, value, field)
+
+
+class ShmRingReader(object):
+    """read only view of a RingBuffer that some other process made with shared=True"""
+
+    def __init__(self, name: str, capacity: int, dtype):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name)
+        try:  # python < 3.13 would otherwise unlink the writer's memory when we exit
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        except Exception as e:
+            pass
+        self._shared_head = np.ndarray((), dtype=SHM_HEAD, buffer=self.shm.buf)
+        self.buf = np.ndarray((capacity,), dtype=dtype, buffer=self.shm.buf, offset=SHM_HEAD.itemsize)
+
+    @property
+    def head(self) -> int:
+        return int(self._shared_head["head"])
+
+    @property
+    def tail(self) -> int:
+        return max(0, self.head - self.capacity)
+
+    def read(self, start: int, stop: int | None = None) -> np.ndarray | None:
+        """
+        returns a copy of samples [start, stop) (stop defaults to head)
+        or None if the writer has already reused some of that space
+        """
+        if stop is None:
+            stop = self.head
+        n = max(0, stop - start)
+        i = start % self.capacity
+        j = i + n
+        if j <= self.capacity:
+            vals = self.buf[i:j].copy()
+        else:
+            vals = np.concatenate((self.buf[i:], self.buf[: j - self.capacity]))
+        if int(self._shared_head["writing"]) - self.capacity > start:  # lapped while we were copying
+            return None
+        return vals
+
+    def bisect(self, value, field: str | None = None) -> int:
+        """RingBuffer.bisect(), moved up to what's still held if the writer lapped the search"""
+        return max(bisect_ring(self.buf, self.tail, self.head, value, field), self.tail)
+
+    def close(self):
+        del self._shared_head
+        del self.buf
+        self.shm.close()
+
+
+class Decimator(object):
+    """
+    reduces a sample stream to min, max and mean over fixed length time buckets
+    a bucket is only given out once a sample from a later bucket shows up
+    """
+
+    period = 1.0  # bucket length in seconds
+    _pending = None  # (bucket number, min, max, sum, count) of the bucket still filling up
+
+    def __init__(self, period=period):
+        self.period = period
+        self._period_ns = round(period * 1e9)
+        self._pending = None
+
+    def feed(self, ts, vals) -> np.ndarray:
+        """takes sample times [ns] and values, returns an array of finished TIER_DTYPE buckets"""
+        vals = np.asarray(vals, dtype=np.float64)
+        if len(vals) == 0:
+            return np.empty(0, dtype=TIER_DTYPE)
+        buckets = np.asarray(ts, dtype=np.int64) // self._period_ns
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ids = buckets[starts]
+        mins = np.minimum.reduceat(vals, starts)
+        maxs = np.maximum.reduceat(vals, starts)
+        sums = np.add.reduceat(vals, starts)
+        counts = np.diff(np.append(starts, len(vals)))
+
+        done = []
+        if self._pending is not None:
+            pid, pmin, pmax, psum, pcount = self._pending
+            if pid == ids[0]:  # the batch continues the pending bucket
+                mins[0] = min(mins[0], pmin)
+                maxs[0] = max(maxs[0], pmax)
+                sums[0] += psum
+                counts[0] += pcount
+            else:
+                done.append((pid * self._period_ns, pmin, pmax, psum / pcount))
+        self._pending = (ids[-1], mins[-1], maxs[-1], sums[-1], counts[-1])
+
+        out = np.empty(len(done) + len(ids) - 1, dtype=TIER_DTYPE)
+        if done:
+            out[0] = done[0]
+        out["t"][len(done) :] = ids[:-1] * self._period_ns
+        out["min"][len(done) :] = mins[:-1]
+        out["max"][len(done) :] = maxs[:-1]
+        out["mean"][len(done) :] = sums[:-1] / counts[:-1]
+        return out
+
+
+# delta-of-delta timestamp buckets for the Gorilla codec: (control bits, number of control bits, value bits)
+# (wider than the paper's since our timestamps are in ns)
+GORILLA_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 20), (0b1110, 4, 32), (0b1111, 4, 64))
+
+
+def _bit_length(x: np.ndarray) -> np.ndarray:
+    """number of bits needed for each element of a uint64 array (0 for 0)"""
+    x = x.copy()
+    n = np.zeros(x.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= (np.uint64(1) << np.uint64(shift))
+        n[big] += shift
+        x[big] >>= np.uint64(shift)
+    return n + (x > 0)
+
+
+def _pack_bits(fields: np.ndarray, widths: np.ndarray) -> bytes:
+    """
+    fields and widths are (samples, fields per sample) arrays, each field being the low widths bits of its uint64
+    returns the fields' bits, most significant first, one after another, padded out to a whole byte
+    """
+    keep = widths > 0
+    fields = fields[keep]
+    widths = widths[keep].astype(np.uint64)
+    ends = np.cumsum(widths)
+    n_bits = int(ends[-1]) if len(ends) else 0
+    starts = ends - widths
+    words = np.zeros(n_bits // 64 + 1, dtype=np.uint64)
+    word = starts // np.uint64(64)
+    offset = starts % np.uint64(64)  # from the word's most significant bit
+    aligned = fields << (np.uint64(64) - widths)  # the field's top bit at the top of a uint64
+    np.bitwise_or.at(words, word, aligned >> offset)
+    spills = (offset + widths) > 64  # the rest goes into the next word
+    np.bitwise_or.at(words, word[spills] + np.uint64(1), aligned[spills] << (np.uint64(64) - offset[spills]))
+    return words.astype(">u8").tobytes()[: (n_bits + 7) // 8]
+
+
+class GorillaEncoder(object):
+    """
+    streaming encoder for (timestamp [ns], float64 value) samples, after Facebook's Gorilla:
+    timestamps become their delta of deltas, put in the smallest of GORILLA_DOD_BUCKETS that fits,
+    values get XORed with the one before and only their meaningful bits kept,
+    so a steady clock and a slowly varying value cost a couple of bits a sample
+    every encode() returns a whole number of bytes, the state carries on into the next call
+    """
+
+    def __init__(self):
+        self._n = 0  # samples encoded so far
+        self._t = 0
+        self._delta = 0
+        self._v = np.uint64(0)
+        self._lz = -1  # leading zeros of the current XOR window, -1 for no window yet
+        self._tz = 0
+
+    def encode(self, ts, vals) -> bytes:
+        """encodes a batch of timestamps and values, decode with GorillaDecoder.decode(the bytes, len(ts))"""
+        ts = np.asarray(ts, dtype=np.int64)
+        bits = np.ascontiguousarray(vals, dtype=np.float64).view(np.uint64)
+        n = len(ts)
+        if n == 0:
+            return b""
+        fields = np.zeros((n, 6), dtype=np.uint64)  # dod control, dod, xor control, leading zeros, meaningful length, meaningful bits
+        widths = np.zeros((n, 6), dtype=np.int64)
+
+        first = self._n == 0  # then sample 0 gets written whole, further down
+        # timestamps
+        deltas = np.diff(ts, prepend=ts[0] if first else self._t)
+        dods = np.diff(deltas, prepend=self._delta)
+        widths[:, 0] = 1  # a lone 0 bit for a dod of 0
+        unplaced = dods != 0
+        for control, n_control, n_bits in GORILLA_DOD_BUCKETS:
+            if n_bits < 64:
+                fits = unplaced & (dods >= -(1 << (n_bits - 1))) & (dods < (1 << (n_bits - 1)))
+            else:
+                fits = unplaced
+            fields[fits, 0] = control
+            widths[fits, 0] = n_control
+            fields[fits, 1] = dods[fits].astype(np.uint64) & np.uint64((1 << n_bits) - 1)
+            widths[fits, 1] = n_bits
+            unplaced &= ~fits
+
+        # values
+        xors = bits ^ np.concatenate(([bits[0] if first else self._v], bits[:-1]))
+        lzs = 64 - _bit_length(xors)
+        tzs = _bit_length(xors & (~xors + np.uint64(1))) - 1
+        widths[:, 2] = 1  # a lone 0 bit for an unchanged value
+        for i in np.flatnonzero(xors).tolist():  # only whether to reuse the window depends on the samples before
+            lz = min(int(lzs[i]), 31)
+            tz = int(tzs[i])
+            if (self._lz >= 0) and (lz >= self._lz) and (tz >= self._tz):  # fits in the current window
+                fields[i, 2] = 0b10
+                widths[i, 2] = 2
+                fields[i, 5] = xors[i] >> np.uint64(self._tz)
+                widths[i, 5] = 64 - self._lz - self._tz
+            else:  # a new window
+                self._lz = lz
+                self._tz = tz
+                fields[i, 2] = 0b11
+                widths[i, 2] = 2
+                fields[i, 3] = lz
+                widths[i, 3] = 5
+                fields[i, 4] = (64 - lz - tz) & 63  # 64 goes as 0
+                widths[i, 4] = 6
+                fields[i, 5] = xors[i] >> np.uint64(tz)
+                widths[i, 5] = 64 - lz - tz
+
+        if first:  # the very first sample goes in whole
+            fields[0] = (ts[:1].view(np.uint64)[0], 0, bits[0], 0, 0, 0)
+            widths[0] = (64, 0, 64, 0, 0, 0)
+        self._n += n
+        self._t = int(ts[-1])
+        self._delta = int(deltas[-1])
+        self._v = bits[-1]
+        return _pack_bits(fields, widths)
+
+
+class GorillaDecoder(object):
+    """undoes GorillaEncoder, feed it the encoder's batches in the order they were made"""
+
+    def __init__(self):
+        self._n = 0
+        self._t = 0
+        self._delta = 0
+        self._v = 0
+        self._lz = 0
+        self._tz = 0
+
+    def decode(self, buf: bytes, count: int) -> tuple[np.ndarray, np.ndarray]:
+        """returns (timestamps, values) for the count samples in an encoded batch"""
+        data = bytes(buf) + b"\0" * 9  # so reads near the end don't run short
+        pos = 0
+
+        def read(n_bits: int) -> int:
+            nonlocal pos
+            start = pos >> 3
+            stop = (pos + n_bits + 7) >> 3
+            chunk = int.from_bytes(data[start:stop], "big")
+            pos += n_bits
+            return (chunk >> ((stop << 3) - pos)) & ((1 << n_bits) - 1)
+
+        ts = np.empty(count, dtype=np.int64)
+        vs = np.empty(count, dtype=np.uint64)
+        t, delta, v, lz, tz = self._t, self._delta, self._v, self._lz, self._tz
+        for i in range(count):
+            if self._n == 0:
+                t = read(64)
+                t -= (t >> 63) << 64  # back to signed
+                v = read(64)
+                self._n = 1
+            else:
+                if read(1):  # the bucket's control bits are a 1 for each bucket it's past, then a 0 (except for the last)
+                    bucket = 0
+                    while (bucket < len(GORILLA_DOD_BUCKETS) - 1) and read(1):
+                        bucket += 1
+                    n_bits = GORILLA_DOD_BUCKETS[bucket][2]
+                    dod = read(n_bits)
+                    if dod >= 1 << (n_bits - 1):
+                        dod -= 1 << n_bits
+                    delta = ((delta + dod + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)  # int64 wraparound, like the encoder's
+                t = ((t + delta + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+                if read(1):
+                    if read(1):  # a new window
+                        lz = read(5)
+                        length = read(6) or 64
+                        tz = 64 - lz - length
+                    v ^= read(64 - lz - tz) << tz
+            ts[i] = t
+            vs[i] = v
+        self._t, self._delta, self._v, self._lz, self._tz = t, delta, v, lz, tz
+        self._n += count
+        return (ts, vs.view(np.float64))
+
+
+class RateMeter(object):
+    """a running total, and its rate over the last window seconds (kept in 1 s bins)"""
+
+    total = 0
+
+    def __init__(self, window: int = 10):
+        self.total = 0
+        self._bins = [0] * window
+        self._t0 = time.monotonic()
+        self._second = int(self._t0)  # the second the newest bin is for
+
+    def _roll(self, now: float):
+        second = int(now)
+        for i in range(min(second - self._second, len(self._bins))):  # clear the bins we've skipped over
+            self._bins[(self._second + i + 1) % len(self._bins)] = 0
+        self._second = max(second, self._second)
+
+    def add(self, n: int = 1):
+        self._roll(time.monotonic())
+        self.total += n
+        self._bins[self._second % len(self._bins)] += n
+
+    @property
+    def rate(self) -> float:
+        """per second"""
+        now = time.monotonic()
+        self._roll(now)
+        span = min(len(self._bins) - 1 + (now - int(now)), now - self._t0)
+        return sum(self._bins) / span if span > 0 else 0.0
+
+
+class Histogram(object):
+    """counts of non-negative values in power of two buckets, bucket i counting those < 2**i (and >= 2**(i-1))"""
+
+    def __init__(self, n_buckets: int = 32):
+        self.counts = [0] * n_buckets
+        self.n = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value: int):
+        value = max(0, int(value))
+        self.counts[min(value.bit_length(), len(self.counts) - 1)] += 1
+        self.n += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> int:
+        """an upper bound on the q quantile: the top of the bucket it falls in"""
+        if self.n == 0:
+            return 0
+        rank = q * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(2**i - 1, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {"count": self.n, "mean": self.sum / self.n if self.n else 0, "max": self.max, "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99), "buckets": {2**i: count for i, count in enumerate(self.counts) if count}}
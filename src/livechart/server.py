@@ -3,14 +3,50 @@
 import asyncio
 import time
 import json
-import struct
-import random
+import glob
+import os
+import socket
+import multiprocessing
+import math
+import collections
+import threading
+import datetime as dt
+import numpy as np
 import psycopg
 from enum import Enum, auto
 
-from numpy import dtype
-
 from .db import DBTool
+from .db import RandomSource
+from .db import ThermalSource
+from .lib import pack_frame
+from .lib import pack_gap
+from .lib import RingBuffer
+from .lib import FLAG_DECIMATED
+from .lib import FLAG_GAP
+from .lib import FLAG_BACKLOG
+from .lib import Decimator
+from .lib import TIER_DTYPE
+from .lib import RECORD_DTYPE
+from .lib import FRAME_CODES
+from .lib import FLAG_DOORBELL
+from .lib import pack_header
+from .lib import read_frame
+from .lib import ShmRingReader
+from .lib import FRAME_DTYPES
+from .lib import FRAME_MAGIC
+from .lib import CONTROL_VERSION
+from .lib import pack_control
+from .lib import unpack_control
+from .lib import is_control
+from .lib import pack_compressed_frame
+from .lib import RateMeter
+from .lib import Histogram
+from .lib import DB_RAW_DTYPE
+from .lib import NOTICE_CODE
+from .lib import pack_notice
+from .lib import Pacer
+from .lib import ThermalSampler
+from .lib import sensor_name
 
 
 # import struct
@@ -18,34 +54,345 @@ class DType(Enum):
     RANDOM = auto()
     THERMAL = auto()
     DB = auto()
+    RELAY = auto()
+
+
+class Policy(Enum):
+    """what to do with a client that can't keep up"""
+
+    DROP_OLDEST = "drop-oldest"  # skip ahead so that it's never more than max_lag behind
+    DECIMATE = "decimate"  # send an evenly strided pick of no more than max_lag samples
+    DISCONNECT = "disconnect"  # hang up if it's been more than max_lag behind for max_behind seconds
+
+
+class Source(object):
+    """one named data stream, produced once and fanned out to only its subscribers"""
+
+    name = ""
+    sid = 0  # goes in the stream field of this source's frames
+    rings = None  # tier name --> RingBuffer
+    decimators = None  # tier name --> Decimator
+    subscribers = None
+    compressed = None  # (tier, seq, count, level) --> compressed frame, shared by every client that wants that batch
+    samples_in = None  # RateMeter of raw samples put
+    max_compressed = 64  # batches to remember
+    arrivals = None  # RingBuffer of when each raw sample got here [ns], kept in step with the raw ring when its samples have no "t" in ns
+    max_untimed_backlog = 1024  # backlog cap for a history_seconds limit on samples we can't tell the age of
+    backfilled = 0  # samples that came in to fill a gap in the database's notifications (db: sources)
+    gaps = None  # [start, stop) ranges of the raw ring that put_gap left holes in, oldest first
+
+    def __init__(self, name: str, sid: int, ring_size: int, tiers: dict, shared: bool = False, dtype=RECORD_DTYPE):
+        """dtype is what the raw tier holds, the others (which only RECORD_DTYPE sources can have) hold TIER_DTYPE buckets"""
+        self.name = name
+        self.sid = sid
+        self.rings = {}
+        self.decimators = {}
+        self.compressed = {}
+        self.samples_in = RateMeter()
+        for tier, period in tiers.items():
+            if period is None:
+                self.rings[tier] = RingBuffer(ring_size, dtype=dtype, shared=shared)
+            else:
+                self.rings[tier] = RingBuffer(ring_size, dtype=TIER_DTYPE, shared=shared)
+                self.decimators[tier] = Decimator(period)
+        if (dtype != RECORD_DTYPE) and ("raw" in self.rings):
+            self.arrivals = RingBuffer(ring_size, dtype=np.int64)
+        self.subscribers = set()
+        self.gaps = collections.deque()
+
+    @classmethod
+    def attach(cls, name: str, sid: int, layout: dict) -> "Source":
+        """a read only Source whose rings are another process's shared memory, layout is {tier: (shm name, capacity, dtype code)}"""
+        source = cls(name, sid, 0, {})
+        for tier, (shm_name, capacity, code) in layout.items():
+            source.rings[tier] = ShmRingReader(shm_name, capacity, FRAME_DTYPES[code])
+        return source
+
+    def compressed_frame(self, tier: str, seq: int, vals: np.ndarray, level: int) -> bytes:
+        """a compressed frame of the tier's samples [seq, seq+len(vals)), compressed only the first time it's asked for"""
+        key = (tier, seq, len(vals), level)
+        if key not in self.compressed:
+            if len(self.compressed) >= self.max_compressed:
+                self.compressed.clear()
+            self.compressed[key] = pack_compressed_frame(seq, vals, dtype=vals.dtype, stream=self.sid, level=level)
+        return self.compressed[key]
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        if self.arrivals is not None:
+            self.arrivals.close()
+
+    def put(self, vals, ts):
+        """puts values (with their source timestamps [ns]) into the rings and wakes up the subscribers"""
+        records = np.empty(len(vals), dtype=RECORD_DTYPE)
+        records["t"] = ts
+        records["v"] = vals
+        self.put_records(records)
+
+    def put_records(self, records: np.ndarray):
+        """puts an array of RECORD_DTYPE into the rings and wakes up the subscribers"""
+        self.samples_in.add(len(records))
+        if self.arrivals is not None:
+            self.arrivals.write(np.full(len(records), time.time_ns(), dtype=np.int64))
+        for tier, ring in self.rings.items():
+            if tier in self.decimators:  # decimated once here, no matter how many clients want it
+                buckets = self.decimators[tier].feed(records["t"], records["v"])
+                if len(buckets) > 0:
+                    ring.write(buckets)
+            else:
+                ring.write(records)
+        for client in self.subscribers:
+            client.wake.set()
+
+    def put_gap(self, count: int):
+        """
+        leaves a hole of count samples in the raw ring, for subscribers to be sent as a gap instead of data
+        the hole is filled with NaNs at the last timestamp so the ring's "t" stays sorted, the other tiers just go without
+        """
+        ring = self.rings["raw"]
+        count = min(count, ring.capacity)
+        if count <= 0:
+            return
+        filler = np.zeros(count, dtype=ring.buf.dtype)
+        last = ring.read(ring.head - 1)
+        if len(last) > 0:
+            filler["t"] = last["t"][-1]
+        filler["v"] = np.nan
+        self.gaps.append((ring.head, ring.head + count))
+        ring.write(filler)
+        while self.gaps and (self.gaps[0][1] <= ring.tail):
+            self.gaps.popleft()
+        for client in self.subscribers:
+            client.wake.set()
+
+    def segments(self, tier: str, start: int, stop: int) -> list[tuple[int, int, bool]]:
+        """splits [start, stop) of a tier's ring into (start, stop, is_hole) runs around the holes put_gap left"""
+        runs = []
+        if self.gaps and (self.ring(tier) is self.rings.get("raw")):
+            for gap_start, gap_stop in self.gaps:
+                if (gap_stop <= start) or (gap_start >= stop):
+                    continue
+                if gap_start > start:
+                    runs.append((start, gap_start, False))
+                runs.append((max(start, gap_start), min(stop, gap_stop), True))
+                start = min(stop, gap_stop)
+        if start < stop:
+            runs.append((start, stop, False))
+        return runs
+
+    def ring(self, tier: str) -> RingBuffer:
+        """the ring for a tier, sources that don't have the tier always give their raw one"""
+        return self.rings.get(tier, self.rings["raw"])
+
+    def backlog_start(self, tier: str, samples: int | None = None, seconds: float | None = None) -> int:
+        """the ring index that the last samples (or seconds worth) of a tier's history starts at"""
+        ring = self.ring(tier)
+        start = ring.tail
+        if samples is not None:
+            start = max(start, ring.head - samples)
+        if seconds is not None:
+            if tier in self.decimators:
+                start = max(start, ring.head - math.ceil(seconds / self.decimators[tier].period))
+            else:
+                if ring.buf.dtype == RECORD_DTYPE:
+                    timed, field = ring, "t"
+                elif self.arrivals is not None:  # other things don't have timestamps we can use, so go by when they got here
+                    timed, field = self.arrivals, None
+                else:
+                    timed = None
+                    start = max(start, ring.head - self.max_untimed_backlog)
+                if timed is not None:
+                    newest = timed.read(timed.head - 1)
+                    if newest is None:  # a writer in another process lapped us, there's nothing older than its tail now
+                        start = max(start, timed.tail)
+                    elif len(newest) > 0:
+                        newest = newest[0] if field is None else newest[field][0]
+                        start = max(start, timed.bisect(newest - round(seconds * 1e9), field))
+        return start
+
+
+class Client(object):
+    """per-connection state"""
+
+    framed = False  # True once the client has asked for batched binary frames
+    shm = False  # True if the client reads the data out of shared memory and only wants doorbells from us
+    tier = "raw"  # which rate tier this client is subscribed to
+    cursors = None  # source name --> absolute index into that source's tier ring of the next sample to go out
+    wake = None  # set when one of the subscribed sources has new data
+    policy = Policy.DROP_OLDEST
+    max_lag = 2**16  # samples
+    max_behind = 5.0  # seconds
+    history_samples = None
+    history_seconds = None
+    behind_since = None  # loop time from when we first saw this client lagging
+    shed = 0  # number of samples this client never got
+    control = False  # speaks the binary control protocol
+    compression = None  # zlib level for this client's frames, None to send them uncompressed
+    done = False  # set when we've stopped listening to this client
+    caps = frozenset()  # capabilities agreed on in the control protocol handshake
+    name = ""  # who it is, for the metrics
+    samples_out = None  # RateMeter of samples sent
+    bytes_out = None  # RateMeter of bytes sent
+    latency = None  # Histogram of source timestamp to send time [us] of the newest sample in each batch
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, policy=policy, max_lag=max_lag, max_behind=max_behind, history_samples=history_samples, history_seconds=history_seconds, name=name):
+        self.reader = reader
+        self.writer = writer
+        self.name = name
+        self.samples_out = RateMeter()
+        self.bytes_out = RateMeter()
+        self.latency = Histogram()
+        self.connected = time.time()
+        self.cursors = {}
+        self.wake = asyncio.Event()
+        self.policy = policy
+        self.max_lag = max_lag
+        self.max_behind = max_behind
+        self.history_samples = history_samples
+        self.history_seconds = history_seconds
+
+    def send(self, data: bytes):
+        self.writer.write(data)
+        self.bytes_out.add(len(data))
+
+    def sent(self, vals: np.ndarray):
+        """counts a batch of samples that went out"""
+        self.samples_out.add(len(vals))
+        if (len(vals) > 0) and (vals.dtype.fields.get("t", (None,))[0] == np.int64):  # has ns timestamps
+            self.latency.add((time.time_ns() - int(vals["t"][-1])) // 1000)
 
 
 class LiveServer(object):
     host = "0.0.0.0"
     default_port = 58741
     srv = None
-    clients = {}
+    clients = None
     t0 = None
     dtype = DType.RANDOM
     zone_num = 0
-    live_clients = asyncio.Event()  # set when there is at least one connected client
+    live_clients = None  # set when there is at least one connected client
     delay = 0.001
+    ring_size = 2**16  # samples held (per source and tier) for the clients to read from
+    tiers = {"raw": None, "100Hz": 0.01, "10Hz": 0.1, "1Hz": 1.0}  # tier name --> decimation bucket length
+    caps = frozenset({"batch", "compression", "tier", "subscriptions"})  # what control protocol clients can ask for
+    cmd_caps = {"tier": "tier", "subscribe": "subscriptions", "unsubscribe": "subscriptions", "zone": "subscriptions", "compression": "compression"}  # command --> capability it needs
+    cmd_types = {"history_samples": (int, type(None)), "history_seconds": (int, float, type(None)), "policy": str, "tier": str, "compression": (int, type(None)), "max_lag": int, "max_behind": (int, float), "unsubscribe": list, "subscribe": list, "zone": (int, str), "resume": dict, "epoch": str}  # command --> the JSON types its value may have
+    compression_level = 6  # zlib level for clients that ask for compression without saying how much
+    sources = None  # source name --> Source
+    policy = Policy.DROP_OLDEST  # default backpressure policy for new clients
+    max_lag = None  # default for how far behind (in samples) a client may get before its policy kicks in, None for ring_size
+    max_behind = 5.0  # default seconds a client may lag before a DISCONNECT policy hangs up on it
+    history_samples = None  # how many of the most recent samples newly subscribed clients get
+    history_seconds = 60.0  # how many seconds of the most recent samples newly subscribed clients get
+    unix_path = None  # also listen on a unix domain socket here
+    usrv = None
+    shared = False  # keep the rings in shared memory so local clients can read them directly
+    workers = 0  # number of processes to hand client handling off to, 0 to do it all here
+    reuse_port = False  # listen with SO_REUSEPORT so that other processes can share the port
+    db_uri = None  # of the database the notify: sources LISTEN to
+    db_ingest = None  # how db: sources get their rows, None follows the table's _events (see DBTool.do_listening), else a DBTool.ingest strategy
+    notice_ring_size = 2**10  # notifications held per notify: source that isn't a raw data one
+    metrics_host = "127.0.0.1"
+    metrics_port = None  # serve the metrics over HTTP on this port
+    msrv = None
+    epoch = None  # this server's id, ring seqs only mean something to clients that got them from the same one
+    _port_holder = None  # keeps the port picked for the workers ours until they've bound it
+    worker_start_timeout = 30.0  # seconds to wait for a worker to come up before letting go of the port anyway
+
+    def __init__(self, host=host, port=default_port, data_type=dtype, thermal_zone=zone_num, upstream=None, artificial_delay=delay, ring_size=ring_size, policy=policy, max_lag=max_lag, max_behind=max_behind, sources=None, history_samples=history_samples, history_seconds=history_seconds, unix_path=unix_path, shared=shared, workers=workers, reuse_port=reuse_port, metrics_port=metrics_port, db_uri=db_uri, db_ingest=db_ingest, epoch=epoch):
+        """
+        sources is a list of source names to run, each one of:
+          "random", "thermal<N>" (or "thermal*" for every zone there is), "db:<table name>"
+          or "relay:<host>:<port>[/<name>]" to re-serve (the named) source of another LiveServer
+          or "notify:<channel>" to proxy the notifications on a channel of the database at db_uri
+          (all of these share one LISTEN connection, channels with "raw" in their names are sent as DB_RAW_DTYPE frames,
+          the rest as notice frames)
+        if it's None, the single source given by data_type (and thermal_zone or upstream="<host>:<port>") gets run
+        new clients are subscribed to the first source until they ask for something else
+
+        framed clients get up to history_samples or history_seconds (whichever is less, None for no limit)
+        of what's still in the ring as a backlog frame when they subscribe to something
+
+        with shared=True, clients on this host (probably connected via unix_path) can ask for
+        the data to be left in shared memory for them, then they only get doorbell frames
+
+        workers > 0 means the sources get sampled in this process (see serve_workers) and written into
+        shared memory rings, while that many worker processes all accept clients on the same port
 
-    def __init__(self, host=host, port=default_port, data_type=dtype, thermal_zone=zone_num, artificial_delay=delay):
+        metrics_port is where to serve the metrics (text at /metrics or anywhere else, JSON at /json) on metrics_host
+
+        epoch is told to clients (in hello and subscription replies) and has to come back with a resume, None makes up a new one
+        """
         self.host = host
         self.port = port
         self.dtype = data_type
         self.zone_num = thermal_zone
         self.delay = artificial_delay
+        self.ring_size = ring_size
+        self.policy = Policy(policy)
+        if max_lag is None:
+            self.max_lag = ring_size
+        else:
+            self.max_lag = min(max_lag, ring_size)
+        self.max_behind = max_behind
+        self.clients = {}
+        self.live_clients = asyncio.Event()
+        self.history_samples = history_samples
+        self.history_seconds = history_seconds
+        self.unix_path = unix_path
+        self.workers = workers
+        self.shared = shared or (workers > 0)
+        self.reuse_port = reuse_port
+        self.metrics_port = metrics_port
+        self.db_uri = db_uri
+        self.db_ingest = db_ingest
+        self.epoch = epoch if epoch is not None else os.urandom(8).hex()
+        if sources is None:
+            if self.dtype == DType.THERMAL:
+                sources = [f"thermal{self.zone_num}"]
+            elif self.dtype == DType.DB:
+                sources = [f"db:{DBTool.tbl_name}"]
+            elif self.dtype == DType.RELAY:
+                sources = [f"relay:{upstream}"]
+            else:
+                sources = ["random"]
+        self.sources = {}
+        for name in sources:
+            if name == "thermal*":
+                names = [f"thermal{zone}" for zone in self.thermal_zones()]
+            else:
+                names = [name]
+            for name in names:
+                if not name.startswith("notify:"):
+                    self.sources[name] = Source(name, len(self.sources), ring_size, self.tiers, shared=self.shared)
+                elif "raw" in name:  # a raw data table's rows
+                    self.sources[name] = Source(name, len(self.sources), ring_size, {"raw": None}, shared=self.shared, dtype=DB_RAW_DTYPE)
+                else:  # event, run, etc. rows go out as the notifications they came as
+                    self.sources[name] = Source(name, len(self.sources), self.notice_ring_size, {"raw": None}, dtype=object)
         # self.srv = await asyncio.start_server(self.client_connected_cb, host=host, port=port, reuse_address=True)
         # self.srv = socketserver.TCPServer(server_address, socketserver.StreamRequestHandler, bind_and_activate=False)
         # self.srv.timeout = None  # never time out
         # self.srv.allow_reuse_address = True
         self.t0 = time.time()
 
+    @staticmethod
+    def thermal_zones() -> list[int]:
+        """the numbers of the thermal zones this system has"""
+        paths = glob.glob("/sys/class/thermal/thermal_zone*")
+        return sorted(int(path.removeprefix("/sys/class/thermal/thermal_zone")) for path in paths)
+
     async def __aenter__(self):
-        self.srv = await asyncio.start_server(self.client_connected_cb, host=self.host, port=self.port, reuse_address=True)
+        self.srv = await asyncio.start_server(self.client_connected_cb, host=self.host, port=self.port, reuse_address=True, reuse_port=self.reuse_port)
+        self.port = self.srv.sockets[0].getsockname()[1]  # in case we were given port 0
         print(f"Listening for clients on {(self.host, self.port)}")
+        if self.unix_path is not None:
+            self.usrv = await asyncio.start_unix_server(self.client_connected_cb, path=self.unix_path)
+            print(f"Listening for local clients on {self.unix_path}")
+        if self.metrics_port is not None:
+            self.msrv = await asyncio.start_server(self.metrics_connected_cb, host=self.metrics_host, port=self.metrics_port, reuse_address=True)
+            self.metrics_port = self.msrv.sockets[0].getsockname()[1]
+            print(f"Serving metrics on {(self.metrics_host, self.metrics_port)}")
         # self.srv.server_bind()
         # self.srv.server_activate()
         # self.sel.register(self.srv.socket, selectors.EVENT_READ, self.accept)
@@ -54,19 +401,67 @@ class LiveServer(object):
     async def __aexit__(self, exc_type, exc_value, traceback):
         self.srv.close()
         await self.srv.wait_closed()
+        if self.msrv is not None:
+            self.msrv.close()
+            await self.msrv.wait_closed()
+        if self.usrv is not None:
+            self.usrv.close()
+            await self.usrv.wait_closed()
+            try:
+                os.unlink(self.unix_path)
+            except FileNotFoundError:
+                pass
+        for source in self.sources.values():
+            source.close()
         # for r, w in self.clients:
         #    w.close()
         #    await w.wait_closed()
 
     async def client_connected_cb(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         pn = writer.get_extra_info("peername")
-        self.clients[pn] = (reader, writer, asyncio.Queue())
+        if not pn:  # unix socket peers are nameless
+            pn = f"unix:{id(writer)}"
+        client = self.clients[pn] = Client(reader, writer, policy=self.policy, max_lag=self.max_lag, max_behind=self.max_behind, history_samples=self.history_samples, history_seconds=self.history_seconds, name=f"{pn}")
+        self.subscribe(client, list(self.sources)[:1])
         self.live_clients.set()
-        feeder = asyncio.create_task(self.do_feeding(*self.clients[pn]))
+        feeder = asyncio.create_task(self.do_feeding(client))
         print(f"New client = {pn}")
+        try:
+            try:
+                first = await reader.readexactly(1)
+            except Exception as e:
+                print(f"Handled exception A: {e}")
+            else:
+                if first == FRAME_MAGIC[:1]:  # speaks the binary control protocol
+                    await self.control_commands(client, pn)
+                else:
+                    await self.legacy_commands(client, pn, first)
+        finally:  # whatever went wrong, the client doesn't get left behind
+            client.done = True
+            client.wake.set()  # so the feeder notices
+            try:
+                await asyncio.wait_for(feeder, timeout=0.5)
+            except:
+                print("Feeder termination timeout")
+            if not feeder.done():
+                feeder.cancel()
+            try:
+                await feeder
+            except asyncio.CancelledError:
+                print("Had to cancel feeder")
+            self.unsubscribe(client, list(client.cursors))
+            if len(self.clients) == 1:
+                self.live_clients.clear()
+            del self.clients[pn]
+            print(f"Goodbye to {pn}")
+
+    async def legacy_commands(self, client: Client, pn, first: bytes = b""):
+        """reads commands in the original format: the length of a JSON object, then the object"""
+        reader = client.reader
         while True:
             try:
-                len_msg = await reader.readuntil(b"{")
+                len_msg = first + await reader.readuntil(b"{")
+                first = b""
             except asyncio.exceptions.IncompleteReadError:
                 break
             except Exception as e:
@@ -78,7 +473,7 @@ class LiveServer(object):
                 print("Stream parse error. Resyncing...")
             else:
                 try:
-                    the_rest = await reader.read(msg_len)
+                    the_rest = await reader.readexactly(msg_len - 1)  # the length counts the { we've already got
                 except asyncio.exceptions.IncompleteReadError:
                     break
                 except Exception as e:
@@ -86,71 +481,654 @@ class LiveServer(object):
                     break
                 else:
                     msg = "{" + the_rest.decode()
-                    cmd = json.loads(msg)
-                    if "thermaltype" in cmd:
-                        writer.write(f"some_zone\n".encode())  # TODO: use right zone
-                    print(f"I got {cmd} from {pn}")
+                    try:
+                        cmd = json.loads(msg)
+                    except ValueError:
+                        print(f"Bad command from {pn}: {msg}")
+                    else:
+                        self.handle_cmd(client, cmd)
+                        print(f"I got {cmd} from {pn}")
+
+    async def control_commands(self, client: Client, pn):
+        """
+        reads control frames, the first of which must say hello: {"hello": {"version": CONTROL_VERSION, "caps": [...]}, ...}
+        every one gets a control frame back with the same seq, carrying "ok" and whatever the command asked about
+        """
+        reader = client.reader
         try:
-            await asyncio.wait_for(feeder, timeout=0.5)
-        except:
-            print("Feeder termination timeout")
-        if not feeder.done():
-            feeder.cancel()
+            if await reader.readexactly(1) != FRAME_MAGIC[1:]:
+                print(f"Bad handshake from {pn}")
+                return
+        except Exception as e:
+            print(f"Handled exception A: {e}")
+            return
+        synced = True  # the magic's already been read
+        while True:
+            try:
+                header, vals = await read_frame(reader, synced=synced)
+            except (asyncio.exceptions.IncompleteReadError, ConnectionError):
+                break
+            except ValueError as e:
+                print(f"Stream parse error: {e}. Resyncing...")
+                continue
+            except Exception as e:
+                print(f"Handled exception B: {e}")
+                break
+            finally:
+                synced = False
+            if not is_control(header):
+                continue
+            seq = header[3]
+            try:
+                cmd = unpack_control(vals)
+            except ValueError as e:
+                self.reply(client, seq, {"ok": False, "errors": [f"Bad control message: {e}"]})
+                continue
+            if "hello" in cmd:
+                hello = cmd.pop("hello")
+                if not isinstance(hello, dict):
+                    hello = {"version": hello}
+                if hello.get("version") != CONTROL_VERSION:
+                    client.send(pack_control(seq, {"ok": False, "errors": [f"Unsupported control protocol version: {hello.get('version')}"], "version": CONTROL_VERSION}))
+                    break
+                caps = hello.get("caps", [])
+                client.control = client.framed = True
+                client.caps = self.caps & {cap for cap in (caps if isinstance(caps, list) else []) if isinstance(cap, str)}
+                cmd["hello"] = True
+            elif not client.control:
+                client.send(pack_control(seq, {"ok": False, "errors": ["Say hello first"], "version": CONTROL_VERSION}))
+                break
+            self.handle_cmd(client, cmd, seq=seq)
+            print(f"I got {cmd} from {pn}")
+
+    @staticmethod
+    def zone_type(zone: int) -> str:
+        """what the kernel calls a thermal zone"""
+        return sensor_name(f"thermal{zone}") or "unknown"
+
+    def reply(self, client: Client, seq: int, reply: dict):
+        """answers a command, control protocol clients get it all, legacy ones get lines for the things they used to get"""
+        if client.control:
+            client.send(pack_control(seq, reply))
+        else:
+            if "thermaltype" in reply:
+                zone_types = list(reply["thermaltype"].values())
+                client.send(f"{zone_types[0] if zone_types else self.zone_type(self.zone_num)}\n".encode())
+            if "streams" in reply:
+                description = {key: reply[key] for key in ("streams", "shm", "epoch") if key in reply}
+                client.send(f"{json.dumps(description)}\n".encode())
+            if "metrics" in reply:
+                client.send(f"{json.dumps({'metrics': reply['metrics']})}\n".encode())
+
+    def metrics(self) -> dict:
+        """counters, rates and latencies for every source and client"""
+        sources = {}
+        for name, source in self.sources.items():
+            sources[name] = {"samples": source.samples_in.total, "samples_per_s": source.samples_in.rate, "subscribers": len(source.subscribers), "backfilled": source.backfilled, "heads": {tier: ring.head for tier, ring in source.rings.items()}}
+        clients = {}
+        for client in self.clients.values():
+            transport = client.writer.transport
+            clients[client.name] = {
+                "connected_s": time.time() - client.connected,
+                "tier": client.tier,
+                "policy": client.policy.value,
+                "samples": client.samples_out.total,
+                "samples_per_s": client.samples_out.rate,
+                "bytes": client.bytes_out.total,
+                "bytes_per_s": client.bytes_out.rate,
+                "shed": client.shed,
+                "lag": {name: self.sources[name].ring(client.tier).head - cursor for name, cursor in client.cursors.items()},  # samples queued in the ring
+                "write_buffer": transport.get_write_buffer_size() if transport is not None else 0,  # bytes queued in the socket
+                "latency_us": client.latency.snapshot(),
+            }
+        return {"uptime_s": time.time() - self.t0, "sources": sources, "clients": clients}
+
+    def metrics_text(self) -> str:
+        """the metrics as prometheus style text"""
+        metrics = self.metrics()
+        lines = [f"livechart_uptime_seconds {metrics['uptime_s']}"]
+        for name, source in metrics["sources"].items():
+            label = f'source="{name}"'
+            lines.append(f"livechart_source_samples_total{{{label}}} {source['samples']}")
+            lines.append(f"livechart_source_samples_per_second{{{label}}} {source['samples_per_s']}")
+            lines.append(f"livechart_source_subscribers{{{label}}} {source['subscribers']}")
+            lines.append(f"livechart_source_backfilled_total{{{label}}} {source['backfilled']}")
+        for name, client in metrics["clients"].items():
+            label = f'client="{name}"'
+            lines.append(f"livechart_client_samples_total{{{label}}} {client['samples']}")
+            lines.append(f"livechart_client_samples_per_second{{{label}}} {client['samples_per_s']}")
+            lines.append(f"livechart_client_bytes_total{{{label}}} {client['bytes']}")
+            lines.append(f"livechart_client_bytes_per_second{{{label}}} {client['bytes_per_s']}")
+            lines.append(f"livechart_client_shed_total{{{label}}} {client['shed']}")
+            lines.append(f"livechart_client_write_buffer_bytes{{{label}}} {client['write_buffer']}")
+            for source, lag in client["lag"].items():
+                lines.append(f'livechart_client_lag_samples{{{label},source="{source}"}} {lag}')
+            for q in ("p50", "p90", "p99", "max"):
+                lines.append(f'livechart_client_latency_us{{{label},quantile="{q}"}} {client["latency_us"][q]}')
+        return "\n".join(lines) + "\n"
+
+    async def metrics_connected_cb(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """a minimal HTTP server for the metrics"""
         try:
-            await feeder
-        except asyncio.CancelledError:
-            print("Had to cancel feeder")
-        if len(self.clients) == 1:
-            self.live_clients.clear()
-        del self.clients[pn]
-        print(f"Goodbye to {pn}")
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ")[1].decode() if request.count(b" ") >= 2 else "/"
+            if path.startswith("/json"):
+                body = json.dumps(self.metrics()).encode()
+                content_type = "application/json"
+            else:
+                body = self.metrics_text().encode()
+                content_type = "text/plain; version=0.0.4"
+            writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            print(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    def subscribe(self, client: Client, names: list[str]):
+        """starts sending the client new data from the named sources"""
+        for name in names:
+            if name in self.sources:
+                source = self.sources[name]
+                source.subscribers.add(client)
+                client.cursors[name] = source.ring(client.tier).head
+
+    def send_backlog(self, client: Client, names):
+        """sends framed clients what the named sources have in their history, up to where their live data starts"""
+        if not client.framed:
+            return
+        for name in names:
+            source = self.sources[name]
+            ring = source.ring(client.tier)
+            cursor = client.cursors[name]
+            start = source.backlog_start(client.tier, samples=client.history_samples, seconds=client.history_seconds)
+            for start, stop, hole in source.segments(client.tier, start, cursor):
+                if hole:
+                    client.send(pack_gap(start, stop - start, dtype=ring.buf.dtype, stream=source.sid))
+                    continue
+                if client.shm:
+                    client.send(pack_header(start, stop - start, dtype=ring.buf.dtype, stream=source.sid, flags=FLAG_BACKLOG | FLAG_DOORBELL))
+                    continue
+                vals = ring.read(start, stop)
+                while vals is None:  # a writer in another process lapped us, so the backlog starts where it's got to
+                    start = max(start, ring.tail)
+                    vals = ring.read(start, stop) if start < stop else ring.buf[:0]
+                client.samples_out.add(len(vals))
+                if len(vals) == 0:
+                    pass
+                elif ring.buf.dtype == object:  # notices, as they were first sent
+                    client.send(b"".join(vals))
+                elif client.compression:
+                    client.send(pack_compressed_frame(stop - len(vals), vals, dtype=ring.buf.dtype, stream=source.sid, flags=FLAG_BACKLOG, level=client.compression))
+                else:
+                    client.send(pack_frame(stop - len(vals), vals, dtype=ring.buf.dtype, stream=source.sid, flags=FLAG_BACKLOG))
+
+    def unsubscribe(self, client: Client, names: list[str]):
+        for name in names:
+            if name in client.cursors:
+                self.sources[name].subscribers.discard(client)
+                del client.cursors[name]
+
+    def describe(self, client: Client) -> dict:
+        """what a client needs to know to make sense of the frames it'll get"""
+        description = {"streams": {name: self.sources[name].sid for name in client.cursors}, "epoch": self.epoch}
+        if client.shm:
+            description["shm"] = {}
+            for name in client.cursors:
+                ring = self.sources[name].ring(client.tier)
+                description["shm"][name] = {"name": ring.shm.name, "capacity": ring.capacity, "dtype": FRAME_CODES[ring.buf.dtype]}
+        return description
+
+    def bad_fields(self, cmd: dict) -> list[str]:
+        """drops the fields of a command that have the wrong type of value, returns what was wrong with them"""
+        errors = []
+        for key, types in self.cmd_types.items():
+            if key not in cmd:
+                continue
+            value = cmd[key]
+            if not isinstance(value, types):
+                errors.append(f"Bad {key}: {value!r}")
+            elif isinstance(value, list) and not all(isinstance(name, str) for name in value):
+                errors.append(f"Bad {key}, source names are strings: {value!r}")
+            elif (key == "resume") and not all(isinstance(last, int) for last in value.values()):
+                errors.append(f"Bad {key}, seqs are integers: {value!r}")
+            else:
+                continue
+            del cmd[key]
+        return errors
+
+    def handle_cmd(self, client: Client, cmd: dict, seq: int = 0):
+        """acts on a decoded client command, then replies to it"""
+        backlog_for = set()  # source names that this command (re)started
+        reply = {}
+        errors = []
+        describe = client.control  # whether the reply should say what the client's subscribed to
+        if client.control:  # the features that need negotiating
+            for key, cap in self.cmd_caps.items():
+                if (key in cmd) and (cap not in client.caps):
+                    errors.append(f"{key} needs the {cap} capability")
+                    del cmd[key]
+        errors.extend(self.bad_fields(cmd))
+        if "hello" in cmd:
+            reply.update({"version": CONTROL_VERSION, "caps": sorted(client.caps), "sources": list(self.sources), "tiers": list(self.tiers), "epoch": self.epoch})
+        if "history_samples" in cmd:
+            client.history_samples = cmd["history_samples"]
+        if "history_seconds" in cmd:
+            client.history_seconds = cmd["history_seconds"]
+        if "framed" in cmd:
+            if cmd["framed"] and (not client.framed):
+                backlog_for.update(client.cursors)
+            client.framed = bool(cmd["framed"]) or client.control
+        if "policy" in cmd:
+            try:
+                client.policy = Policy(cmd["policy"])
+            except ValueError:
+                errors.append(f"Unknown policy: {cmd['policy']}")
+        if "tier" in cmd:
+            if cmd["tier"] in self.tiers:
+                client.tier = cmd["tier"]
+                for name in client.cursors:
+                    client.cursors[name] = self.sources[name].ring(client.tier).head
+                backlog_for.update(client.cursors)
+                describe = describe or client.shm  # the tier's rings are somewhere else
+            else:
+                errors.append(f"Unknown tier: {cmd['tier']}")
+        if "compression" in cmd:  # True, a zlib level or something falsy for none
+            level = cmd["compression"]
+            if level is True:
+                level = self.compression_level
+            if not level:
+                client.compression = None
+            elif isinstance(level, int) and (1 <= level <= 9):
+                client.compression = level
+            else:
+                errors.append(f"Bad compression level: {level}")
+        if "max_lag" in cmd:
+            client.max_lag = max(1, min(int(cmd["max_lag"]), self.ring_size))
+        if "max_behind" in cmd:
+            client.max_behind = float(cmd["max_behind"])
+        if "unsubscribe" in cmd:
+            self.unsubscribe(client, cmd["unsubscribe"])
+        if "subscribe" in cmd:  # replaces the whole subscription list
+            errors.extend(f"Unknown source: {name}" for name in cmd["subscribe"] if name not in self.sources)
+            self.unsubscribe(client, [name for name in client.cursors if name not in cmd["subscribe"]])
+            new_names = [name for name in cmd["subscribe"] if name not in client.cursors]
+            self.subscribe(client, new_names)
+            backlog_for.update(name for name in new_names if name in client.cursors)
+            describe = True  # tell the client which stream id each of its sources will come with
+        if "zone" in cmd:  # swaps the client's thermal subscription for another zone's
+            name = f"thermal{cmd['zone']}"
+            thermals = [old for old in client.cursors if old.startswith("thermal")]
+            if name not in self.sources:
+                errors.append(f"Unknown source: {name}")
+            elif not thermals:
+                errors.append("Not subscribed to a thermal zone")
+            elif name not in client.cursors:
+                self.unsubscribe(client, thermals)
+                self.subscribe(client, [name])
+                backlog_for.add(name)
+                describe = True
+        if "resume" in cmd:  # {source name: seq of the last sample the client got}, in its current tier, with the "epoch" those seqs are from
+            reply["resume"] = {}
+            for name, last in cmd["resume"].items():
+                if name not in client.cursors:
+                    errors.append(f"Can't resume unsubscribed source: {name}")
+                    continue
+                ring = self.sources[name].ring(client.tier)
+                if cmd.get("epoch") != self.epoch:  # another server's (or our previous life's) seqs, so it gets the whole backlog instead
+                    backlog_for.add(name)
+                    start = self.sources[name].backlog_start(client.tier, samples=client.history_samples, seconds=client.history_seconds)
+                    reply["resume"][name] = {"from": start, "lost": None}  # None for not knowing how much
+                    describe = True
+                    continue
+                want = int(last) + 1
+                if want > ring.head:  # this isn't the history the client was getting before (we restarted?)
+                    errors.append(f"Can't resume {name} from {want}, it's only at {ring.head}")
+                    continue
+                # the feeder replays from here, with a gap frame first for whatever's already been overwritten
+                client.cursors[name] = want
+                backlog_for.discard(name)
+                reply["resume"][name] = {"from": max(want, ring.tail), "lost": max(0, ring.tail - want)}
+            client.wake.set()
+        if "shm" in cmd:
+            if cmd["shm"] and self.shared:
+                client.shm = client.framed = True
+                describe = True
+            else:
+                if cmd["shm"]:
+                    errors.append("Shared memory was asked for but this server isn't sharing")
+                client.shm = False
+        if "metrics" in cmd:
+            reply["metrics"] = self.metrics()
+        if "thermaltype" in cmd:
+            reply["thermaltype"] = {name: self.zone_type(int(name.removeprefix("thermal"))) for name in client.cursors if name.startswith("thermal")}
+        if describe:
+            reply.update(self.describe(client))
+        for error in errors:
+            print(error)
+        reply["ok"] = not errors
+        if errors:
+            reply["errors"] = errors
+        self.reply(client, seq, reply)
+        self.send_backlog(client, [name for name in client.cursors if name in backlog_for])
 
     async def datasource(self):
-        dbw = DBTool()
-        dbw.listen_channels.append(f"{dbw.tbl_name}_events")
-        aconn = await psycopg.AsyncConnection.connect(conninfo=dbw.db_uri, autocommit=True)
-        async with aconn:
-            async with aconn.cursor() as acur:
-                listener = asyncio.create_task(dbw.do_listening(aconn, acur))
-                while await self.live_clients.wait():  # runs forever
-                    if self.dtype == DType.DB:
-                        if dbw.outq.qsize() > 1:
-                            vals = [await dbw.outq.get() for x in range(dbw.outq.qsize())]
-                        else:
-                            vals = (await dbw.outq.get(),)
-                    elif self.dtype == DType.RANDOM:
-                        vals = (random.random(),)
-                        await asyncio.sleep(self.delay)
-                    elif self.dtype == DType.THERMAL:
-                        vals = (random.random() * 10,)
-                        await asyncio.sleep(self.delay)
+        """
+        runs every source, each in its own task (except the notify: ones, which all share one, and so do the thermal ones)
+        a source that fails gets restarted on its own, the others carry on
+        """
+        tasks = [self.keep_running(name, lambda source=source: self.run_source(source)) for name, source in self.sources.items() if not name.startswith(("notify:", "thermal"))]
+        thermals = [source for name, source in self.sources.items() if name.startswith("thermal")]
+        if thermals:
+            tasks.append(self.keep_running("thermal sources", lambda: self.run_thermals(thermals)))
+        channels = [name.removeprefix("notify:") for name in self.sources if name.startswith("notify:")]
+        if channels:
+            tasks.append(self.proxy_db(channels))
+        await asyncio.gather(*tasks)
+
+    @staticmethod
+    async def keep_running(what: str, run, retry_delay: float = 1.0):
+        """awaits run() (a coroutine function), and again after a retry_delay whenever it fails"""
+        while True:
+            try:
+                return await run()
+            except Exception as e:
+                print(f"Failed running {what}: {e!r}, restarting it in {retry_delay} s")
+            await asyncio.sleep(retry_delay)
+
+    async def proxy_db(self, channels: list[str], retry_delay: float = 1.0):
+        """feeds the notify: sources from one LISTEN connection to the database"""
+        dbw = DBTool(db_uri=self.db_uri)
+        while True:
+            try:
+                await self.proxy(dbw.notifications(channels))
+            except Exception as e:
+                print(f"Lost the database connection: {e}")
+            await asyncio.sleep(retry_delay)
+
+    async def proxy(self, notifications):
+        """
+        puts (channel, JSON payload) notifications into the notify:<channel> sources, decoding each just once
+        rows from raw channels become DB_RAW_DTYPE records, everything else goes out as is in notice frames
+        """
+        pending = {}  # source --> notifications (raw rows already as DB_RAW_DTYPE tuples) for it that have come in since the last flush
+
+        def flush():
+            try:
+                for source, msgs in pending.items():
+                    ring = source.ring("raw")
+                    if ring.buf.dtype == object:
+                        notices = np.empty(len(msgs), dtype=object)
+                        notices[:] = [pack_notice(ring.head + i, json.dumps(msg).encode(), stream=source.sid) for i, msg in enumerate(msgs)]
+                        source.put_records(notices)
                     else:
-                        vals = (0,)
-                        await asyncio.sleep(self.delay)
-                    self.putter(vals)
-                await listener  # will never be reached
-
-    def putter(self, vals):
-        """distributes values to client queues"""
-        for pn, (reader, writer, q) in self.clients.items():
-            for v in vals:
-                if not writer.is_closing():
-                    q.put_nowait(v)
-
-    async def do_feeding(self, reader: asyncio.StreamWriter, writer: asyncio.StreamReader, q: asyncio.Queue):
+                        source.put_records(np.array(msgs, dtype=DB_RAW_DTYPE))
+            finally:  # or nothing would ever get flushed again
+                pending.clear()
+
+        loop = asyncio.get_running_loop()
+        async for channel, payload in notifications:
+            source = self.sources.get(f"notify:{channel}")
+            if source is None:
+                continue
+            try:
+                msg = json.loads(payload)
+                msg["channel"] = channel
+                if source.ring("raw").buf.dtype != object:  # checked now, so one bad row can't spoil the batch it'd go out in
+                    msg = np.array(tuple(msg[key] if msg.get(key) is not None else {"eid": -1, "s": -1}.get(key, np.nan) for key in DB_RAW_DTYPE.names), dtype=DB_RAW_DTYPE).item()
+            except (ValueError, TypeError):
+                print(f"Failed to parse payload on {channel}: {payload}")
+                continue
+            if not pending:  # whatever else comes in before the loop gets around to it goes out in the same batch
+                loop.call_soon(flush)
+            pending.setdefault(source, []).append(msg)
+
+    async def producing(self) -> bool:
+        """waits until someone could want new data (which is always when we're keeping history for future clients)"""
+        if self.workers > 0:  # our clients are in other processes
+            return True
+        elif (self.history_samples == 0) or (self.history_seconds == 0):
+            return await self.live_clients.wait()
+        else:
+            return True
+
+    async def run_thermals(self, sources: list[Source]):
+        """feeds thermal sources from one sampler, which reads all of their zones together each time a sample's due"""
+        pacer = Pacer(self.delay)
+        with ThermalSampler([source.name for source in sources]) as sampler:
+            while await self.producing():  # runs forever
+                n = len(pacer.take(await pacer.wait(1, ThermalSource.tick)))
+                ts = np.empty(n, dtype=np.int64)
+                vals = np.empty((n, len(sources)), dtype=np.float64)
+                for i in range(n):
+                    vals[i] = sampler.read()
+                    ts[i] = time.time_ns()
+                for i, source in enumerate(sources):
+                    source.put(vals[:, i], ts)
+
+    async def run_source(self, source: Source):
+        if source.name == "random":
+            async with RandomSource(artificial_delay=self.delay) as d_source:
+                while await self.producing():  # runs forever
+                    ts, vals = await d_source.get_many()
+                    source.put(vals, ts)
+        elif source.name.startswith("db:"):
+            dbw = DBTool(db_uri=self.db_uri)
+            dbw.tbl_name = source.name.removeprefix("db:")
+            dbw.listen_channels = [f"{dbw.tbl_name}_events"]
+
+            async def get(filler: asyncio.Task):
+                """the next thing in dbw.outq, or whatever stopped the task that fills it"""
+                getting = asyncio.ensure_future(dbw.outq.get())
+                await asyncio.wait({filler, getting}, return_when=asyncio.FIRST_COMPLETED)
+                if not getting.done():
+                    getting.cancel()
+                    filler.result()
+                    raise RuntimeError(f"Stopped getting rows from {dbw.tbl_name}")
+                return getting.result()
+
+            aconn = await psycopg.AsyncConnection.connect(conninfo=dbw.db_uri, autocommit=True)
+            if self.db_ingest is not None:
+                dbw.ingest = self.db_ingest
+                async with aconn:
+                    ingester = asyncio.create_task(dbw.ingesting(aconn, [dbw.tbl_name]))
+                    try:
+                        while await self.producing():  # runs forever
+                            rows = (await get(ingester))["rows"]
+                            source.put(rows["v"], rows["t"])
+                            source.backfilled = dbw.backfilled
+                    finally:
+                        ingester.cancel()
+            else:
+                async with aconn:
+                    async with aconn.cursor() as acur:
+                        listener = asyncio.create_task(dbw.do_listening(aconn, acur))
+                        try:
+                            while await self.producing():  # runs forever
+                                records = [await get(listener)]
+                                records.extend(dbw.outq.get_nowait() for x in range(dbw.outq.qsize()))
+                                source.put([rec[2] for rec in records], [self._ns(rec[1]) for rec in records])
+                                source.backfilled = dbw.backfilled
+                        finally:
+                            listener.cancel()
+        elif source.name.startswith("relay:"):
+            await self.relay(source)
+        else:
+            print(f"Don't know how to run source {source.name}")
+
+    async def relay(self, source: Source, retry_delay: float = 1.0):
+        """
+        feeds a source from another LiveServer's framed stream
+        the payloads go into our rings as they came off the wire, without being unpacked sample by sample
+        a named source's upstream says which run of it we're hearing from, so its seqs starting over after a restart is noticed
+        """
+        upstream, _, upstream_name = source.name.removeprefix("relay:").partition("/")
+        host, _, port = upstream.rpartition(":")
+        cmd = {"framed": True, "policy": Policy.DROP_OLDEST.value}  # never a decimated pick, what's dropped comes as a gap
+        if upstream_name:
+            cmd["subscribe"] = [upstream_name]
+        msg = json.dumps(cmd).encode()
+        upstream_next = 0  # upstream's index of the next sample we need, so backlogs don't repeat what we already have
+        upstream_epoch = None  # which run of the upstream server those indices belong to
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, int(port))
+            except OSError as e:
+                print(f"Can't reach upstream {upstream}: {e}")
+                await asyncio.sleep(retry_delay)
+                continue
+            writer.write(f"{len(msg)}".encode() + msg)
+            try:
+                if upstream_name:  # subscribing gets a description line back first, saying which run of upstream this is
+                    description = json.loads(await reader.readline())
+                    epoch = description.get("epoch") if isinstance(description, dict) else None
+                    if epoch != upstream_epoch:  # it's restarted (or it's the first we've heard of it), its seqs start over
+                        upstream_epoch = epoch
+                        upstream_next = 0
+                while True:
+                    (dtype, flags, stream, seq, count), vals = await read_frame(reader)
+                    if (dtype != RECORD_DTYPE) or (flags & FLAG_DECIMATED):  # only raw samples go in the raw ring, the next frame's seq shows what a pick covered
+                        continue
+                    if upstream_next and (seq > upstream_next):  # upstream lost these before they got to us
+                        source.put_gap(seq - upstream_next)
+                        upstream_next = seq
+                    if flags & FLAG_GAP:
+                        source.put_gap(seq + count - max(seq, upstream_next))
+                    else:
+                        if flags & FLAG_BACKLOG:
+                            vals = vals[max(0, upstream_next - seq) :]
+                        if len(vals) > 0:
+                            source.put_records(vals)
+                    upstream_next = max(upstream_next, seq + count)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                print(f"Lost upstream {upstream}: {e}")
+            except (ValueError, asyncio.LimitOverrunError) as e:  # a frame (or reply) we can't make sense of, start over on a fresh connection
+                print(f"Garbled stream from upstream {upstream}: {e}")
+            finally:
+                writer.close()
+            await asyncio.sleep(retry_delay)
+
+    @staticmethod
+    def _ns(timestamp: dt.datetime) -> int:
+        """datetime --> ns since the epoch"""
+        return int(timestamp.timestamp() * 1_000_000) * 1000
+
+    def putter(self, vals, ts=None, source: str | None = None):
+        """puts values (with their source timestamps [ns], or now) into a source, the first one by default"""
+        if source is None:
+            source = list(self.sources)[0]
+        if ts is None:
+            ts = [time.time_ns()] * len(vals)
+        self.sources[source].put(vals, ts)
+
+    async def do_feeding(self, client: Client):
+        reader = client.reader
+        writer = client.writer
         while not reader.at_eof():
-            q_item = await q.get()
+            await client.wake.wait()
+            client.wake.clear()
+            if client.done:
+                break
+            keep = True
             try:
-                writer.write(struct.pack("f", q_item[2]))
-                await writer.drain()
+                for name in list(client.cursors):
+                    keep = keep and self.feed_one(client, self.sources[name])
+                if keep:
+                    if client.policy == Policy.DISCONNECT:  # a client that's stopped reading never lets drain() return
+                        await asyncio.wait_for(writer.drain(), client.max_behind)
+                    else:
+                        await writer.drain()
+            except asyncio.TimeoutError:
+                keep = False
             except Exception as e:
                 print(f"Write exception: {e}")
+            if not keep:
+                print(f"Hanging up on {writer.get_extra_info('peername')} for lagging")
+                writer.transport.abort()  # closing would wait for it to read what's buffered
+                break
         try:
             writer.close()
             await writer.wait_closed()
         except Exception as e:
             print(f"Writer close exception: {e}")
 
+    def feed_one(self, client: Client, source: Source) -> bool:
+        """writes whatever's new from the source to the client, returns False if the client should be dropped"""
+        ring = source.ring(client.tier)
+        cursor = client.cursors[source.name]
+        lag = ring.head - cursor
+        if lag <= 0:
+            return True
+        if lag > client.max_lag:
+            if client.behind_since is None:
+                client.behind_since = asyncio.get_running_loop().time()
+            if client.policy == Policy.DISCONNECT:
+                if (asyncio.get_running_loop().time() - client.behind_since) > client.max_behind:
+                    return False
+                skip = max(0, ring.tail - cursor)  # only what the ring has overwritten
+            elif client.policy == Policy.DROP_OLDEST:
+                skip = lag - client.max_lag
+            else:
+                skip = max(0, ring.tail - cursor)
+        else:
+            client.behind_since = None
+            skip = max(0, ring.tail - cursor)
+        if skip > 0:
+            if client.framed:
+                client.send(pack_gap(cursor, skip, dtype=ring.buf.dtype if ring.buf.dtype != object else FRAME_DTYPES[NOTICE_CODE], stream=source.sid))
+            cursor += skip
+            client.shed += skip
+        runs = source.segments(client.tier, cursor, ring.head)
+        while runs and runs[0][2]:  # holes the source was left with go out as gaps
+            start, stop, _ = runs.pop(0)
+            if client.framed:
+                client.send(pack_gap(start, stop - start, dtype=ring.buf.dtype, stream=source.sid))
+            cursor = client.cursors[source.name] = stop
+        if not runs:
+            return True
+        head = runs[0][1]
+        if len(runs) > 1:  # what's past the next hole goes on another go
+            client.wake.set()
+        if client.shm:  # the data is already where the client can get it
+            client.send(pack_header(cursor, head - cursor, dtype=ring.buf.dtype, stream=source.sid, flags=FLAG_DOORBELL))
+            client.samples_out.add(head - cursor)
+            client.cursors[source.name] = head
+            return True
+        vals = ring.read(cursor, head)
+        if vals is None:  # a writer in another process lapped us mid read
+            client.wake.set()  # so have another go at it
+            return True
+        n_vals = len(vals)
+        if ring.buf.dtype == object:  # notices, each one already a whole frame
+            if client.framed:
+                client.send(b"".join(vals))
+            client.samples_out.add(n_vals)
+            client.cursors[source.name] = cursor + n_vals
+            return True
+        flags = 0
+        stride = 1
+        if (client.policy == Policy.DECIMATE) and (n_vals > client.max_lag):
+            stride = -(-n_vals // client.max_lag)
+            vals = vals[::stride]
+            flags = FLAG_DECIMATED
+            client.shed += n_vals - len(vals)
+        if client.control and ("batch" not in client.caps):  # one sample per frame
+            client.send(b"".join(pack_frame(cursor + i * stride, vals[i : i + 1], dtype=ring.buf.dtype, stream=source.sid, flags=flags) for i in range(len(vals))))
+        elif client.framed and client.compression:
+            if flags:  # this client's own pick of the samples
+                client.send(pack_compressed_frame(cursor, vals, dtype=ring.buf.dtype, stream=source.sid, flags=flags, level=client.compression))
+            else:
+                client.send(source.compressed_frame(client.tier, cursor, vals, client.compression))
+        elif client.framed:  # everything that's waiting goes out as one frame
+            client.send(pack_frame(cursor, vals, dtype=ring.buf.dtype, stream=source.sid, flags=flags))
+        elif ring.buf.dtype == TIER_DTYPE:  # plain float streams only get the bucket means
+            client.send(vals["mean"].astype("<f4").tobytes())
+        else:  # the same bytes the one-float-per-write stream would have made
+            client.send(vals["v"].astype("<f4").tobytes())
+        client.sent(vals)
+        client.cursors[source.name] = cursor + n_vals
+        return True
+
     # def accept(self, sock):
     #    conn, addr = sock.accept()  # accept a connection
     #    print(f"Accepted new connection: {conn} from ip {addr}")
@@ -175,6 +1153,85 @@ class LiveServer(object):
         async with self.srv:
             await self.srv.serve_forever()
 
+    def layout(self) -> dict:
+        """where our shared memory rings are: {source name: {tier: (shm name, capacity, dtype code)}}"""
+        return {name: {tier: (ring.shm.name, ring.capacity, FRAME_CODES[ring.buf.dtype]) for tier, ring in source.rings.items()} for name, source in self.sources.items() if all(ring.shm is not None for ring in source.rings.values())}
+
+    def attach(self, layout: dict):
+        """serve sources that some other process is writing into shared memory"""
+        for name, rings in layout.items():
+            self.sources[name] = Source.attach(name, len(self.sources), rings)
+
+    async def follow(self, interval: float = 0.001, max_interval: float = 0.05):
+        """
+        wakes up the subscribers of attached sources whenever the producing process writes to them
+        polls every interval seconds while there's new data, backing off to max_interval while there isn't
+        """
+        heads = {}
+        wait = interval
+        while True:
+            wait = min(wait * 2, max_interval)
+            for source in self.sources.values():
+                these_heads = tuple(ring.head for ring in source.rings.values())
+                if heads.get(source.name) != these_heads:
+                    heads[source.name] = these_heads
+                    wait = interval
+                    for client in source.subscribers:
+                        client.wake.set()
+            await asyncio.sleep(wait)
+
+    def start_workers(self) -> list:
+        """starts the worker processes, they all accept clients on our port"""
+        if self.port == 0:  # pick one for all of them, and hold it
+            self._port_holder = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET)
+            self._port_holder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._port_holder.bind((self.host, 0))
+            self.port = self._port_holder.getsockname()[1]
+        settings = {"policy": self.policy.value, "max_lag": self.max_lag, "max_behind": self.max_behind, "history_samples": self.history_samples, "history_seconds": self.history_seconds, "epoch": self.epoch}
+        ctx = multiprocessing.get_context("spawn")
+        ready = ctx.Semaphore(0)  # released by each worker once it's listening
+        procs = [ctx.Process(target=worker_main, args=(self.host, self.port, self.layout(), settings, ready), daemon=True) for i in range(self.workers)]
+        for proc in procs:
+            proc.start()
+        print(f"Started {self.workers} workers for clients on {(self.host, self.port)}")
+        if self._port_holder is not None:
+            threading.Thread(target=self._release_port, args=(ready, len(procs)), daemon=True).start()
+        return procs
+
+    def _release_port(self, ready, n_workers: int):
+        """closes the socket holding the workers' port once they've all bound it"""
+        for i in range(n_workers):
+            if not ready.acquire(timeout=self.worker_start_timeout):
+                print("Gave up waiting for the workers to come up")
+                break
+        self._port_holder.close()
+        self._port_holder = None
+
+    def serve_workers(self):
+        """samples the sources here, exactly once, while the worker processes handle the clients"""
+        procs = self.start_workers()
+        try:
+            asyncio.run(self.datasource())
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.join()
+            for source in self.sources.values():
+                source.close()
+
+
+def worker_main(host: str, port: int, layout: dict, settings: dict, ready=None):
+    """the body of a worker process, ready is a semaphore to release once it's listening"""
+
+    async def serve():
+        async with LiveServer(host=host, port=port, sources=[], shared=True, reuse_port=True, **settings) as ls:
+            ls.attach(layout)
+            if ready is not None:
+                ready.release()
+            await asyncio.gather(ls.run(), ls.follow())
+
+    asyncio.run(serve())
+
 
 """         with Datagetter(dtype=dtype, zone=zone) as dg:
             self.sel.register(dg.socket, selectors.EVENT_READ, self.get_data)
@@ -12,7 +12,9 @@ import collections
 import time
 from matplotlib.backends.backend_cairo import FigureCanvasCairo, RendererCairo
 from matplotlib.figure import Figure
-import struct
+import json
+
+from ..lib import FrameParser
 
 # from ..lib import Datagetter
 # from ..lib import Downsampler
@@ -52,7 +54,8 @@ class Interface(object):
 
         self.t0 = time.time()
         self.s = Gio.SocketClient.new()
-        self.float_size = struct.calcsize("f")
+        self.read_size = 65536  # most we'll take off the socket per read
+        self.parser = FrameParser()
 
     def on_app_activate(self, app):
         win = self.app.props.active_window
@@ -128,15 +131,18 @@ class Interface(object):
         if (not input_stream.props.socket.is_closed()) and (not self.closing):
             try:
                 vraw = input_stream.read_bytes_finish(result)
-                dat = struct.unpack("f", vraw.unref_to_data())[0]
-                input_stream.read_bytes_async(self.float_size, GLib.PRIORITY_DEFAULT, None, self.handle_data)
+                if vraw.get_size() == 0:
+                    raise ConnectionError("Server hung up")
+                frames = self.parser.feed(vraw.get_data())
+                input_stream.read_bytes_async(self.read_size, GLib.PRIORITY_DEFAULT, None, self.handle_data)
             except Exception as e:
                 toast = Adw.Toast.new(f"Closing connection because of data reception failure: {e}")
                 toast.props.timeout = 3
                 self.tol.add_toast(toast)
                 self.close_conn()
             else:
-                self.data.appendleft((time.time() - self.t0, dat))
+                for header, vals in frames:  # records carry their source timestamps
+                    self.data.extendleft(zip((vals["t"] / 1e9 - self.t0).tolist(), vals["v"].tolist()))
                 self.update_val()
                 self.new_plot()
                 self.canvas.queue_draw()
@@ -204,7 +210,10 @@ class Interface(object):
             conn = socket_client.connect_to_host_finish(result)
             conn.props.graceful_disconnect = True
             conn.props.socket.set_timeout(1)
-            conn.props.input_stream.read_bytes_async(self.float_size, GLib.PRIORITY_DEFAULT, None, self.handle_data)
+            msg = json.dumps({"framed": True}).encode()
+            conn.props.output_stream.write_all(f"{len(msg)}".encode() + msg, None)
+            self.parser = FrameParser()
+            conn.props.input_stream.read_bytes_async(self.read_size, GLib.PRIORITY_DEFAULT, None, self.handle_data)
             self.conn = conn
         except Exception as e:
             if hasattr(e, "message"):
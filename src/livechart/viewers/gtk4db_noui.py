@@ -33,6 +33,14 @@ from matplotlib.figure import Figure
 import struct
 
 from livechart.db import DBTool
+from livechart.lib import FrameParser
+from livechart.lib import pack_control
+from livechart.lib import unpack_control
+from livechart.lib import is_control
+from livechart.lib import is_notice
+from livechart.lib import db_raw_dicts
+from livechart.lib import DB_RAW_DTYPE
+from livechart.lib import CONTROL_VERSION
 import psycopg
 import asyncio
 import threading
@@ -359,6 +367,7 @@ class Interface(object):
     app = None
     version = livechart.__version__
     db_url = "postgresql://"
+    proxy_address = ""  # host:port of a LiveServer proxying the database's notifications, blank to LISTEN to the database directly
     some_widgets = {}
     max_data_length = 1000  # can be None for unbounded
     data = collections.deque([(float("nan"), float("nan"))], max_data_length)
@@ -506,6 +515,7 @@ class Interface(object):
             tb.pack_end(mb)
 
             self.db_url = self.settings.get_string("address")
+            self.proxy_address = self.settings.get_string("proxy")
 
             cbtn = Gtk.Button.new_from_icon_name("call-start")
             cbtn.connect("clicked", self.on_conn_btn_clicked)
@@ -1513,6 +1523,11 @@ class Interface(object):
         entry_widget = args[0]
         self.db_url = entry_widget.get_text()
 
+    def proxy_change(self, *args, **kwargs):
+        """handle change in the proxy address string"""
+        entry_widget = args[0]
+        self.proxy_address = entry_widget.get_text()
+
     def on_preferences_action(self, widget, _):
         win = self.app.props.active_window
         # setup prefs dialog
@@ -1586,6 +1601,21 @@ class Interface(object):
         # urllinebox.append(sbf)
         content_box.append(sbf)
 
+        pf = Gtk.Frame.new()
+        pfl = Gtk.Label.new()
+        pfl.props.label = "LiveServer Proxy (host:port, blank to listen to the database directly)"
+        pf.props.label_widget = pfl
+        proxy_entry = Gtk.Entry.new()
+        proxy_entry.props.attributes = self.mal
+        proxy_entry.props.text = self.proxy_address
+        proxy_entry.connect("changed", self.proxy_change)
+        proxy_entry.props.placeholder_text = "localhost:58741"
+        proxy_entry.props.margin_start = 5
+        proxy_entry.props.margin_end = 5
+        proxy_entry.props.margin_bottom = 5
+        pf.props.child = proxy_entry
+        content_box.append(pf)
+
         lf = Gtk.Frame.new()
         lfl = Gtk.Label.new()
         # lfl.props.attributes = self.bal
@@ -1625,6 +1655,7 @@ class Interface(object):
     def on_prefs_response(self, prefs_dialog, response_code, listbox):
         if response_code == Gtk.ResponseType.OK:
             self.settings.set_string("address", self.db_url)
+            self.settings.set_string("proxy", self.proxy_address)
             self.channels = []
 
             def fill_channels(box: Gtk.ListBox, row: Gtk.ListBoxRow):
@@ -1634,6 +1665,7 @@ class Interface(object):
             listbox.selected_foreach(fill_channels)
         else:
             self.db_url = self.settings.get_string("address")
+            self.proxy_address = self.settings.get_string("proxy")
         prefs_dialog.destroy()
 
     def thread_task_runner(self):
@@ -1651,6 +1683,7 @@ class Interface(object):
             self.async_loops.append(asyncio.get_running_loop())
             dbw = DBTool(db_uri=self.db_url)
             dbw.listen_channels = [f"{chan[0]}_{chan[1]}" for chan in self.channels]
+            dbw.channel_tables = {f"{chan[0]}_{chan[1]}": f"{chan[0]}.{chan[1]}" for chan in self.channels}
             schemas = set([chan[0] for chan in self.channels])
             if len(schemas) > 1:
                 toast_text = "LIstening on multiple schemas.\nThis will not go well..."
@@ -1692,7 +1725,60 @@ class Interface(object):
                         await asyncio.gather(*[acur.execute(f"UNLISTEN {ch}") for ch in dbw.listen_channels])
                         await aconn.commit()
 
-        asyncio.run(db_listener())
+        async def proxy_getter(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, channels: list[str]):
+            """turns the proxy's frames back into the dicts the database's notifications would have given"""
+            writer.write(pack_control(1, {"hello": {"version": CONTROL_VERSION, "caps": ["batch", "subscriptions"]}, "subscribe": [f"notify:{ch}" for ch in channels]}))
+            stream_channels = {}  # stream id --> channel
+            parser = FrameParser()
+            while True:
+                data = await reader.read(2**16)
+                if not data:
+                    break
+                vals = []
+                for header, payload in parser.feed(data):
+                    if is_control(header):
+                        reply = unpack_control(payload)
+                        if not reply["ok"]:
+                            print(f"Proxy said: {reply['errors']}")
+                        stream_channels = {sid: name.removeprefix("notify:") for name, sid in reply.get("streams", {}).items()}
+                    elif is_notice(header):
+                        vals.append(json.loads(payload.tobytes()))
+                    elif header[0] == DB_RAW_DTYPE:
+                        vals += db_raw_dicts(payload, stream_channels.get(header[2], ""))
+                if vals:
+                    GLib.idle_add(self.handle_db_data, vals)
+
+        async def proxy_listener():
+            self.async_loops.append(asyncio.get_running_loop())
+            channels = [f"{chan[0]}_{chan[1]}" for chan in self.channels]
+            schemas = set([chan[0] for chan in self.channels])
+            if schemas:
+                self.db_schema_dot = f"{schemas.pop()}."
+            host, _, port = self.proxy_address.rpartition(":")
+            writer = None
+            try:
+                reader, writer = await asyncio.create_task(asyncio.open_connection(host, int(port)), name="connect")
+                toast_text = f"Connected to {self.proxy_address}"
+            except Exception as e:
+                toast_text = f"Connection failure: {e}"
+            toast = Adw.Toast.new(toast_text)
+            toast.props.timeout = 3
+            self.tol.add_toast(toast)
+
+            if writer is not None:
+                listen_task = asyncio.create_task(proxy_getter(reader, writer, channels), name="listen")
+                try:
+                    await listen_task
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:
+                    print(e)
+                writer.close()
+
+        if self.proxy_address:
+            asyncio.run(proxy_listener())
+        else:
+            asyncio.run(db_listener())
         GLib.idle_add(self.cleanup_conn)
 
     def on_conn_btn_clicked(self, widget):
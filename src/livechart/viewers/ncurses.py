@@ -13,6 +13,7 @@ import json
 
 # from ..server import LiveServer
 from ..lib import Downsampler
+from ..lib import read_frame
 
 
 class Interface(object):
@@ -53,7 +54,7 @@ class Interface(object):
         # TODO: read the terminal size with curses and use that
 
         average_window_length = round(plot_width / 5)  # length of running average window
-        downsample_by = 30  # factor for downsampling
+        downsample_by = 3  # factor for downsampling (on top of the server's 100Hz tier)
 
         display = deque([], plot_width)  # what we'll be displaying
 
@@ -66,7 +67,7 @@ class Interface(object):
 
     async def synchy(self, lds, lstdscr, lcache, awinlen, lcum_sum, ldisp, lquitkey, ph, tzn, datatype, delay):
         reader, writer = await asyncio.open_connection("127.0.0.1", 58741)
-        msg = json.dumps({"dtype": datatype, "zone": tzn, "delay": delay, "thermaltype": 0}).encode()
+        msg = json.dumps({"dtype": datatype, "zone": tzn, "delay": delay, "thermaltype": 0, "framed": True, "tier": "100Hz"}).encode()
         writer.write(f"{len(msg)}".encode() + msg)
         thermaltype_response = await reader.readline()
         tmp_type = thermaltype_response.decode().strip()
@@ -74,9 +75,8 @@ class Interface(object):
         quit = False
         # dg.trigger_new()  # ask for a new value
         while (not quit) and ((time.time() - t0) < self.max_duration):
-            vraw = await reader.read(4)
-            raw_data = struct.unpack("f", vraw)[0]  # TODO: possibly handle more than one AND check this length
-            if math.isnan(this_data := lds.feed(raw_data)):  # feed the downsampler with raw data until it gives us a data point
+            header, vals = await read_frame(reader)
+            if math.isnan(this_data := lds.feed(vals["mean"].tolist())):  # feed the downsampler with raw data until it gives us a data point
                 pass
             else:  # the downsampler as produced a point for us
                 lstdscr.erase()
@@ -0,0 +1,297 @@
+import unittest
+import asyncio
+import json
+import contextlib
+import psycopg
+import datetime as dt
+import numpy as np
+from livechart.db import pack_copy
+from livechart.db import ns_to_datetime
+from livechart.db import COPY_SIGNATURE
+from livechart.db import COPY_TRAILER
+from livechart.db import COPY_ROW_DTYPE
+from livechart.db import notified_ids
+from livechart.db import pack_payloads
+from livechart.db import unpack_payloads
+from livechart.db import PACKED_ROWS_MAX
+from livechart.db import unpack_copy
+from livechart.db import has_gap
+from livechart.db import DBTool
+from livechart.db import ROWS_DTYPE
+from livechart.db import BatchWriter
+from psycopg.adapt import Transformer
+from psycopg.postgres import types
+from psycopg.pq import Format
+from psycopg._copy_base import parse_row_binary
+
+
+class PackCopyTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        """what psycopg's own binary COPY parser makes of it"""
+        ids = np.array([7, 8, 10])
+        ts = np.array([1_700_000_000_123_456_789, 1_700_000_000_223_456_789, 946_684_800 * 10**9])
+        vals = np.array([1.5, -2.25, 45.125])
+        packed = pack_copy(ids, ts, vals)
+        self.assertTrue(packed.startswith(COPY_SIGNATURE))
+        self.assertTrue(packed.endswith(COPY_TRAILER))
+        tx = Transformer()
+        tx.set_loader_types([types["int8"].oid, types["timestamptz"].oid, types["float4"].oid], Format.BINARY)
+        body = packed[len(COPY_SIGNATURE) : -len(COPY_TRAILER)]
+        rows = [parse_row_binary(body[i : i + COPY_ROW_DTYPE.itemsize], tx) for i in range(0, len(body), COPY_ROW_DTYPE.itemsize)]
+        self.assertEqual([row[0] for row in rows], [7, 8, 10])
+        self.assertEqual([row[1] for row in rows], [ns_to_datetime(t) for t in ts])
+        self.assertEqual(rows[2][1], dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc))
+        self.assertEqual(rows[0][1].microsecond, 123456)
+        self.assertEqual([row[2] for row in rows], [1.5, -2.25, 45.125])
+
+    def test_unpack(self):
+        ids = np.arange(3)
+        ts = np.array([1_700_000_000_123_456_000, 1_700_000_000_223_456_000, 946_684_800 * 10**9])
+        rows = unpack_copy(pack_copy(ids, ts, [1.5, -2.25, 45.125]))
+        self.assertEqual(rows["id"].tolist(), ids.tolist())
+        self.assertEqual(rows["t"].tolist(), ts.tolist())
+        self.assertEqual(rows["v"].tolist(), [1.5, -2.25, 45.125])
+        self.assertEqual(len(unpack_copy(pack_copy([], [], []))), 0)
+
+
+class NotifiedIdsTestCase(unittest.TestCase):
+    def test_payloads(self):
+        self.assertEqual(notified_ids("42"), (42, 42))
+        self.assertEqual(notified_ids("100,10099,10000"), (100, 10099))
+
+
+class PackedPayloadsTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        n = 1000
+        ids = np.arange(5, 5 + n)
+        ts = 1_700_000_000 * 10**9 + np.arange(n) * 1_000_000
+        vals = np.linspace(-10, 10, n).astype(np.float32)
+        payloads = pack_payloads(ids, ts, vals)
+        self.assertEqual(len(payloads), -(-n // PACKED_ROWS_MAX))
+        self.assertTrue(all(len(payload.encode()) < 8000 for payload in payloads))
+        rows = unpack_payloads(payloads)
+        self.assertEqual(rows["id"].tolist(), ids.tolist())
+        self.assertEqual(rows["t"].tolist(), ts.tolist())
+        self.assertEqual(rows["v"].tolist(), vals.tolist())
+
+
+class BatchWriterTestCase(unittest.IsolatedAsyncioTestCase):
+    class Connection:
+        """just enough of a psycopg connection for a BatchWriter, whose next `fail` transactions fail"""
+
+        def __init__(self):
+            self.fail = 0
+            self.next_id = 1
+            self.copied = []
+
+        @contextlib.asynccontextmanager
+        async def transaction(self):
+            if self.fail > 0:
+                self.fail -= 1
+                raise ConnectionError("The database went away")
+            yield
+
+        @contextlib.asynccontextmanager
+        async def cursor(self):
+            yield self
+
+        @contextlib.asynccontextmanager
+        async def copy(self, query):
+            yield self
+
+        async def write(self, data):
+            self.copied.append(unpack_copy(data))
+
+        async def execute(self, query, params=None):
+            if "nextval" in query:
+                self.ids = list(range(self.next_id, self.next_id + params[1]))
+                self.next_id += params[1]
+
+        async def fetchall(self):
+            return [(i,) for i in self.ids]
+
+        async def fetchone(self):
+            return (1,)
+
+    async def test_failed_flush(self):
+        conn = self.Connection()
+        bw = BatchWriter(DBTool(), conn, max_rows=3, max_age=10)
+        conn.fail = 1
+        with self.assertRaises(ConnectionError):
+            await bw.add([1, 2, 3], [1.0, 2.0, 3.0])
+        self.assertEqual(bw.n_buffered, 3)  # still there for the next go
+        await bw.add([4], [4.0])
+        self.assertEqual((bw.n_buffered, bw.n_written), (0, 4))
+        self.assertEqual(conn.copied[0]["v"].tolist(), [1.0, 2.0, 3.0, 4.0])
+        await bw.close()
+
+    async def test_failed_timed_flush(self):
+        conn = self.Connection()
+        bw = BatchWriter(DBTool(), conn, max_rows=100, max_age=0.01)
+        conn.fail = 1
+        await bw.add([1], [1.0])
+        await asyncio.sleep(0.05)
+        with self.assertRaises(ConnectionError):  # the next add hears about it
+            await bw.add([2], [2.0])
+        await bw.add([2], [2.0])
+        await bw.close()
+        self.assertEqual(bw.n_written, 2)
+        self.assertEqual(np.concatenate(conn.copied)["v"].tolist(), [1.0, 2.0])
+
+
+class BackfillTestCase(unittest.IsolatedAsyncioTestCase):
+    class Table(DBTool):
+        """a DBTool whose range queries are answered from an array instead of a database"""
+
+        def __init__(self, rows):
+            super().__init__(db_uri="postgresql://nobody@nowhere/nothing")
+            self.table = rows
+            self.queries = []
+            self._fill_conn = type("Connection", (), {"closed": False})()
+
+        async def fetch_since(self, conn, tbl, last_id, before_id=None):
+            self.queries.append((last_id, before_id))
+            rows = self.table[self.table["id"] > last_id]
+            if before_id is not None:
+                rows = rows[rows["id"] < before_id]
+            return rows
+
+        async def fetch_dicts_since(self, conn, tbl, last_id, before_id=None):
+            return [{"id": int(row["id"]), "v": float(row["v"])} for row in await self.fetch_since(conn, tbl, last_id, before_id)]
+
+    class Notify:
+        def __init__(self, channel, payload):
+            self.channel = channel
+            self.payload = payload
+
+    class Cursor:
+        async def execute(self, query):
+            pass
+
+    @staticmethod
+    def rows(ids):
+        rows = np.zeros(len(ids), dtype=ROWS_DTYPE)
+        rows["id"] = ids
+        rows["v"] = ids
+        return rows
+
+    def test_has_gap(self):
+        self.assertFalse(has_gap(4, np.array([5, 6, 7])))
+        self.assertFalse(has_gap(4, np.array([3, 4, 5, 5, 6])))
+        self.assertTrue(has_gap(4, np.array([5, 7])))
+        self.assertTrue(has_gap(4, np.array([6])))
+
+    async def test_splice(self):
+        dbt = self.Table(self.rows(np.arange(1, 21)))
+        dbt.deliver("tbl", self.rows([1, 2, 3]))
+        await dbt.splice("tbl", self.rows([5, 6, 9, 10]))  # 4, 7 and 8 never got notified
+        dbt.deliver("tbl", self.rows([10, 11]))  # 10 again
+        got = [dbt.outq.get_nowait() for i in range(dbt.outq.qsize())]
+        self.assertEqual(np.concatenate([batch["rows"]["id"] for batch in got]).tolist(), list(range(1, 12)))
+        self.assertEqual(dbt.queries, [(3, 9)])
+        self.assertEqual(dbt.backfilled, 3)
+        self.assertEqual(dbt.last_ids["tbl"], 11)
+
+    async def test_ingesting_listener_fails(self):
+        class Broken(self.Table):
+            async def latest_id(self, conn, tbl):
+                return 0
+
+            async def notifications(self, channels, listening=None):
+                raise ValueError("Not a notification")
+                yield
+
+        dbt = Broken(self.rows([]))
+        with self.assertRaises(ValueError):  # instead of waiting forever for notifications that won't come
+            await asyncio.wait_for(dbt.ingesting(None, ["tbl"]), 1)
+
+    async def test_listening_order(self):
+        Notify = self.Notify
+
+        class Connection:
+            async def commit(self):
+                pass
+
+            async def notifies(self):
+                yield Notify("tbl", pack_payloads([1, 2], [0, 0], [1, 2])[0])
+                yield Notify("tbl", json.dumps({"event": "a"}))
+                await asyncio.sleep(0)
+                yield Notify("tbl", pack_payloads([6], [0], [6])[0])  # 4 and 5 never got notified
+                yield Notify("tbl", json.dumps({"event": "b"}))
+
+        dbt = self.Table(self.rows([1, 2, 4, 5, 6]))
+        dbt.listen_channels = ["tbl"]
+        await dbt.new_listening(Connection(), self.Cursor())
+        while dbt.outq.qsize() < 4:
+            await asyncio.sleep(0.01)
+        got = [dbt.outq.get_nowait() for i in range(dbt.outq.qsize())]
+        self.assertEqual([item["rows"]["id"].tolist() if "rows" in item else item["event"] for item in got], [[1, 2], "a", [4, 5, 6], "b"])
+
+    async def test_listening_json_gap(self):
+        Notify = self.Notify
+
+        class Connection:
+            async def commit(self):
+                pass
+
+            async def notifies(self):
+                yield Notify("evs", json.dumps({"id": 1, "eid": 7, "v": 1.0}))
+                yield Notify("evs", json.dumps({"id": 2, "eid": 7, "v": 2.0}))
+                yield Notify("evs", json.dumps({"id": 5, "eid": 8, "v": 5.0}))  # 3 and 4 never got notified
+                yield Notify("evs", json.dumps({"event": "a"}))
+                yield Notify("evs", json.dumps({"id": 5, "eid": 8, "v": 5.5}))  # an update
+
+        dbt = self.Table(self.rows([1, 2, 3, 4, 5]))
+        dbt.listen_channels = ["evs"]
+        dbt.channel_tables = {"evs": "s.evs"}
+        await dbt.new_listening(Connection(), self.Cursor())
+        while dbt.outq.qsize() < 7:
+            await asyncio.sleep(0.01)
+        got = [dbt.outq.get_nowait() for i in range(dbt.outq.qsize())]
+        self.assertEqual([item.get("id", item.get("event")) for item in got], [1, 2, 3, 4, 5, "a", 5])
+        self.assertEqual([item["v"] for item in got if "v" in item], [1.0, 2.0, 3.0, 4.0, 5.0, 5.5])
+        self.assertEqual(dbt.queries, [(2, 5)])
+        self.assertEqual(dbt.backfilled, 2)
+        self.assertEqual(dbt.last_event_ids, {("evs", 7): 2, ("evs", 8): 5})
+
+    async def test_listening_reconnects(self):
+        Notify = self.Notify
+
+        class Lost:
+            closed = False
+
+            async def commit(self):
+                pass
+
+            async def notifies(self):
+                yield Notify("tbl", pack_payloads([1, 2], [0, 0], [1, 2])[0])
+                yield Notify("evs", json.dumps({"id": 1, "v": 1.0}))
+                await asyncio.sleep(0)
+                raise psycopg.OperationalError("Connection lost")
+
+        class Remade(Lost):
+            async def notifies(self):
+                yield Notify("evs", json.dumps({"id": 3, "v": 3.0}))
+
+            def cursor(self):
+                return BackfillTestCase.Cursor()
+
+            async def close(self):
+                self.closed = True
+
+        class Reconnecting(self.Table):
+            reconnect_delay = 0.0
+
+            async def connect(self):
+                self.remade = Remade()
+                return self.remade
+
+        dbt = Reconnecting(self.rows([1, 2, 3, 4]))
+        dbt.listen_channels = ["tbl", "evs"]
+        await dbt.new_listening(Lost(), self.Cursor())
+        while dbt.outq.qsize() < 7:
+            await asyncio.sleep(0.01)
+        got = [dbt.outq.get_nowait() for i in range(dbt.outq.qsize())]
+        self.assertEqual([item["rows"]["id"].tolist() for item in got if "rows" in item], [[1, 2], [3, 4]])  # 3 and 4 went in while it was gone
+        self.assertEqual([item["id"] for item in got if "id" in item], [1, 2, 3, 4, 3])  # and 2, 3 and 4 for evs, before 3 as notified
+        self.assertTrue(dbt.remade.closed)
@@ -1,8 +1,29 @@
 import unittest
 from livechart.lib import Datagetter
 from livechart.lib import Downsampler
+from livechart.lib import RingBuffer
+from livechart.lib import Decimator
+from livechart.lib import FrameParser
+from livechart.lib import pack_frame
+from livechart.lib import pack_gap
+from livechart.lib import pack_compressed_frame
+from livechart.lib import TIER_DTYPE
+from livechart.lib import GorillaEncoder
+from livechart.lib import GorillaDecoder
+from livechart.lib import RECORD_DTYPE
+from livechart.lib import ShmRingReader
+from livechart.lib import Pacer
+from livechart.lib import ThermalSampler
+from livechart.lib import DataStream
+from livechart.db import ThermalSource
+import tempfile
+import os
+from livechart.db import RandomSource
+import asyncio
+import time
 import statistics
 import math
+import numpy as np
 
 
 class DatagetterTestCase(unittest.TestCase):
@@ -48,3 +69,245 @@ class DownsamplerTestCase(unittest.TestCase):
             else:
                 self.assertTrue(math.isnan(ds.feed(sample)))
         self.assertEqual(statistics.mean(sequence), ds.feed(sequence[-1]))
+
+
+class PacerTestCase(unittest.TestCase):
+    def test_no_drift(self):
+        """a sample that takes too long doesn't push back the ones after it"""
+        pacer = Pacer(0.01)
+        t0 = time.monotonic()
+        for i in range(20):
+            pacer.wait_sync()
+            pacer.take(1)
+            if i == 5:
+                time.sleep(0.03)  # late by three samples
+        self.assertAlmostEqual(time.monotonic() - t0, 0.19, delta=0.02)
+
+    def test_unpaced(self):
+        """with no period, samples are stamped when they're taken"""
+        pacer = Pacer(0)
+        first = pacer.take(1)[0]
+        time.sleep(0.002)
+        self.assertEqual(pacer.wait_sync(), 1)
+        self.assertGreater(pacer.take(1)[0], first)
+        self.assertEqual(pacer.n, 2)
+
+    def test_batches(self):
+        """many samples per wake up, on an even schedule"""
+
+        async def run():
+            n_wakes = 0
+            async with RandomSource(artificial_delay=1e-5) as source:
+                t0 = time.monotonic()
+                tss = []
+                async for ts, vals in source:
+                    self.assertEqual(len(ts), len(vals))
+                    tss.append(ts)
+                    n_wakes += 1
+                    if time.monotonic() - t0 > 0.2:
+                        break
+            return np.concatenate(tss), n_wakes
+
+        ts, n_wakes = asyncio.run(run())
+        self.assertLess(n_wakes, len(ts) / 5)
+        self.assertTrue(np.all(np.diff(ts) > 0))
+        self.assertEqual(np.median(np.diff(ts)), 10**4)
+        self.assertGreater(len(ts), 0.2 / 1e-5 * 0.5)  # delivered, not just scheduled, loose for loaded machines
+
+
+class DataStreamTestCase(unittest.TestCase):
+    def test_random(self):
+        async def run():
+            batches = []
+            async with DataStream(rate=1000) as stream:
+                async for ts, vals in stream:
+                    batches.append((ts, vals))
+                    if len(batches) == 20:
+                        break
+                n_scheduled = stream.pacer.n - stream.pacer.skipped
+            with self.assertRaises(StopAsyncIteration):
+                await stream.__anext__()
+            return batches, n_scheduled
+
+        batches, n_scheduled = asyncio.run(run())
+        ts = np.concatenate([ts for ts, vals in batches])
+        vals = np.concatenate([vals for ts, vals in batches])
+        self.assertEqual(vals.dtype, np.float64)
+        self.assertEqual(len(ts), len(vals))
+        self.assertEqual(len(ts), n_scheduled)  # every sample that came due, each one once
+        self.assertTrue(np.all(np.diff(ts) > 0))
+        self.assertTrue(np.all(np.diff(ts) % 10**6 == 0))  # on the 1 ms schedule, however late they got handed out
+
+    def test_bad_dtype(self):
+        with self.assertRaises(ValueError):
+            DataStream("bogus")
+
+
+class ThermalSamplerTestCase(unittest.TestCase):
+    def setUp(self):
+        """a fake sysfs"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        files = {
+            "class/thermal/thermal_zone10/temp": "30000\n",
+            "class/thermal/thermal_zone10/type": "acpitz\n",
+            "class/thermal/thermal_zone2/temp": "-1500\n",
+            "class/thermal/thermal_zone2/type": "x86_pkg_temp\n",
+            "class/thermal/thermal_zone0/temp": "",
+            "class/hwmon/hwmon1/temp1_input": "51000\n",
+            "class/hwmon/hwmon1/temp1_label": "Package id 0\n",
+            "class/hwmon/hwmon1/name": "coretemp\n",
+        }
+        for path, content in files.items():
+            os.makedirs(os.path.join(self.root, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(self.root, path), "w") as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read(self):
+        with ThermalSampler(root=self.root) as sampler:
+            self.assertEqual(sampler.sensors, ["thermal0", "thermal2", "thermal10", "hwmon1/temp1"])
+            self.assertEqual(sampler.names, {"thermal0": None, "thermal2": "x86_pkg_temp", "thermal10": "acpitz", "hwmon1/temp1": "coretemp Package id 0"})
+            np.testing.assert_array_equal(sampler.read(), [np.nan, -1.5, 30.0, 51.0])
+            with open(os.path.join(self.root, "class/thermal/thermal_zone10/temp"), "w") as f:
+                f.write("123456\n")
+            np.testing.assert_array_equal(sampler.read(), [np.nan, -1.5, 123.456, 51.0])
+
+    def test_source(self):
+        async def run():
+            async with ThermalSource(thermal_zone=2, artificial_delay=0.001, root=self.root) as source:
+                return source.thermaltype, await source.get_many(3)
+
+        thermaltype, (ts, vals) = asyncio.run(run())
+        self.assertEqual(thermaltype, "x86_pkg_temp")
+        self.assertEqual(list(vals), [-1.5] * 3)
+
+    def test_stream(self):
+        async def run():
+            batches = []
+            async with DataStream("thermal", zone="hwmon1/temp1", rate=1000, root=self.root) as stream:
+                self.assertTrue(stream.in_executor)
+                async for ts, vals in stream:
+                    batches.append(vals)
+                    if len(batches) == 3:
+                        break
+                return stream.thermaltype, np.concatenate(batches)
+
+        thermaltype, vals = asyncio.run(run())
+        self.assertEqual(thermaltype, "coretemp Package id 0")
+        self.assertTrue(np.all(vals == 51.0))
+
+    def test_stream_cancelled(self):
+        """closing a stream waits for a read that's still going in the executor"""
+
+        class SlowStream(DataStream):
+            def _read(self, n):
+                time.sleep(0.05)
+                self.got = super()._read(n)
+                return self.got
+
+        async def run():
+            async with SlowStream("thermal", zone=2, rate=1000, root=self.root, in_executor=True) as stream:
+                reading = asyncio.create_task(stream.__anext__())
+                await asyncio.sleep(0.02)
+                reading.cancel()
+            return stream.got
+
+        ts, vals = asyncio.run(run())
+        self.assertTrue(np.all(vals == -1.5))
+
+    def test_missing(self):
+        with ThermalSampler(["thermal2", "thermal3"], root=self.root) as sampler:
+            self.assertEqual(sampler.missing, ["thermal3"])
+            np.testing.assert_array_equal(sampler.read(), [-1.5, np.nan])
+
+
+class RingBufferTestCase(unittest.TestCase):
+    def test_wrap(self):
+        rb = RingBuffer(capacity=4)
+        rb.write([0, 1, 2])
+        rb.write([3, 4, 5])
+        self.assertEqual(rb.head, 6)
+        self.assertEqual(rb.tail, 2)
+        self.assertEqual(rb.read(0).tolist(), [2, 3, 4, 5])
+        self.assertEqual(rb.read(3, 5).tolist(), [3, 4])
+
+    def test_bisect(self):
+        rb = RingBuffer(capacity=4, dtype="<i8")
+        rb.write([10, 20, 30])
+        rb.write([40, 50])  # wrapped, holds [20, 30, 40, 50]
+        self.assertEqual([rb.bisect(v) for v in (0, 20, 35, 50, 99)], [1, 1, 3, 4, 5])
+
+    def test_shared(self):
+        rb = RingBuffer(capacity=4, dtype="<f8", shared=True)
+        reader = ShmRingReader(rb.shm.name, 4, "<f8")
+        rb.write([0, 1, 2, 3, 4])
+        self.assertEqual(reader.head, 5)
+        self.assertEqual(reader.read(2, 5).tolist(), [2, 3, 4])
+        self.assertIsNone(reader.read(0, 2))
+        reader.close()
+        rb.close()
+
+    def test_oversized_write(self):
+        rb = RingBuffer(capacity=4)
+        rb.write(range(10))
+        self.assertEqual(rb.read(rb.tail).tolist(), [6, 7, 8, 9])
+
+
+class DecimatorTestCase(unittest.TestCase):
+    def test_buckets(self):
+        dec = Decimator(period=1.0)
+        s = 1_000_000_000  # ns
+        out = dec.feed([s // 10, s // 2, 12 * s // 10], [1, 3, 5])
+        self.assertEqual(out.tolist(), [(0, 1, 3, 2)])
+        out = dec.feed([16 * s // 10, 21 * s // 10, 35 * s // 10], [7, 0, 4])
+        self.assertEqual(out.tolist(), [(s, 5, 7, 6), (2 * s, 0, 0, 0)])
+        self.assertEqual(len(dec.feed([39 * s // 10], [1])), 0)
+
+
+class FrameParserTestCase(unittest.TestCase):
+    def test_chunks(self):
+        recs = np.zeros(3, dtype=RECORD_DTYPE)
+        recs["t"] = [1, 2, 3]
+        recs["v"] = [0.1, 0.2, 0.3]
+        stream = b"junk" + pack_frame(0, recs, dtype=RECORD_DTYPE) + pack_gap(3, 5, dtype=RECORD_DTYPE) + pack_frame(8, recs[:1], dtype=RECORD_DTYPE)
+        fp = FrameParser()
+        frames = []
+        for i in range(0, len(stream), 7):
+            frames += fp.feed(stream[i : i + 7])
+        self.assertEqual([f[0][3] for f in frames], [0, 3, 8])
+        self.assertEqual(frames[0][1]["v"].tolist(), [0.1, 0.2, 0.3])
+        self.assertEqual(frames[2][1]["t"].tolist(), [1])
+
+    def test_compressed(self):
+        buckets = np.zeros(50, dtype=TIER_DTYPE)
+        buckets["t"] = np.arange(50) * 10**7
+        buckets["min"] = np.linspace(-1, 1, 50)
+        buckets["max"] = buckets["min"] + 0.5
+        buckets["mean"] = np.nan
+        frame = pack_compressed_frame(7, buckets, dtype=TIER_DTYPE)
+        self.assertLess(len(frame), buckets.nbytes)
+        ((header, vals),) = FrameParser().feed(frame)
+        self.assertEqual(header[3], 7)
+        self.assertEqual(vals.tobytes(), buckets.tobytes())
+
+
+class GorillaTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        ts = 1_700_000_000 * 10**9 + np.arange(3000) * 10**6
+        ts[1000:1100] += rng.integers(-(10**5), 10**5, 100)  # a jittery patch
+        vals = np.round(45000 + np.cumsum(rng.normal(0, 0.3, 3000)))  # millidegrees
+        vals[2000:2003] = [np.nan, -np.inf, -0.0]
+        encoder = GorillaEncoder()
+        decoder = GorillaDecoder()
+        n_bytes = 0
+        for chunk in np.array_split(np.arange(3000), 7):
+            packed = encoder.encode(ts[chunk], vals[chunk])
+            n_bytes += len(packed)
+            got_ts, got_vals = decoder.decode(packed, len(chunk))
+            self.assertEqual(got_ts.tolist(), ts[chunk].tolist())
+            self.assertEqual(got_vals.view(np.uint64).tolist(), vals[chunk].view(np.uint64).tolist())
+        self.assertLess(n_bytes * 8 / 3000, 8)  # bits per sample
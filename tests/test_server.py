@@ -1,20 +1,576 @@
 import unittest
+import asyncio
+import json
+import struct
+import socket
 from livechart.server import LiveServer
+from livechart.server import Source
+from livechart.server import Client
+from livechart.lib import DB_RAW_DTYPE
+from livechart.lib import RECORD_DTYPE
+from livechart.lib import FRAME_CODES
+from livechart.lib import read_frame
+from livechart.lib import pack_frame
+from livechart.lib import FLAG_GAP
+from livechart.lib import FLAG_DECIMATED
+from livechart.lib import FLAG_BACKLOG
+from livechart.lib import FLAG_DOORBELL
+from livechart.lib import FLAG_COMPRESSED
+from livechart.lib import FRAME_DTYPES
+from livechart.lib import ShmRingReader
+from livechart.lib import pack_control
+from livechart.lib import unpack_control
+from livechart.lib import is_control
+from livechart.lib import is_notice
+from livechart.lib import db_raw_dicts
+import tempfile
+import numpy as np
+import os
 
 
-class LiveServerTestCase(unittest.TestCase):
+class LiveServerTestCase(unittest.IsolatedAsyncioTestCase):
     def test_init(self):
         ls = LiveServer()
         self.assertIsInstance(ls, LiveServer)
 
-    def test_connect(self):
-        ls = LiveServer()
-        self.assertIsInstance(ls, LiveServer)
-        ls.connect()
+    async def test_connect(self):
+        async with LiveServer(host="127.0.0.1", port=0) as ls:
+            self.assertIsInstance(ls, LiveServer)
+            reader, writer = await asyncio.open_connection(ls.host, ls.port)
+            while len(ls.clients) == 0:
+                await asyncio.sleep(0.01)
+            writer.close()
 
-    def test_run(self):
-        runtime = 5  # seconds
-        ls = LiveServer()
-        self.assertIsInstance(ls, LiveServer)
-        ls.connect()
-        ls.run(timeout=runtime)
+    async def test_run(self):
+        runtime = 1  # seconds
+        async with LiveServer(host="127.0.0.1", port=0) as ls:
+            self.assertIsInstance(ls, LiveServer)
+            tasks = asyncio.gather(ls.run(), ls.datasource())
+            reader, writer = await asyncio.open_connection(ls.host, ls.port)
+            msg = json.dumps({"framed": True}).encode()
+            writer.write(f"{len(msg)}".encode() + msg)
+            n_got = 0
+            t_end = asyncio.get_running_loop().time() + runtime
+            while asyncio.get_running_loop().time() < t_end:
+                (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+                n_got += count
+            self.assertGreater(n_got, 0)
+            writer.close()
+            tasks.cancel()
+            try:
+                await tasks
+            except asyncio.CancelledError:
+                pass
+
+
+class LiveServerFramingTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.ls = LiveServer(host="127.0.0.1", port=0, ring_size=4)
+        await self.ls.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.ls.__aexit__(None, None, None)
+
+    async def connect(self, cmd: dict):
+        reader, writer = await asyncio.open_connection(self.ls.host, self.ls.port)
+        msg = json.dumps(cmd).encode()
+        writer.write(f"{len(msg)}".encode() + msg)
+        await writer.drain()
+        while len(self.ls.clients) == 0:
+            await asyncio.sleep(0.01)
+        return reader, writer
+
+    async def test_compressed(self):
+        reader, writer = await self.connect({"framed": True, "compression": 1})
+        reader2, writer2 = await self.connect({"framed": True, "compression": 1})
+        while not all(client.compression for client in self.ls.clients.values()) or len(self.ls.clients) < 2:
+            await asyncio.sleep(0.01)
+        self.ls.putter([0.5, 1.5, 2.5], ts=[10, 20, 30])
+        for r in (reader, reader2):
+            (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(r), 1)
+            self.assertTrue(flags & FLAG_COMPRESSED)
+            self.assertEqual(vals.tolist(), [(10, 0.5), (20, 1.5), (30, 2.5)])
+        self.assertEqual(len(self.ls.sources["random"].compressed), 1)  # packed once for both
+        writer.close()
+        writer2.close()
+
+    async def test_resume(self):
+        reader, writer = await self.connect({"framed": True})
+        while not list(self.ls.clients.values())[0].framed:
+            await asyncio.sleep(0.01)
+        self.ls.putter([0.5, 1.5])
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        last = seq + count - 1
+        writer.close()
+        while len(self.ls.clients) > 0:
+            await asyncio.sleep(0.01)
+        self.ls.putter([2.5, 3.5])  # missed while disconnected
+        reader, writer = await self.connect({"framed": True, "resume": {"random": last}, "epoch": self.ls.epoch})
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual((seq, flags, vals["v"].tolist()), (2, 0, [2.5, 3.5]))
+        writer.close()
+        while len(self.ls.clients) > 0:
+            await asyncio.sleep(0.01)
+        self.ls.putter([4.5, 5.5, 6.5, 7.5, 8.5])  # more than the ring holds
+        reader, writer = await self.connect({"framed": True, "resume": {"random": 3}, "epoch": self.ls.epoch})
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual((flags, seq, count), (FLAG_GAP, 4, 1))
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual((seq, vals["v"].tolist()), (5, [5.5, 6.5, 7.5, 8.5]))
+        writer.close()
+
+    async def test_resume_other_epoch(self):
+        self.ls.putter([0.5, 1.5, 2.5])
+        reader, writer = await self.connect({"framed": True, "resume": {"random": 0}, "epoch": "someone else"})
+        description = json.loads(await asyncio.wait_for(reader.readline(), 1))
+        self.assertEqual(description["epoch"], self.ls.epoch)
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertTrue(flags & FLAG_BACKLOG)
+        self.assertEqual((seq, vals["v"].tolist()), (0, [0.5, 1.5, 2.5]))  # all of it, not from seq 1
+        writer.close()
+
+    async def test_framed(self):
+        reader, writer = await self.connect({"framed": True})
+        while not list(self.ls.clients.values())[0].framed:
+            await asyncio.sleep(0.01)
+        self.ls.putter([0.5, 1.5, 2.5])
+        self.ls.putter([3.5])
+        n_got = 0
+        while n_got < 4:
+            (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+            self.assertEqual(seq, n_got)
+            self.assertEqual(len(vals), count)
+            self.assertEqual(vals["v"].tolist(), [0.5, 1.5, 2.5, 3.5][seq : seq + count])
+            n_got += count
+        writer.close()
+
+    async def test_gap(self):
+        reader, writer = await self.connect({"framed": True})
+        while not list(self.ls.clients.values())[0].framed:
+            await asyncio.sleep(0.01)
+        self.ls.putter(list(range(10)))
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertTrue(flags & FLAG_GAP)
+        self.assertEqual((seq, count), (0, 6))
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual(seq, 6)
+        self.assertEqual(vals["v"].tolist(), [6, 7, 8, 9])
+        writer.close()
+
+    async def test_drop_oldest(self):
+        reader, writer = await self.connect({"framed": True, "policy": "drop-oldest", "max_lag": 2})
+        client = list(self.ls.clients.values())[0]
+        while client.max_lag != 2:
+            await asyncio.sleep(0.01)
+        self.ls.putter(list(range(3)))
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertTrue(flags & FLAG_GAP)
+        self.assertEqual((seq, count), (0, 1))
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual(vals["v"].tolist(), [1, 2])
+        self.assertEqual(client.shed, 1)
+        writer.close()
+
+    async def test_decimate(self):
+        reader, writer = await self.connect({"framed": True, "policy": "decimate", "max_lag": 2})
+        client = list(self.ls.clients.values())[0]
+        while client.max_lag != 2:
+            await asyncio.sleep(0.01)
+        self.ls.putter(list(range(4)))
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertTrue(flags & FLAG_DECIMATED)
+        self.assertEqual(vals["v"].tolist(), [0, 2])
+        self.assertEqual(client.shed, 2)
+        writer.close()
+
+    async def test_tier(self):
+        reader, writer = await self.connect({"framed": True, "tier": "1Hz"})
+        client = list(self.ls.clients.values())[0]
+        while client.tier != "1Hz":
+            await asyncio.sleep(0.01)
+        self.ls.putter([1, 2, 3, 10], ts=[100_100_000_000, 100_200_000_000, 100_900_000_000, 101_500_000_000])
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual(vals.tolist(), [(100_000_000_000, 1, 3, 2)])
+        writer.close()
+
+    async def test_backlog(self):
+        self.ls.putter([0.0, 1.0, 2.0, 3.0], ts=[10_000_000_000, 11_000_000_000, 12_000_000_000, 13_000_000_000])
+        reader, writer = await self.connect({"framed": True, "history_seconds": 1.5})
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertTrue(flags & FLAG_BACKLOG)
+        self.assertEqual(seq, 2)
+        self.assertEqual(vals["t"].tolist(), [12_000_000_000, 13_000_000_000])
+        self.assertEqual(vals["v"].tolist(), [2.0, 3.0])
+        self.ls.putter([4.0])
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertFalse(flags & FLAG_BACKLOG)
+        self.assertEqual((seq, vals["v"].tolist()), (4, [4.0]))
+        writer.close()
+
+    async def test_unframed(self):
+        reader, writer = await self.connect({})
+        self.ls.putter([0.5, 1.5])
+        raw = await asyncio.wait_for(reader.readexactly(8), 1)
+        self.assertEqual(struct.unpack("2f", raw), (0.5, 1.5))
+        writer.close()
+
+
+class LiveServerPolicyTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_disconnect_stalled(self):
+        """a client that never reads gets hung up on after max_behind, even though its writes never finish"""
+        async with LiveServer(host="127.0.0.1", port=0, ring_size=2**12, max_lag=16) as ls:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.connect((ls.host, ls.port))
+            reader, writer = await asyncio.open_connection(sock=sock)
+            msg = json.dumps({"framed": True, "policy": "disconnect", "max_behind": 0.2}).encode()
+            writer.write(f"{len(msg)}".encode() + msg)
+            await writer.drain()
+            while not ls.clients or list(ls.clients.values())[0].policy.value != "disconnect":
+                await asyncio.sleep(0.01)
+            list(ls.clients.values())[0].writer.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            for i in range(300):
+                ls.putter(list(range(1000)))
+                await asyncio.sleep(0.01)
+                if not ls.clients:
+                    break
+            self.assertEqual(len(ls.clients), 0)
+            writer.close()
+
+
+class LiveServerSourcesTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_untimed_backlog(self):
+        """history_seconds limits the backlog of sources whose samples have no ns timestamps, by when they got here"""
+        source = Source("notify:raw", 0, 64, {"raw": None}, dtype=DB_RAW_DTYPE)
+        source.put_records(np.zeros(5, dtype=DB_RAW_DTYPE))
+        await asyncio.sleep(0.3)
+        source.put_records(np.zeros(2, dtype=DB_RAW_DTYPE))
+        self.assertEqual(source.backlog_start("raw", seconds=0.1), 5)
+        self.assertEqual(source.backlog_start("raw", seconds=10), 0)
+        source.close()
+
+    async def test_lapped_backlog(self):
+        """a worker's backlog of a shared ring that the producing process laps while it's being read"""
+        producer = Source("random", 0, 4, {"raw": None}, shared=True)
+        producer.put(np.arange(4.0), np.arange(4) * 10**9)
+        source = Source.attach("random", 0, {"raw": (producer.rings["raw"].shm.name, 4, FRAME_CODES[RECORD_DTYPE])})
+        ring = source.rings["raw"]
+
+        def lapping_read(start, stop=None):
+            del ring.read  # just the once
+            producer.put(np.arange(4.0, 6.0), np.arange(4, 6) * 10**9)
+            return ring.read(start, stop)
+
+        ring.read = lapping_read
+        self.assertEqual(source.backlog_start("raw", seconds=60), 2)
+        ring.read = lapping_read
+        sent = []
+        client = Client(None, type("Writer", (), {"write": lambda self, data: sent.append(data)})(), history_seconds=60)
+        client.framed = True
+        client.cursors["random"] = ring.head
+        self.ls.sources["random"], source = source, self.ls.sources["random"]
+        self.ls.send_backlog(client, ["random"])
+        self.ls.sources["random"], source = source, self.ls.sources["random"]
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(sent))
+        reader.feed_eof()
+        (dtype, flags, stream, seq, count), vals = await read_frame(reader)
+        self.assertEqual((seq, vals["v"].tolist()), (4, [4.0, 5.0]))
+        source.close()
+        producer.close()
+
+    async def asyncSetUp(self):
+        self.ls = LiveServer(host="127.0.0.1", port=0, sources=["random", "thermal3"])
+        await self.ls.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.ls.__aexit__(None, None, None)
+
+    async def test_subscribe(self):
+        reader, writer = await asyncio.open_connection(self.ls.host, self.ls.port)
+        msg = json.dumps({"framed": True, "subscribe": ["thermal3"]}).encode()
+        writer.write(f"{len(msg)}".encode() + msg)
+        reply = json.loads(await asyncio.wait_for(reader.readline(), 1))
+        self.assertEqual(reply, {"streams": {"thermal3": 1}, "epoch": self.ls.epoch})
+        self.ls.putter([1.0], source="random")
+        self.ls.putter([2.0], source="thermal3")
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual(stream, 1)
+        self.assertEqual(vals["v"].tolist(), [2.0])
+        self.assertEqual(len(self.ls.sources["random"].subscribers), 0)
+        writer.close()
+
+
+class LiveServerDatasourceTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_failing_source(self):
+        """a source that can't run doesn't take the others down with it"""
+        async with LiveServer(host="127.0.0.1", port=0, sources=["db:nowhere", "random"], db_uri="postgresql://nobody@127.0.0.1:1/nothing") as ls:
+            datasource = asyncio.create_task(ls.datasource())
+            await asyncio.sleep(0.2)
+            self.assertFalse(datasource.done())
+            self.assertGreater(ls.sources["random"].rings["raw"].head, 0)
+            datasource.cancel()
+
+
+class LiveServerControlTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.ls = LiveServer(host="127.0.0.1", port=0, sources=["thermal0", "thermal3"], history_samples=0)
+        await self.ls.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.ls.__aexit__(None, None, None)
+
+    async def command(self, reader, writer, seq, cmd):
+        writer.write(pack_control(seq, cmd))
+        while True:
+            header, vals = await asyncio.wait_for(read_frame(reader), 1)
+            if is_control(header):
+                self.assertEqual(header[3], seq)
+                return unpack_control(vals)
+
+    async def test_handshake(self):
+        reader, writer = await asyncio.open_connection(self.ls.host, self.ls.port)
+        reply = await self.command(reader, writer, 1, {"hello": {"version": 1, "caps": ["batch", "subscriptions", "bogus"]}, "thermaltype": True})
+        self.assertTrue(reply["ok"])
+        self.assertEqual(reply["caps"], ["batch", "subscriptions"])
+        self.assertEqual(reply["streams"], {"thermal0": 0})
+        self.assertIn("thermal0", reply["thermaltype"])
+        reply = await self.command(reader, writer, 2, {"zone": 3})
+        self.assertEqual((reply["ok"], reply["streams"]), (True, {"thermal3": 1}))
+        reply = await self.command(reader, writer, 3, {"tier": "10Hz"})  # not negotiated
+        self.assertFalse(reply["ok"])
+        self.ls.putter([1.0, 2.0], source="thermal3")
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual((stream, vals["v"].tolist()), (1, [1.0, 2.0]))
+        writer.close()
+
+    async def test_bad_fields(self):
+        reader, writer = await asyncio.open_connection(self.ls.host, self.ls.port)
+        reply = await self.command(reader, writer, 1, {"hello": {"version": 1, "caps": ["subscriptions"]}})
+        self.assertTrue(reply["ok"])
+        for seq, cmd in enumerate([{"subscribe": 5}, {"max_lag": "x"}, {"resume": {"thermal0": "abc"}}, {"subscribe": [["thermal3"]]}], start=2):
+            reply = await self.command(reader, writer, seq, cmd)
+            self.assertFalse(reply["ok"])
+            self.assertEqual(len(reply["errors"]), 1)
+        reply = await self.command(reader, writer, 9, {"zone": 3})  # still taking commands
+        self.assertTrue(reply["ok"])
+        writer.close()
+        for i in range(100):
+            if not self.ls.clients:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.ls.clients, {})
+        self.assertFalse(any(source.subscribers for source in self.ls.sources.values()))
+
+    async def test_bad_version(self):
+        reader, writer = await asyncio.open_connection(self.ls.host, self.ls.port)
+        reply = await self.command(reader, writer, 7, {"hello": {"version": 99}})
+        self.assertFalse(reply["ok"])
+        self.assertEqual(await asyncio.wait_for(reader.read(), 1), b"")
+        writer.close()
+
+
+class LiveServerMetricsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_metrics(self):
+        async with LiveServer(host="127.0.0.1", port=0, metrics_port=0, history_samples=0) as ls:
+            reader, writer = await asyncio.open_connection(ls.host, ls.port)
+            msg = json.dumps({"framed": True}).encode()
+            writer.write(f"{len(msg)}".encode() + msg)
+            while not any(client.framed for client in ls.clients.values()):
+                await asyncio.sleep(0.01)
+            ls.putter([1.0, 2.0, 3.0])
+            await asyncio.wait_for(read_frame(reader), 1)
+            msg = json.dumps({"metrics": True}).encode()
+            writer.write(f"{len(msg)}".encode() + msg)
+            metrics = json.loads(await asyncio.wait_for(reader.readline(), 1))["metrics"]
+            self.assertEqual(metrics["sources"]["random"]["samples"], 3)
+            (client,) = metrics["clients"].values()
+            self.assertEqual(client["samples"], 3)
+            self.assertEqual(client["latency_us"]["count"], 1)
+            self.assertGreater(client["bytes"], 3 * 16)
+
+            m_reader, m_writer = await asyncio.open_connection(ls.metrics_host, ls.metrics_port)
+            m_writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = (await asyncio.wait_for(m_reader.read(), 1)).decode()
+            self.assertTrue(response.startswith("HTTP/1.0 200 OK"))
+            self.assertIn('livechart_source_samples_total{source="random"} 3', response)
+            m_writer.close()
+            writer.close()
+
+
+class LiveServerProxyTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_proxy(self):
+        notifications = asyncio.Queue()
+
+        async def fake_notifications():
+            while True:
+                yield await notifications.get()
+
+        async with LiveServer(host="127.0.0.1", port=0, sources=["notify:org_tbl_mppt_events", "notify:org_tbl_mppt_raw"], history_samples=0) as ls:
+            proxy = asyncio.create_task(ls.proxy(fake_notifications()))
+            reader, writer = await asyncio.open_connection(ls.host, ls.port)
+            writer.write(pack_control(1, {"hello": {"version": 1, "caps": ["batch", "subscriptions"]}, "subscribe": ["notify:org_tbl_mppt_events", "notify:org_tbl_mppt_raw"]}))
+            header, vals = await asyncio.wait_for(read_frame(reader), 1)
+            self.assertEqual(unpack_control(vals)["streams"], {"notify:org_tbl_mppt_events": 0, "notify:org_tbl_mppt_raw": 1})
+            notifications.put_nowait(("org_tbl_mppt_events", json.dumps({"id": 7, "run_id": 2, "device_id": 3, "complete": False})))
+            header, vals = await asyncio.wait_for(read_frame(reader), 1)
+            self.assertTrue(is_notice(header))
+            self.assertEqual(json.loads(vals.tobytes()), {"id": 7, "run_id": 2, "device_id": 3, "complete": False, "channel": "org_tbl_mppt_events"})
+            for i in range(3):
+                notifications.put_nowait(("org_tbl_mppt_raw", json.dumps({"eid": 7, "v": 0.5 * i, "i": 0.001, "t": 10.0 + i, "s": 1})))
+            notifications.put_nowait(("org_tbl_mppt_raw", "not json"))
+            notifications.put_nowait(("org_tbl_mppt_raw", json.dumps({"eid": 7, "v": 0.5, "i": 0.001, "t": "noon", "s": 1})))
+            notifications.put_nowait(("org_tbl_mppt_raw", json.dumps([1, 2])))
+            (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+            self.assertEqual((stream, count), (1, 3))  # the raw rows all went out together
+            self.assertEqual(db_raw_dicts(vals, "org_tbl_mppt_raw")[2], {"eid": 7, "v": 1.0, "i": 0.001, "t": 12.0, "s": 1, "channel": "org_tbl_mppt_raw"})
+            notifications.put_nowait(("org_tbl_mppt_raw", json.dumps({"eid": 8, "v": 0.5, "i": 0.001, "t": 13.0, "s": 1})))
+            (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+            self.assertEqual((seq, count), (3, 1))  # the bad ones were dropped, and the good ones still get through
+            writer.close()
+            proxy.cancel()
+
+
+class LiveServerLocalTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "livechart.sock")
+        self.ls = LiveServer(host="127.0.0.1", port=0, unix_path=self.path, shared=True, history_samples=0)
+        await self.ls.__aenter__()
+
+    async def asyncTearDown(self):
+        await self.ls.__aexit__(None, None, None)
+        self.tmpdir.cleanup()
+
+    async def test_unix_socket(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        msg = json.dumps({"framed": True}).encode()
+        writer.write(f"{len(msg)}".encode() + msg)
+        while not any(client.framed for client in self.ls.clients.values()):
+            await asyncio.sleep(0.01)
+        self.ls.putter([1.0, 2.0])
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertEqual(vals["v"].tolist(), [1.0, 2.0])
+        writer.close()
+
+    async def test_shared_memory(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        msg = json.dumps({"shm": True}).encode()
+        writer.write(f"{len(msg)}".encode() + msg)
+        description = json.loads(await asyncio.wait_for(reader.readline(), 1))
+        info = description["shm"]["random"]
+        shm_ring = ShmRingReader(info["name"], info["capacity"], FRAME_DTYPES[info["dtype"]])
+        self.ls.putter([1.0, 2.0, 3.0])
+        (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+        self.assertTrue(flags & FLAG_DOORBELL)
+        self.assertEqual(len(vals), 0)
+        self.assertEqual(shm_ring.read(seq, seq + count)["v"].tolist(), [1.0, 2.0, 3.0])
+        shm_ring.close()
+        writer.close()
+
+
+class LiveServerRelayTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_relay(self):
+        async with LiveServer(host="127.0.0.1", port=0, sources=["thermal0"]) as upstream:
+            async with LiveServer(host="127.0.0.1", port=0, sources=[f"relay:127.0.0.1:{upstream.port}/thermal0"]) as relay:
+                relay_task = asyncio.create_task(relay.datasource())
+                while not any(client.framed for client in upstream.clients.values()):
+                    await asyncio.sleep(0.01)
+                reader, writer = await asyncio.open_connection(relay.host, relay.port)
+                msg = json.dumps({"framed": True}).encode()
+                writer.write(f"{len(msg)}".encode() + msg)
+                while not any(client.framed for client in relay.clients.values()):
+                    await asyncio.sleep(0.01)
+                upstream.putter([1.0, 2.0], ts=[5, 6])
+                (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+                self.assertEqual(vals.tolist(), [(5, 1.0), (6, 2.0)])
+                writer.close()
+                relay_task.cancel()
+
+    async def test_relay_restarted_upstream(self):
+        """a garbled frame gets a fresh connection, and a new upstream epoch means its seqs have started over"""
+        replies = []
+
+        def records(*vals):
+            recs = np.zeros(len(vals), dtype=RECORD_DTYPE)
+            recs["v"] = vals
+            return recs
+
+        async def upstream(reader, writer):
+            await reader.readuntil(b"}")
+            epoch, frames = replies.pop(0)
+            writer.write(json.dumps({"streams": {"random": 0}, "epoch": epoch}).encode() + b"\n" + frames)
+            await writer.drain()
+
+        replies.append(("a", pack_frame(0, records(1.0, 2.0), dtype=RECORD_DTYPE, flags=FLAG_BACKLOG) + b"LC" + bytes(18)))
+        replies.append(("b", pack_frame(0, records(3.0), dtype=RECORD_DTYPE, flags=FLAG_BACKLOG)))
+        srv = await asyncio.start_server(upstream, host="127.0.0.1", port=0)
+        port = srv.sockets[0].getsockname()[1]
+        async with LiveServer(host="127.0.0.1", port=0, sources=[f"relay:127.0.0.1:{port}/random"]) as relay:
+            source = next(iter(relay.sources.values()))
+            relay_task = asyncio.create_task(relay.relay(source, retry_delay=0.01))
+            for i in range(100):
+                if source.rings["raw"].head >= 3:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(source.rings["raw"].read(0)["v"].tolist(), [1.0, 2.0, 3.0])
+            self.assertFalse(relay_task.done())
+            relay_task.cancel()
+        srv.close()
+
+    async def test_relay_gap(self):
+        async with LiveServer(host="127.0.0.1", port=0, sources=["thermal0"], max_lag=2) as upstream:
+            async with LiveServer(host="127.0.0.1", port=0, sources=[f"relay:127.0.0.1:{upstream.port}/thermal0"]) as relay:
+                relay_task = asyncio.create_task(relay.datasource())
+                while not any(client.framed for client in upstream.clients.values()):
+                    await asyncio.sleep(0.01)
+                reader, writer = await asyncio.open_connection(relay.host, relay.port)
+                msg = json.dumps({"framed": True}).encode()
+                writer.write(f"{len(msg)}".encode() + msg)
+                while not any(client.framed for client in relay.clients.values()):
+                    await asyncio.sleep(0.01)
+                upstream.putter([1.0, 2.0, 3.0, 4.0, 5.0], ts=[5, 6, 7, 8, 9])  # more than the relay may lag, so upstream drops some
+                (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+                self.assertTrue(flags & FLAG_GAP)
+                self.assertEqual((seq, count), (0, 3))
+                (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+                self.assertEqual((seq, vals.tolist()), (3, [(8, 4.0), (9, 5.0)]))
+                source = next(iter(relay.sources.values()))
+                self.assertTrue(np.isnan(source.rings["raw"].read(0, 3)["v"]).all())
+                self.assertEqual(list(source.gaps), [(0, 3)])
+                writer.close()
+                relay_task.cancel()
+
+
+class LiveServerWorkersTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_workers(self):
+        ls = LiveServer(host="127.0.0.1", port=0, sources=["thermal0"], workers=2)
+        ls.putter([1.0, 2.0], ts=[5, 6])
+        procs = ls.start_workers()
+        try:
+            for i in range(500):  # the workers take a moment to come up
+                try:
+                    reader, writer = await asyncio.open_connection(ls.host, ls.port)
+                    break
+                except ConnectionRefusedError:
+                    await asyncio.sleep(0.02)
+            msg = json.dumps({"framed": True}).encode()
+            writer.write(f"{len(msg)}".encode() + msg)
+            (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 10)
+            self.assertTrue(flags & FLAG_BACKLOG)
+            self.assertEqual(vals.tolist(), [(5, 1.0), (6, 2.0)])
+            ls.putter([3.0], ts=[7])
+            (dtype, flags, stream, seq, count), vals = await asyncio.wait_for(read_frame(reader), 1)
+            self.assertEqual((seq, vals.tolist()), (2, [(7, 3.0)]))
+            for i in range(500):  # the port's let go of once every worker has it
+                if ls._port_holder is None:
+                    break
+                await asyncio.sleep(0.02)
+            self.assertIsNone(ls._port_holder)
+            writer.close()
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.join()
+            for source in ls.sources.values():
+                source.close()